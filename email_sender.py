@@ -85,8 +85,12 @@ class EmailSender:
             if slept_time >= self.queue_time:
                 # send queued emails since queuing time has exceeded
                 msg = ''
+                traces = []
                 while not self.msg_queue.empty():
-                    msg += self.msg_queue.get() + '\n'
+                    (trade_str, trace) = self.msg_queue.get()
+                    msg += trade_str + '\n'
+                    if trace:
+                        traces.append(trace)
 
                 if self.send_opt == 1:
                     # Sending every email in bcc style
@@ -100,6 +104,9 @@ class EmailSender:
                     for email in email_list:
                         self.send([email], subj, msg)
 
+                for trace in traces:
+                    trace.mark('email')
+
                 # reset timer
                 slept_time = 0
             sleep(1)
@@ -125,8 +132,8 @@ class EmailSender:
            self.send([txt], subj, msg)
 
 
-    def queue_trade(self, trade_str):
-        self.msg_queue.put(trade_str)
+    def queue_trade(self, trade_str, trace=None):
+        self.msg_queue.put((trade_str, trace))
 
     def test_conn_open(self):
         try:
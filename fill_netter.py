@@ -0,0 +1,124 @@
+################################################################################
+# Nets partial fills. TradeStation sends an "Order has been filled" email for
+# every partial fill of an order, and each of them would become an order on
+# every account. Fills of the same order are held for a short window from the
+# first one and then released as a single fill of the total quantity, so that
+# the accounts get one order each, sized from the total.
+################################################################################
+import time
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from sig_tracer import monotonic
+
+
+class NettedFill(object):
+    """Fills of one order merged into its first signal."""
+
+    __slots__ = ('ts_signal', 'data', 'pieces', 'deadline', 'journal_ids')
+
+    def __init__(self, ts_signal, data, deadline, journal_id=None):
+        self.ts_signal = ts_signal  # first fill, its quantity and price become the totals
+        self.data = data            # email of the first fill
+        self.pieces = 1
+        self.deadline = deadline
+        self.journal_ids = [journal_id] if journal_id is not None else []     # of every fill
+
+    def merge(self, ts_signal, journal_id=None):
+        if journal_id is not None:
+            self.journal_ids.append(journal_id)
+        first = self.ts_signal
+        total = first.quantity + ts_signal.quantity
+        if first.price and ts_signal.price:
+            # average fill price weighted by quantity
+            first.price = (first.price * first.quantity + ts_signal.price * ts_signal.quantity) / total
+        first.quantity = total
+        self.pieces += 1
+
+
+class FillNetter:
+
+    def __init__(self, window, on_flush, logger=None):
+        """
+        :param window: seconds the fills of an order are collected for, from the first one
+        :param on_flush: called with the NettedFill once its window is over
+        """
+        self.window = window
+        self.on_flush = on_flush
+        self.logger = logger
+        self.pending = OrderedDict()    # key -> NettedFill, oldest first
+        self.cond = Condition()
+        self.stopped = False
+        self.fills = 0      # fills received
+        self.netted = 0     # fills merged into an earlier fill of their order
+        self.saved = 0      # broker messages saved, counted by the caller of on_flush
+
+        self.thread = Thread(target=self.run, name="fill-netter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    def key(ts_signal):
+        return (ts_signal.account_name, ts_signal.order_id, ts_signal.symbol, ts_signal.action)
+
+    def add(self, ts_signal, data, journal_id=None):
+        """
+        Hold a fill until the window of its order is over.
+        :param journal_id: id of the fill in the SignalJournal, if journaled on receipt
+        """
+        key = self.key(ts_signal)
+        with self.cond:
+            self.fills += 1
+            fill = self.pending.get(key)
+            if fill is None:
+                # the window is the same for all, so pending stays in deadline order
+                self.pending[key] = NettedFill(ts_signal, data, monotonic() + self.window, journal_id)
+                self.cond.notify()
+            else:
+                fill.merge(ts_signal, journal_id)
+                self.netted += 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopped:
+                    self.cond.wait()
+                wait = 0
+                if self.pending and not self.stopped:
+                    wait = next(self.pending.itervalues()).deadline - monotonic()
+            if wait > 0:
+                # a timed Condition.wait polls in steps of up to 50 ms on python 2, and
+                # later fills only have later deadlines, so nothing needs to wake us up
+                time.sleep(wait)
+                continue
+
+            with self.cond:
+                due = []
+                now = monotonic()
+                while self.pending:
+                    (key, fill) = next(self.pending.iteritems())
+                    if fill.deadline > now and not self.stopped:
+                        break
+                    del self.pending[key]
+                    due.append(fill)
+                if self.stopped and not due:
+                    return
+
+            for fill in due:
+                try:
+                    self.on_flush(fill)
+                except Exception as e:
+                    if self.logger:
+                        self.logger.error("netted fill of order# %s not dispatched: %s" %
+                                          (fill.ts_signal.order_id, str(e)))
+
+    def stats(self):
+        return "fill netting: %d fills, %d netted, %d broker messages saved" % (
+                self.fills, self.netted, self.saved)
+
+    def stop(self):
+        """Release the fills still held and stop."""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
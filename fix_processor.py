@@ -6,15 +6,19 @@ from threading import Event
 import quickfix as fix
 from sig_logger import SigLogger
 from fixapp.fix_wrapper import FixWrapper
-from sig_logger import SigLogger
+import sig_config
 
 
 class FixProcessor():
+
+    NOT_LOGGED_IN_LOG_INTERVAL = 30     # seconds between not logged in errors
+    reports_sent = True     # process_order calls on_sent once the queued order is sent
+
     def __init__(self, client, uilogger=None):
         cfg_file_path       = client.get("fix_cfg_path")
-        self.skip_list      = client.get('skip_list', [])
-        self.security_types = client.get('security_types')
-        self.sig_multiplier = client.get('sig_multiplier', 0.01)
+        self.name           = "FIX " + cfg_file_path
+        self.sizing         = sig_config.client_sizing(client)
+        self.min_order_interval = client.get('min_order_interval', 0)  # seconds, 0 for no pacing
         self.settings       = fix.SessionSettings(cfg_file_path)
         self.storeFactory   = fix.FileStoreFactory(self.settings)
         self.logFactory     = fix.FileLogFactory(self.settings)
@@ -22,7 +26,8 @@ class FixProcessor():
         self.uilogger  = uilogger
         self.logger    = SigLogger("FixProcessor", uilogger=uilogger)
 
-        self.app       = FixWrapper(self.settings, self.logger)
+        self.app       = FixWrapper(self.settings, self.logger,
+                                    on_state_change=self.session_state_changed)
         self.initiator = fix.SocketInitiator(
                                 self.app,
                                 self.storeFactory,
@@ -31,6 +36,8 @@ class FixProcessor():
 
         self.order_queue = Queue()  # used for order delivery
         self.stop_event = Event()   # used to signal thread exit
+        self.state_event = Event()  # set on logon, logout and stop
+        self.last_sent = 0          # time the last order was sent
 
     @property
     def session_id(self):
@@ -42,69 +49,107 @@ class FixProcessor():
     def start(self):
         try:
             self.initiator.start()
-            time.sleep(2)
             logged_in = False  # logged in state check for printing message
             while not (self.stop_event and self.stop_event.is_set()):
-
-                if not self.is_logged_in() and not self.stop_event.is_set():
-                    # send not logged-in error
-                    self.log_all("fix client is not logged in: " + self.session_id, level="error")
-                    # login will automatically retried every 30s of heartbeat.
-                    time.sleep(5)
+                # cleared before the state is checked, so that a logon or
+                # logout right after the check still ends the wait below.
+                self.state_event.clear()
+
+                if not self.is_logged_in():
+                    logged_in = False
+                    # woken up as soon as the session logs on or the processor
+                    # is stopped. login will automatically retried every 30s of heartbeat.
+                    if not self.state_event.wait(self.NOT_LOGGED_IN_LOG_INTERVAL):
+                        self.log_all("fix client is not logged in: " + self.session_id, level="error")
                     continue
 
-                # we're logged in. Only show connected message on the first 
-                # iteration of the loop using the flag.
+                # we're logged in. Only show connected message on the first
+                # iteration after logging on using the flag.
                 if not logged_in:
                     self.log_all("Connected to FIX: " + self.session_id)
                     logged_in = True
 
-                if self.order_queue.empty():
-                    time.sleep(0.2)
+                # block until a signal arrives. A None is queued to wake the
+                # loop up when the session state changes or on stop.
+                order = self.order_queue.get()
+                if order is None:
                     continue
-
-                # loop to check incoming signals
-                sig = self.order_queue.get()
-                qty = int(round(sig.quantity * self.sig_multiplier))
-                self.log_all(' '.join(["sent", self.session_id, sig.action,
-                               str(qty), sig.symbol, '@', sig.order_type]))
-
-                options = self.convert_order(sig)
-                if sig.action == 'buy':
-                    self.app.buy(**options)
-                elif sig.action == 'sell':
-                    self.app.sell(**options)
-                else:
-                    self.log_all("Unrecognized action: "
-                                + sig.action + " for " + self.session_id,
-                                level="error")
-                time.sleep(0.2)
+                self.send_order(*order)
         except (fix.ConfigError, fix.RuntimeError, ValueError) as e:
             self.logger.error(pp.pformat(e))
 
-    def process_order(self, ts_signal):
-        # skip symbol if it's in the skip list of the client
-        if len(self.skip_list) and ts_signal.symbol in self.skip_list:
-            return
-
-        # if security type is defined, we will only process the defined ones
-        if self.security_types and not self.security_types.get(
-                ts_signal.sec_type.lower()):
-            return
-
-        self.order_queue.put(ts_signal)
-
-    def convert_order(self, ts_signal):
+    def send_order(self, sig, qty, on_sent=None):
+        if self.min_order_interval:
+            # optional pacing between consecutive orders
+            wait = self.last_sent + self.min_order_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        self.log_all(' '.join(["sent", self.session_id, sig.action,
+                       str(qty), sig.symbol, '@', sig.order_type]))
+
+        options = self.convert_order(sig, qty)
+        sent = True
+        if sig.action == 'buy':
+            self.app.buy(**options)
+        elif sig.action == 'sell':
+            self.app.sell(**options)
+        else:
+            self.log_all("Unrecognized action: "
+                        + sig.action + " for " + self.session_id,
+                        level="error")
+            sent = False
+        self.last_sent = time.time()
+        if sig.trace:
+            sig.trace.mark(self.name)
+        if on_sent:
+            on_sent(sent)
+
+    def session_state_changed(self):
+        """Called by FixWrapper on logon and logout, wakes up the send loop."""
+        self.state_event.set()
+        self.order_queue.put(None)
+
+    def update(self, client):
+        """Apply reloaded settings from clients.yml, without logging out."""
+        self.sizing = sig_config.client_sizing(client)
+        self.min_order_interval = client.get('min_order_interval', 0)
+        self.log_all("Updated %s: %s" % (self.name, str(self.sizing)))
+
+    def process_order(self, ts_signal, quantity=None, on_sent=None):
+        """
+        Queue the order for the signal. A quantity is given when the signal was
+        already routed and sized by SigRouter, otherwise it's checked and sized here.
+        on_sent(ok) is called once the order was sent, or right away if it's skipped.
+        """
+        if quantity is None:
+            sizing = self.sizing    # one consistent snapshot, even during a reload
+
+            # skip symbol if it's in the skip list of the client, and if security
+            # type is defined, we will only process the defined ones. A client
+            # with a sig_multiplier of 0 takes no trades.
+            if not sizing.sig_multiplier or ts_signal.symbol in sizing.skip_list or \
+                    (sizing.security_types and not sizing.security_types.get(ts_signal.sec_type.lower())):
+                if on_sent:
+                    on_sent(True)   # nothing to send
+                return
+
+            quantity = int(round(ts_signal.quantity * sizing.sig_multiplier))
+
+        self.order_queue.put((ts_signal, quantity, on_sent))
+
+    def convert_order(self, ts_signal, quantity):
         return {
             '55': ts_signal.symbol,
-            '38': int(round(ts_signal.quantity * self.sig_multiplier)),
+            '38': quantity,
         }
 
     def stop(self):
-        self.uilogger.info("Disconnecting FIX: " + str(self.session_id))
+        self.log_all("Disconnecting FIX: " + str(self.session_id))
         self.app.logout()       # send logout to fix server
         self.initiator.stop()   # stop fix client
         self.stop_event.set()   # stop this thread
+        self.session_state_changed()
         
     def log_all(self, message, level='info'):
         self.logger.log_all(message, level=level)
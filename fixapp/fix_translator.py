@@ -1,37 +1,55 @@
-import json
 import pprint as pp
 
+import sig_config
+
+# admin messages not worth translating: heartbeats and test requests
+SKIPPED_MSG_TYPES = frozenset(['0', '1'])
+
+
 class FixTranslator():
     def __init__(self):
-        self.fix_dict = {}
-        self.load_dict()
-
-    def load_dict(self):
-        with open('./fixapp/dict_4.2.json', 'r') as df:
-            data = json.loads(df.read())
-            for f in data['Fields']:
-                self.fix_dict[str(f['Tag'])] = f
-
-    def translate(self, message):
-        if "|35=0|" in message:
-            # skip heartbeat message
+        # tag -> ("tag-Name: " prefix, value description map or None),
+        # loaded once per process and shared by all translators
+        self.fix_dict = sig_config.fix_dict()
+
+    def translate(self, message, sep='|'):
+        if sep + "35=0" + sep in message or sep + "35=1" + sep in message:
+            # skip heartbeat and test request messages
             return
-    
-        out = ''
-        data = message.split('|')
-        for kv in data:
-            if not kv or '=' not in kv:
+
+        lines = []
+        for kv in message.split(sep):
+            (k, eq, v) = kv.partition('=')
+            if not eq:
                 continue
-            (k,v) = kv.split('=')
-            m = self.fix_dict.get(str(k))
+            m = self.fix_dict.get(k)
             if not m:
-                out += "key " + str(k) + " is not found in dict!" + "\n"
-                continue
-            if "Val" in m:
-                out += str(k) + "-" + str(m.get("Name")) + ': ' + m.get("Val").get(str(v)) + "\n"
+                lines.append("key " + k + " is not found in dict!")
+            elif m[1]:
+                lines.append(m[0] + m[1].get(v, v))
             else:
-                out += str(k) + "-" + str(m.get("Name")) + ': ' + str(v) + "\n"
-        return out
+                lines.append(m[0] + v)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class LazyTranslation(object):
+    """
+    Log message that translates a raw FIX message only when it gets
+    formatted, i.e. when a handler actually emits the log record.
+    """
+
+    __slots__ = ('translator', 'message')
+
+    def __init__(self, translator, message):
+        self.translator = translator
+        self.message = message
+
+    def __nonzero__(self):
+        return True
+
+    def __str__(self):
+        return self.translator.translate(self.message, sep='\x01') or ''
 
 
 if __name__=='__main__':
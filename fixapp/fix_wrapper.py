@@ -2,15 +2,25 @@
 Wrapper module for Fix application.
 """
 __all__ = ['BaseFixClient']
+import os
 import pprint as pp
-import datetime as dt
 import time
 import quickfix as fix
 
-from fixapp.fix_translator import FixTranslator
+from fixapp.fix_translator import FixTranslator, LazyTranslation, SKIPPED_MSG_TYPES
+
+
+# call tracing is only wired in when SIGBRIDGE_FIX_DEBUG is set, so that
+# it costs nothing on the order path otherwise.
+FIX_DEBUG = bool(os.environ.get('SIGBRIDGE_FIX_DEBUG'))
+
+MSG_TYPE_TAG = fix.MsgType().getField()
 
 
 def echo(f):
+    if not FIX_DEBUG:
+        return f
+
     def decorated(*args, **kwargs):
         print(" --- calling " + f.__name__)
         return f(*args, **kwargs)
@@ -19,15 +29,22 @@ def echo(f):
 
 class FixWrapper(fix.Application):
 
-    def __init__(self, session_settings, logger):
+    def __init__(self, session_settings, logger, on_state_change=None):
         super(FixWrapper, self).__init__()
         self.session_settings = session_settings
         self.logger = logger
+        self.on_state_change = on_state_change  # called on logon and logout
 
         self.orderID = 0
         self.execID  = 0
         self.settingsDic = {}
         self.sessionID = None
+        self.sender_comp_id = None  # read from the session settings at onCreate
+        self.target_comp_id = None
+
+        # TransactTime up to the second, only reformatted when the second changes
+        self._ts_second = None
+        self._ts_prefix = None
 
         # Keep track of orders and IDs
         self.ORDERS_DICT   = {}
@@ -54,49 +71,69 @@ class FixWrapper(fix.Application):
         '''
         self.sessionID = sessionID
         self.settingsDic = self.session_settings.get(sessionID)
+        self.sender_comp_id = self.settingsDic.getString('SenderCompID')
+        self.target_comp_id = self.settingsDic.getString('TargetCompID')
         self.logger.info("created session id: " + sessionID.toString())
         return
 
     def onLogon(self, sessionID):
         self.logger.info("Logon to session " + sessionID.toString())
         self.is_logged_in = True
+        if self.on_state_change:
+            self.on_state_change()
         return
 
 
     def onLogout(self, sessionID):
         self.logger.info("Logout from session " + sessionID.toString())
         self.is_logged_in = False
+        if self.on_state_change:
+            self.on_state_change()
         return
 
+    def _log_message(self, message, msg_type=None, bulk=None):
+        '''Log the message, translated only if and when the log record is emitted.
+        Heartbeats and test requests are skipped before the message is rendered.
+        Messages of a bulk category may be sampled by the log backend under load.
+        '''
+        if not self.logger.is_enabled():
+            return
+        if msg_type is None:
+            msg_type = message.getHeader().getField(MSG_TYPE_TAG)
+        if msg_type in SKIPPED_MSG_TYPES:
+            return
+        msg = LazyTranslation(self.fix_tran, message.toString())
+        if bulk:
+            self.logger.bulk(msg, bulk)
+        else:
+            self.logger.info(msg)
+
     @echo
     def toAdmin(self, message, sessionID):
-        msg_type    = message.getHeader().getField(fix.MsgType().getField())
+        msg_type    = message.getHeader().getField(MSG_TYPE_TAG)
         if msg_type == fix.MsgType_Logon:
-            username = self.settingsDic.getString('SenderCompID')
+            username = self.sender_comp_id
             # password = self.settingsDic.getString('Password')
             #username = sessionID.getSenderCompID().getValue()
             message.setField(fix.Username(username))
             # message.setField(fix.Password(password))
-        self.logger.info(self.fix_tran.translate(self.unicode_fix(message.toString())))
+        self._log_message(message, msg_type, bulk='fix admin')
         return
 
     @echo
     def fromAdmin(self, message, sessionID):
-        fix_str = self.unicode_fix(message.toString())
-        self.logger.info(self.fix_tran.translate(fix_str))
+        self._log_message(message, bulk='fix admin')
         return
 
     @echo
     def toApp(self, message, sessionID):
-        fix_str = self.unicode_fix(message.toString())
-        self.logger.info(self.fix_tran.translate(fix_str))
+        self._log_message(message)
         return
 
     @echo
     def fromApp(self, message, sessionID):
         '''Capture Messages coming from the counterparty'''
-        fix_str = self.unicode_fix(message.toString())
-        self.logger.info(self.fix_tran.translate(fix_str))
+        self._log_message(message)
         return
 
     @echo
@@ -112,7 +149,7 @@ class FixWrapper(fix.Application):
     	return str(self.execID) + '-' + str(time.time())
 
     @echo
-    def _make_standard_header(self):
+    def _make_standard_header(self, msg_type=fix.MsgType_Logon):
         '''Make a standard header for Fortex FIX 4.4 Server based on their instruction file.
         A standard header for Fortex has the following tags (first 6 tags must be in this exact order):
         *     8  - BeginString  - required
@@ -124,21 +161,24 @@ class FixWrapper(fix.Application):
         *     43 - PossDupFlag  - Not required (can be Y or N)
         *     52 - SendingTime  - required
         '''
-        sender = self.settingsDic.getString('SenderCompID')
-        target = self.settingsDic.getString('TargetCompID')
         msg = fix.Message()
-        msg.getHeader().setField(fix.BeginString(fix.BeginString_FIX42))
-        msg.getHeader().setField(fix.MsgType(fix.MsgType_Logon))
-        msg.getHeader().setField(fix.SenderCompID(sender))
-        msg.getHeader().setField(fix.TargetCompID(target))
-        # Following line is a placeholder.
-        # I am just trying to force quickfix to put this tag in this particular order
-        # msg.getHeader().setField(fix.MsgSeqNum(3333))        
-        # msg.getHeader().setField(fix.SendingTime(1))
-
-        fix_str = self.unicode_fix(msg.toString())
+        header = msg.getHeader()
+        header.setField(fix.BeginString(fix.BeginString_FIX42))
+        header.setField(fix.MsgType(msg_type))
+        header.setField(fix.SenderCompID(self.sender_comp_id))
+        header.setField(fix.TargetCompID(self.target_comp_id))
+        # MsgSeqNum and SendingTime are filled in by the session on send.
         return msg
 
+    def _transact_time(self):
+        """UTC time as YYYYMMDD-HH:MM:SS.sss"""
+        now = time.time()
+        second = int(now)
+        if second != self._ts_second:
+            self._ts_prefix = time.strftime("%Y%m%d-%H:%M:%S", time.gmtime(second))
+            self._ts_second = second
+        return "%s.%03d" % (self._ts_prefix, int((now - second) * 1000))
+
 
     '''=======================================================================
     Internally keep track of orders and subscriptions. (This might later be 
@@ -214,9 +254,7 @@ class FixWrapper(fix.Application):
         _ordType     = kargs.get('40', fix.OrdType_MARKET)  # OrdType
         _secType     = kargs.get('167', fix.SecurityType_COMMON_STOCK)         #SecurityType
 
-        msg = self._make_standard_header()
-        msg.getHeader().setField(fix.BeginString(fix.BeginString_FIX42))
-        msg.getHeader().setField(fix.MsgType(fix.MsgType_NewOrderSingle)) #35=D
+        msg = self._make_standard_header(fix.MsgType_NewOrderSingle)  #35=D
         msg.setField(fix.ClOrdID(self.genOrderID()))                 #11=Unique order
 
         # system complained of missing tag. This order is good for the day or for the session
@@ -233,9 +271,7 @@ class FixWrapper(fix.Application):
         msg.setField(fix.OrdType(_ordType))   #40=2 Limit order
         msg.setField(fix.OrderQty(_orderQty)) #38=100
         msg.setField(fix.Price(_price))       #tag 44 price
-        time_stamp = int(time.time())
-        msg.getHeader().setField(fix.SendingTime(1))
-        msg.setField(fix.StringField(60,(dt.datetime.utcnow().strftime("%Y%m%d-%H:%M:%S.%f"))[:-3]))
+        msg.setField(fix.StringField(60, self._transact_time()))  #60 TransactTime
 
         return msg
 
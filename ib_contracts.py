@@ -0,0 +1,185 @@
+################################################################################
+# Resolved IB contracts. Orders used to build a new Contract every time, and TWS
+# resolved the symbol when the first order for it came in, so an ambiguous
+# symbol only showed up as a rejected order. Contracts are kept per TWS, keyed
+# on (symbol, sec_type), and after every connect the symbols of ibsymbols.yml,
+# the watchlist and those orders were sent for are qualified with contract
+# details requests: a symbol that resolves to one contract gets its conId and
+# orders go out against it, one TWS doesn't know or finds ambiguous is logged
+# then instead. The requests are paced along with the orders of the connection.
+################################################################################
+from copy import copy
+from Queue import Queue
+from threading import Thread, Lock
+
+from ib_orders import PACING_ERROR
+
+# TWS has no single contract for the request, asking again won't change that
+FAILED_CODES = frozenset([200, 321])
+
+
+class ContractCache:
+
+    REQ_ID_BASE = 1 << 30   # request ids apart from order ids, errors carry either
+
+    def __init__(self, name, build, request, logger):
+        """
+        :param build: build(symbol, sec_type) -> Contract, not resolved
+        :param request: request(req_id, contract) sends a contract details request,
+                        once paced, and returns False if not connected
+        """
+        self.name = name
+        self.build = build
+        self.request = request
+        self.logger = logger
+        self.contracts = {}     # (symbol, sec_type) -> Contract, with its conId once resolved
+        self.state = {}         # (symbol, sec_type) -> 'pending', 'resolved' or 'failed'
+        self.pending = {}       # req id -> ((symbol, sec_type), [ContractDetails])
+        self.lock = Lock()
+        self.queue = Queue()    # keys to qualify
+        self.next_req_id = self.REQ_ID_BASE
+        self.thread = None
+        self.misses = 0         # symbols first seen on an order, not qualified in advance
+
+    @staticmethod
+    def key(symbol, sec_type):
+        return (symbol.upper(), sec_type.upper())
+
+    def get(self, symbol, sec_type):
+        """Contract to send an order against, resolved if it could be."""
+        key = self.key(symbol, sec_type)
+        contract = self.contracts.get(key)
+        if contract is None:
+            # not qualified yet, resolved for the next order
+            contract = self.contracts.setdefault(key, self.build(*key))
+            self.misses += 1
+            self.qualify([key])
+        return contract
+
+    def qualify(self, keys):
+        """Have the contracts of the keys resolved, in the background."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="ib-contracts-" + self.name)
+                self.thread.daemon = True
+                self.thread.start()
+        for key in keys:
+            self.queue.put(self.key(*key))
+
+    def requalify(self, keys):
+        """
+        After a connect: requests in flight on the old connection are lost
+        and failed keys are retried, with every key not resolved yet.
+        """
+        with self.lock:
+            self.pending.clear()
+            for (key, state) in self.state.items():
+                if state != 'resolved':
+                    del self.state[key]
+            keys = set(self.key(*k) for k in keys) | set(self.contracts)
+            keys = [k for k in sorted(keys) if k not in self.state]
+        self.qualify(keys)
+
+    def forget(self, sec_type):
+        """Drop the contracts of a security type, built again for the next order."""
+        with self.lock:
+            for key in list(self.contracts):
+                if key[1] == sec_type:
+                    del self.contracts[key]
+                    self.state.pop(key, None)
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            with self.lock:
+                if key in self.state:
+                    continue    # resolved, failed or asked for already
+                self.state[key] = 'pending'
+                req_id = self.next_req_id
+                self.next_req_id += 1
+                self.pending[req_id] = (key, [])
+                contract = self.contracts.get(key) or self.build(*key)
+            if not self.request(req_id, contract):
+                # not connected, asked for again after the next connect
+                with self.lock:
+                    self.pending.pop(req_id, None)
+                    self.state.pop(key, None)
+
+    def details(self, req_id, details):
+        with self.lock:
+            entry = self.pending.get(req_id)
+            if entry:
+                entry[1].append(details)
+
+    def details_end(self, req_id):
+        with self.lock:
+            entry = self.pending.pop(req_id, None)
+        if entry is None:
+            return
+        (key, found) = entry
+        contract = self.contracts.get(key) or self.build(*key)
+
+        # TWS lists a stock once per listing, prim_exch of ibsymbols.yml picks one
+        prim_exch = (contract.m_primaryExch or '').upper()
+        if len(found) > 1 and prim_exch not in ('', 'SMART'):
+            found = [d for d in found if (d.m_summary.m_primaryExch or '').upper() == prim_exch]
+        con_ids = sorted(set(d.m_summary.m_conId for d in found))
+
+        if len(con_ids) != 1:
+            with self.lock:
+                self.state[key] = 'failed'
+            if con_ids:
+                reason = "matches %d contracts (%s), set its prim_exch in ibsymbols.yml" % (
+                        len(con_ids), ', '.join(sorted(set(d.m_summary.m_primaryExch or '?'
+                                                           for d in found))))
+            else:
+                reason = "not found"
+            self.logger.log_all("IB contract %s %s %s, orders go out by symbol" % (key[0], key[1], reason),
+                                level="error")
+            return
+
+        resolved = copy(contract)
+        resolved.m_conId = con_ids[0]
+        with self.lock:
+            self.contracts[key] = resolved
+            self.state[key] = 'resolved'
+        summary = found[0].m_summary
+        self.logger.info("IB contract %s %s: conId %d (%s)" % (
+                key[0], key[1], con_ids[0], summary.m_primaryExch or summary.m_exchange))
+
+    def error(self, req_id, err_code, err_msg):
+        """
+        True if the error is the answer to a contract details request. Only
+        FAILED_CODES mark the contract failed, a paced out request is sent
+        again once paced and any other error leaves it to the next connect.
+        """
+        with self.lock:
+            entry = self.pending.pop(req_id, None)
+            if entry is None:
+                return False
+            key = entry[0]
+            if err_code in FAILED_CODES:
+                self.state[key] = 'failed'
+            else:
+                self.state.pop(key, None)
+        if err_code == PACING_ERROR:
+            self.logger.info("IB contract %s %s paced out, asking again" % key)
+            self.queue.put(key)
+        elif err_code in FAILED_CODES:
+            self.logger.log_all("IB contract %s %s not qualified, orders go out by symbol: [%s] %s" % (
+                    key[0], key[1], err_code, err_msg), level="error")
+        else:
+            self.logger.log_all("IB contract %s %s not qualified yet, asked for again after the next "
+                                "connect: [%s] %s" % (key[0], key[1], err_code, err_msg), level="error")
+        return True
+
+    def stats(self):
+        with self.lock:
+            states = list(self.state.values())
+        return "contracts resolved %d, failed %d, first seen on an order %d" % (
+                states.count('resolved'), states.count('failed'), self.misses)
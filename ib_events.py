@@ -0,0 +1,90 @@
+################################################################################
+# Dispatch of the messages TWS sends on a connection. ibpy's Dispatcher looks
+# up the type of every message by name, then its listeners by type name, and
+# raises and catches a KeyError for every message nobody listens to (ticks,
+# order statuses...). IBEventDispatcher keeps a table from the EWrapper method
+# name straight to the message type and its handlers, rebuilt whenever a
+# handler is registered, so a message costs one lookup, and one that isn't
+# handled isn't even built. Handlers read the message's attributes.
+# Account values stream in for every key while subscribed; AccountValueFilter
+# keeps only the keys asked for and a value only when it changed, at most once
+# per interval per key.
+################################################################################
+from ib.lib import maybeName
+from ib.opt.dispatcher import Dispatcher
+
+from sig_tracer import monotonic
+
+
+class IBEventDispatcher(Dispatcher):
+
+    def __init__(self):
+        Dispatcher.__init__(self)
+        self.table = {}     # EWrapper method name -> (message type, handlers)
+
+    def register(self, listener, *types):
+        registered = Dispatcher.register(self, listener, *types)
+        self._build()
+        return registered
+
+    def unregister(self, listener, *types):
+        unregistered = Dispatcher.unregister(self, listener, *types)
+        self._build()
+        return unregistered
+
+    def _build(self):
+        table = {}
+        for (name, types) in self.messageTypes.items():
+            listeners = self.listeners.get(maybeName(types[0]))
+            if listeners:
+                table[name] = (types[0], tuple(listeners))
+        # replaced whole, the reader thread may be dispatching from the old one
+        self.table = table
+
+    def __call__(self, name, args):
+        entry = self.table.get(name)
+        if entry is None:
+            return []
+        (msg_type, listeners) = entry
+        msg = msg_type(**args)
+        results = []
+        for listener in listeners:
+            try:
+                results.append(listener(msg))
+            except Exception:
+                self.logger.exception("Exception in message dispatch.  Handler '%s' for '%s'",
+                                      maybeName(listener), name)
+                results.append(None)
+        return results
+
+
+class AccountValueFilter(object):
+
+    def __init__(self, keys=None, interval=60):
+        """
+        :param keys: account value keys to keep, e.g. NetLiquidation, None for all
+        :param interval: seconds before a changed value of the same key is kept again,
+                         a change within it is kept with the next update after it
+        """
+        self.last = {}      # (account, key, currency) -> (value kept, when)
+        self.received = 0
+        self.kept = 0
+        self.configure(keys, interval)
+
+    def configure(self, keys=None, interval=60):
+        self.keys = frozenset(keys) if keys else None
+        self.interval = interval
+
+    def accept(self, msg):
+        """True if the UpdateAccountValue message is to be logged."""
+        self.received += 1
+        if self.keys is not None and msg.key not in self.keys:
+            return False
+        key = (msg.accountName, msg.key, msg.currency)
+        last = self.last.get(key)
+        now = monotonic()
+        if last and (last[0] == msg.value or now - last[1] < self.interval):
+            return False
+        self.last[key] = (msg.value, now)
+        self.kept += 1
+        return True
@@ -0,0 +1,86 @@
+################################################################################
+# Order ids of a TWS connection. TWS wants every order of a client id to have
+# a new id above all the previous ones. Ids are handed out atomically, so any
+# number of threads can submit on a connection, and they are reserved in
+# blocks: only the end of the reserved block is written to disk, once per
+# block, and after a restart ids continue above it even if TWS's next valid
+# id is lower (e.g. its API order id sequence was reset).
+################################################################################
+import os
+from threading import Lock
+
+import sig_files
+
+
+class IBOrderIdAllocator(object):
+
+    def __init__(self, path=None, block=100, logger=None):
+        """
+        :param path: file keeping the high-water mark, None to not persist it
+        :param block: ids reserved with each write of the high-water mark
+        """
+        self.path = path
+        self.block = block
+        self.logger = logger
+        self.lock = Lock()
+        self.limit = 0          # ids below it may have been used (high-water mark)
+        self.next_id = 0        # next id to hand out
+        self.valid = False      # TWS sent its next valid id since the connection was made
+
+        if path:
+            self.limit = self.next_id = self._load()
+
+    def reconcile(self, next_valid_id):
+        """
+        Apply the next valid id TWS sends on every connect. Ids handed out
+        before are never reused, even if TWS never received them.
+        """
+        with self.lock:
+            self.next_id = max(next_valid_id, self.next_id)
+            self.valid = True
+            return self.next_id
+
+    def invalidate(self):
+        """The connection was lost, no ids until TWS sends its next valid id again."""
+        with self.lock:
+            self.valid = False
+
+    def allocate(self):
+        return self.reserve(1)
+
+    def reserve(self, count):
+        """First of count consecutive ids, for an order and its attached orders."""
+        with self.lock:
+            first = self.next_id
+            self.next_id += count
+            if self.next_id > self.limit:
+                limit = self.next_id + self.block
+                if self.path is None or self._save(limit):
+                    self.limit = limit
+            return first
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _save(self, limit):
+        """True once the high-water mark is on disk."""
+        tmp_path = self.path + '.tmp'
+        try:
+            if os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp_path, 'w') as f:
+                f.write('%d\n' % limit)
+                f.flush()
+                os.fsync(f.fileno())
+            sig_files.replace(tmp_path, self.path)
+            return True
+        except (IOError, OSError) as e:
+            # orders go on, the next id handed out tries again. Only a restart
+            # could reuse ids TWS doesn't know about.
+            if self.logger:
+                self.logger.error("order id high-water mark not saved: " + str(e))
+            return False
@@ -0,0 +1,242 @@
+################################################################################
+# Lifecycle of the orders placed on an IB account. Every order is registered as
+# it's placed and followed through the orderStatus and execDetails messages TWS
+# sends for it: when it was acknowledged, filled, cancelled or rejected, and at
+# what price. The ack and fill latency from placement go to the latency tracker
+# per account, and the fill price is compared with the TradeStation Filled
+# Price of the signal. Only the last max_orders orders are kept.
+# The on_sent callback of an order is held until TWS answers it, so an order
+# TWS paces out is reported once it's placed again, or dropped, instead.
+################################################################################
+from collections import OrderedDict
+from threading import Lock
+
+from sig_tracer import monotonic
+
+# statuses TWS sends once it has accepted the order
+ACK_STATUSES = frozenset(['PreSubmitted', 'Submitted', 'Filled'])
+# statuses of orders that ended without being filled
+UNFILLED_STATUSES = frozenset(['Cancelled', 'ApiCancelled', 'Inactive'])
+# errors for an order id that mean TWS didn't take the order
+PACING_ERROR = 100      # too many messages, the order can be placed again
+REJECT_CODES = frozenset([PACING_ERROR, 103, 110, 200, 201, 203])
+
+
+class IBOrder(object):
+
+    __slots__ = ('order_id', 'client_id', 'ts_signal', 'symbol', 'action', 'quantity', 'ts_price',
+                 'placed', 'acked', 'filled_at', 'status', 'filled', 'avg_price',
+                 'exec_ids', 'exec_shares', 'exec_value', 'error', 'on_sent')
+
+    def __init__(self, client_id, order_id, placed=None):
+        self.client_id = client_id
+        self.order_id = order_id
+        self.ts_signal = None   # signal the order was placed for, None if not placed by us
+        self.symbol = None
+        self.action = None
+        self.quantity = None
+        self.ts_price = None    # TradeStation Filled Price of the signal, if it was a fill
+        self.placed = placed    # monotonic times, None if not seen
+        self.acked = None
+        self.filled_at = None
+        self.status = None
+        self.filled = 0         # shares filled, as of the last orderStatus
+        self.avg_price = None   # average fill price, as of the last orderStatus
+        self.exec_ids = set()   # executions reported, TWS may report one again
+        self.exec_shares = 0
+        self.exec_value = 0.0
+        self.error = None       # code of the error TWS rejected the order with
+        self.on_sent = None     # on_sent(ok) of the order, until TWS answers it
+
+    def fill_price(self):
+        if self.exec_shares:
+            return self.exec_value / self.exec_shares
+        return self.avg_price or None
+
+    def slippage(self):
+        """Fill price against TradeStation's in basis points, positive when it's worse."""
+        price = self.fill_price()
+        if not price or not self.ts_price:
+            return None
+        bps = (price - self.ts_price) / self.ts_price * 1e4
+        return bps if (self.action or '').upper() == 'BUY' else -bps
+
+
+class IBOrderRegistry:
+
+    def __init__(self, tracker=None, max_orders=1000):
+        """
+        :param tracker: LatencyTracker the ack and fill latency go to, if any
+        :param max_orders: orders kept, the oldest are forgotten first
+        """
+        self.tracker = tracker
+        self.max_orders = max_orders
+        self.account = None     # account the latency is recorded for
+        self.orders = OrderedDict()     # (client id, order id) -> IBOrder, oldest first
+        self.lock = Lock()
+        self.counts = {'placed': 0, 'acked': 0, 'filled': 0, 'cancelled': 0, 'rejected': 0, 'paced': 0}
+
+    def get(self, client_id, order_id):
+        with self.lock:
+            return self.orders.get((client_id, order_id))
+
+    def placed(self, client_id, order_id, ts_signal, quantity, on_sent=None):
+        """
+        Register an order, before it's sent so that no answer can come first.
+        on_sent(True) is called once TWS answers it with anything but a pacing error.
+        """
+        order = IBOrder(client_id, order_id, monotonic())
+        order.ts_signal = ts_signal
+        order.symbol = ts_signal.symbol
+        order.action = ts_signal.action
+        order.quantity = quantity
+        order.on_sent = on_sent
+        if ts_signal.sig_type == 'filled':
+            order.ts_price = ts_signal.price
+        with self.lock:
+            evicted = self._add(order)
+            self.counts['placed'] += 1
+        self._report(evicted)
+        return order
+
+    def discard(self, client_id, order_id):
+        """The order didn't go out, it's placed again under another id. on_sent isn't called."""
+        with self.lock:
+            if self.orders.pop((client_id, order_id), None):
+                self.counts['placed'] -= 1
+
+    def status(self, client_id, msg):
+        """Apply an orderStatus message, returns the order if its status changed."""
+        now = monotonic()
+        with self.lock:
+            (order, answered) = self._order(client_id, msg.orderId)
+            order.filled = msg.filled or 0
+            order.avg_price = msg.avgFillPrice
+            changed = order.status != msg.status    # TWS repeats unchanged statuses
+            if changed:
+                order.status = msg.status
+                if msg.status in ACK_STATUSES:
+                    self._acked(order, now)
+                if msg.status == 'Filled':
+                    self._filled(order, now)
+                elif msg.status in UNFILLED_STATUSES and order.error is None and order.placed is not None:
+                    self.counts['cancelled'] += 1
+        self._report(answered)
+        return order if changed else None
+
+    def execution(self, client_id, execution):
+        """Apply an execDetails message, returns the order."""
+        now = monotonic()
+        with self.lock:
+            (order, answered) = self._order(client_id, execution.m_orderId)
+            if execution.m_execId not in order.exec_ids:
+                order.exec_ids.add(execution.m_execId)
+                order.exec_shares += execution.m_shares
+                order.exec_value += execution.m_shares * execution.m_price
+                self._acked(order, now)
+                if order.quantity and order.exec_shares >= order.quantity:
+                    self._filled(order, now)
+        self._report(answered)
+        return order
+
+    def error(self, client_id, order_id, err_code):
+        """
+        Apply an error for an order id, returns the order if it was rejected.
+        A paced out order keeps its on_sent, see take_on_sent.
+        """
+        if err_code not in REJECT_CODES:
+            return None
+        answered = []
+        with self.lock:
+            order = self.orders.get((client_id, order_id))
+            if order is None or order.error is not None or order.filled_at is not None:
+                return None
+            order.error = err_code
+            if err_code == PACING_ERROR:
+                self.counts['paced'] += 1
+            else:
+                self.counts['rejected'] += 1
+                answered = self._answered(order)    # it was sent, TWS turned it down
+        self._report(answered)
+        return order
+
+    def take_on_sent(self, order):
+        """The on_sent of an order placed again, which reports for both of them."""
+        with self.lock:
+            (on_sent, order.on_sent) = (order.on_sent, None)
+        return on_sent
+
+    def release(self, client_id=None):
+        """
+        TWS won't answer the orders of a connection that's gone, of every
+        connection if client_id is None: they are reported sent, as TWS may
+        have taken them.
+        """
+        answered = []
+        with self.lock:
+            for order in self.orders.values():
+                if client_id is None or order.client_id == client_id:
+                    answered.extend(self._answered(order))
+        self._report(answered)
+
+    def stats(self):
+        with self.lock:
+            slippage = sorted(s for s in (o.slippage() for o in self.orders.values()) if s is not None)
+            counts = dict(self.counts)
+        text = "orders placed %(placed)d, acked %(acked)d, filled %(filled)d, " \
+               "cancelled %(cancelled)d, rejected %(rejected)d, paced out %(paced)d" % counts
+        if slippage:
+            text += ", slippage vs TradeStation p50 %.1f p90 %.1f bps (%d fills)" % (
+                    slippage[len(slippage) // 2], slippage[int(len(slippage) * 0.9)], len(slippage))
+        return text
+
+    def _order(self, client_id, order_id):
+        """
+        The order, registered unplaced if it wasn't placed by us, and the
+        on_sent callbacks TWS answered with it. Called with lock held.
+        """
+        order = self.orders.get((client_id, order_id))
+        if order is None:
+            order = IBOrder(client_id, order_id)
+            return (order, self._add(order))
+        return (order, self._answered(order))
+
+    def _add(self, order):
+        """Returns the on_sent callbacks of the orders it pushed out."""
+        evicted = []
+        self.orders[(order.client_id, order.order_id)] = order
+        while len(self.orders) > self.max_orders:   # it may have been lowered by a reload
+            evicted.extend(self._answered(self.orders.popitem(last=False)[1]))
+        return evicted
+
+    @staticmethod
+    def _answered(order):
+        """The order's on_sent as a list, once. Called with lock held."""
+        if order.on_sent is None:
+            return []
+        (on_sent, order.on_sent) = (order.on_sent, None)
+        return [on_sent]
+
+    @staticmethod
+    def _report(answered):
+        """Call the on_sent callbacks of answered orders, outside the lock."""
+        for on_sent in answered:
+            on_sent(True)
+
+    def _acked(self, order, now):
+        if order.acked is not None:
+            return
+        order.acked = now
+        if order.placed is not None:
+            self.counts['acked'] += 1
+            if self.tracker:
+                self.tracker.record("IB ack %s" % (self.account or '?'), now - order.placed)
+
+    def _filled(self, order, now):
+        if order.filled_at is not None:
+            return
+        order.filled_at = now
+        if order.placed is not None:
+            self.counts['filled'] += 1
+            if self.tracker:
+                self.tracker.record("IB fill %s" % (self.account or '?'), now - order.placed)
@@ -0,0 +1,228 @@
+################################################################################
+# Paces the orders of an IB client. TWS accepts at most IB_MAX_RATE messages per
+# second on a connection and answers any more with a pacing error (code 100),
+# so orders are queued and sent through a token bucket per connection instead
+# of as fast as signals arrive. An IB client can open extra connections under
+# other client ids to the same TWS; orders then go out on whichever connection
+# has a token, which multiplies the rate a burst drains at. The time every
+# order waited in the queue is recorded per account.
+# While no connection is up, orders are held in the queue: at most max_held of
+# them and for at most hold_time seconds. Orders held longer are dropped with
+# an alert instead of being sent late once the connection is back. An order
+# TWS still rejects with a pacing error is queued again in front.
+################################################################################
+import time
+from Queue import Queue
+from threading import Thread, Lock
+
+from sig_tracer import monotonic
+
+IB_MAX_RATE = 50    # messages per second TWS accepts on one connection
+DEFAULT_RATE = 40   # orders per second per connection...
+DEFAULT_BURST = 10  # ...plus a burst, never more than IB_MAX_RATE in any second
+HOLD_POLL = 0.05    # seconds between checks for a connection while orders are held
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+
+    def delay(self, now):
+        """Seconds until a token is available, 0 if there is one."""
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        """Hold back the next token for the given time, after TWS reported pacing."""
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class IBChannel(object):
+    """A connection to TWS under one client id, with its own order ids and pacing."""
+
+    def __init__(self, con, client_id, ids, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.con = con
+        self.client_id = client_id
+        self.ids = ids      # IBOrderIdAllocator of this client id
+        self.bucket = TokenBucket(rate, burst)
+        self.sent = 0   # orders sent on this connection
+        self.placing = None         # order id placeOrder is writing, if any
+        self.send_failed = False    # placeOrder reported it didn't send that order
+
+    def is_ready(self):
+        """Connected and given its first order id by TWS."""
+        client = self.con.sender.client     # None until the first connect
+        return client is not None and client.isConnected() and self.ids.valid
+
+
+class IBOrderScheduler:
+
+    def __init__(self, channels, send, tracker=None, logger=None, max_held=100, hold_time=60):
+        """
+        :param channels: IBChannels of the client, the first one is the main connection
+        :param send: send(channel, ts_signal, quantity, on_sent), places the order on
+                     the channel and returns False if it couldn't be sent on it. Once
+                     placed, on_sent is up to send, which calls it when TWS answers
+        :param tracker: LatencyTracker recording the queue wait, if any
+        :param max_held: orders queued while disconnected before new ones are dropped
+        :param hold_time: seconds an order may wait before it's dropped
+        """
+        self.channels = channels
+        self.send = send
+        self.tracker = tracker
+        self.logger = logger
+        self.max_held = max_held
+        self.hold_time = hold_time
+        self.account = None     # account the queue wait is recorded for
+        self.queue = Queue()
+        self.current = None     # order taken from the queue and not placed yet
+        self.lock = Lock()      # guards the buckets against update
+        self.thread = None
+        self.stopped = False
+        self.dropped = 0        # orders dropped, expired or over max_held
+        self.retried = 0        # orders placed again after TWS paced them out
+
+    def start(self, name):
+        if self.thread:
+            return
+        self.thread = Thread(target=self.run, name="ib-orders-" + name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, ts_signal, quantity, on_sent=None):
+        """Queue an order, on_sent(ok) is called once TWS answered it or it was dropped."""
+        item = (monotonic(), ts_signal, quantity, on_sent)
+        if self.queue.qsize() >= self.max_held and not any(c.is_ready() for c in self.channels):
+            self._drop(item, "%d orders are already held" % self.queue.qsize())
+            return
+        self.queue.put(item)
+
+    def retry(self, ts_signal, quantity, on_sent=None):
+        """
+        Place an order TWS rejected with a pacing error again, ahead of every
+        order still queued. on_sent is the one of the first placement, it was
+        held back until now.
+        """
+        item = (monotonic(), ts_signal, quantity, on_sent)
+        with self.queue.mutex:
+            self.queue.queue.appendleft(item)
+            self.queue.unfinished_tasks += 1
+            self.queue.not_empty.notify()
+        self.retried += 1
+
+    def set_pacing(self, rate, burst):
+        with self.lock:
+            for channel in self.channels:
+                channel.bucket.rate = rate
+                channel.bucket.burst = burst
+
+    def wait_token(self, channel):
+        """
+        Take a token of the channel for a request other than an order, once
+        the bucket is full and no order is waiting, so that it never holds
+        back a burst of orders. Returns False if the connection isn't ready,
+        or on stop.
+        """
+        while not self.stopped and channel.is_ready():
+            wait = HOLD_POLL
+            if self.current is None and self.queue.empty():
+                with self.lock:
+                    bucket = channel.bucket
+                    bucket.delay(monotonic())
+                    if bucket.tokens >= bucket.burst:
+                        bucket.take()
+                        return True
+                    wait = min(wait, (bucket.burst - bucket.tokens) / bucket.rate)
+            time.sleep(wait)
+        return False
+
+    def stop(self):
+        """Stop sending, orders still queued are not reported as sent."""
+        self.stopped = True
+        self.queue.put(None)
+
+    def run(self):
+        item = None
+        while not self.stopped:
+            if item is None:
+                self.current = None
+                item = self.queue.get()
+                if item is None:
+                    break
+                self.current = item
+            (queued, ts_signal, quantity, on_sent) = item
+
+            channel = self._next_channel(queued)
+            if channel is None:
+                if not self.stopped:
+                    self._drop(item, "held for more than %d sec" % self.hold_time)
+                item = None
+                continue
+
+            wait = monotonic() - queued
+            ok = False
+            try:
+                if not self.send(channel, ts_signal, quantity, on_sent):
+                    continue    # connection lost, the order waits for the next one
+                ok = True
+            except Exception as e:
+                if self.logger:
+                    self.logger.log_all("IB order not placed: %s" % str(e), level="error")
+            item = None
+            if ok:
+                channel.sent += 1
+                if self.tracker:
+                    self.tracker.record("IB queue wait %s" % (self.account or '?'), wait)
+            elif on_sent:
+                on_sent(False)
+
+    def _drop(self, item, reason):
+        (queued, ts_signal, quantity, on_sent) = item
+        self.dropped += 1
+        if self.logger:
+            self.logger.log_all("IB order dropped, %s: %s %s %s %d %s" % (
+                    reason, self.account, ts_signal.order_id, ts_signal.action,
+                    quantity, ts_signal.symbol), level="error")
+        if on_sent:
+            on_sent(False)
+
+    def _next_channel(self, queued):
+        """
+        Wait for a token on a ready connection and take it. Returns None if the
+        order expires while no connection is up, or on stop.
+        """
+        while not self.stopped:
+            if monotonic() - queued > self.hold_time:
+                return None
+            with self.lock:
+                now = monotonic()
+                ready = [c for c in self.channels if c.is_ready()]
+                best = None
+                wait = HOLD_POLL
+                for channel in ready:
+                    delay = channel.bucket.delay(now)
+                    # the connection with the most tokens left spreads a burst evenly
+                    if best is None or delay < wait or (delay == wait == 0 and
+                            channel.bucket.tokens > best.bucket.tokens):
+                        (best, wait) = (channel, delay)
+                if best and wait == 0:
+                    best.bucket.take()
+                    return best
+            # held while no connection is ready, checked every HOLD_POLL seconds
+            time.sleep(wait)
+        return None
+
+    def stats(self):
+        return "queued %d, dropped %d, retried %d, sent per client id: %s" % (
+                self.queue.qsize(), self.dropped, self.retried, ', '.join(
+                "%s: %d" % (c.client_id, c.sent) for c in self.channels))
@@ -0,0 +1,94 @@
+################################################################################
+# Reconnects lost IB connections in the background. A lost connection is
+# retried with exponential backoff and jitter, so that the ibpy reader thread
+# that noticed the loss returns at once and reconnecting clients don't all hit
+# a restarting TWS at the same moment. Orders meanwhile wait in the client's
+# order queue until the connection is back and has a fresh order id.
+################################################################################
+import random
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from sig_tracer import monotonic
+
+
+class ReconnectSupervisor:
+
+    MIN_DELAY = 1.0     # seconds before the first retry
+    MAX_DELAY = 60.0    # longest wait between retries
+
+    def __init__(self, name, reconnect, logger):
+        """
+        :param reconnect: reconnect(channel), returns True once connected
+        """
+        self.name = name
+        self.reconnect = reconnect
+        self.logger = logger
+        self.down = OrderedDict()   # channel -> [failed attempts, time of the next attempt]
+        self.cond = Condition()
+        self.stopped = False
+        self.thread = None
+
+    def backoff(self, attempts):
+        """Exponential delay after the given failed attempts, with jitter of up to half of it."""
+        delay = min(self.MAX_DELAY, self.MIN_DELAY * 2 ** attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    def lost(self, channel, retry_now=False):
+        """Have a lost connection reconnected, right away or after MIN_DELAY."""
+        with self.cond:
+            if self.stopped or channel in self.down:
+                return
+            self.down[channel] = [0, monotonic() + (0 if retry_now else self.backoff(0))]
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="ib-reconnect-" + self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+
+    def is_down(self, channel):
+        with self.cond:
+            return channel in self.down
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    if self.down:
+                        wait = min(t for (_, t) in self.down.values()) - monotonic()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                if self.stopped:
+                    return
+                now = monotonic()
+                due = [c for (c, (_, t)) in self.down.items() if t <= now]
+
+            for channel in due:
+                connected = False
+                try:
+                    connected = self.reconnect(channel)
+                except Exception as e:
+                    self.logger.error("IB reconnect %s/%s: %s" % (self.name, channel.client_id, str(e)))
+                with self.cond:
+                    state = self.down.get(channel)
+                    if state is None:
+                        continue
+                    if connected:
+                        del self.down[channel]
+                        self.logger.log_all("Reconnected to IB %s/%s after %d failed attempt(s)" %
+                                            (self.name, channel.client_id, state[0]))
+                        continue
+                    state[0] += 1
+                    delay = self.backoff(state[0])
+                    state[1] = monotonic() + delay
+                self.logger.log_all("Not connected to IB %s/%s, will retry in %.1f sec..." %
+                                    (self.name, channel.client_id, delay), level="error")
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.down.clear()
+            self.cond.notify()
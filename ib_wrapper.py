@@ -1,108 +1,306 @@
 # -*- coding: utf-8 -*-
-import re
+import os
+import socket
 from time import sleep
-import yaml
-from threading import Event
+from functools import partial
 
 from ib.ext.Contract import Contract
 from ib.ext.Order import Order
 from ib.opt import ibConnection
 from sig_logger import SigLogger
+from ib_scheduler import IBChannel, IBOrderScheduler, DEFAULT_RATE, DEFAULT_BURST
+from ib_supervisor import ReconnectSupervisor
+from ib_order_ids import IBOrderIdAllocator
+from ib_events import IBEventDispatcher, AccountValueFilter
+from ib_contracts import ContractCache
+from ib_orders import IBOrderRegistry, UNFILLED_STATUSES, PACING_ERROR
+import sig_config
 
 
 TS2IB_ORDER_TYPE_MAP = {'market': 'mkt'}
 
+# EClientSocket's own errors, reported from inside the call that failed
+NOT_CONNECTED = 504
+FAIL_SEND_ORDER = 512
+
 
 class IBWrapper:
-    def __init__(self, ib_host, uilogger=None):
-        self.nextOrderId = 0
+
+    PACING_BACKOFF = 1.0    # seconds a connection sends nothing after a pacing error
+    reports_sent = True     # process_order calls on_sent once TWS answered the queued order
+
+    def __init__(self, ib_host, uilogger=None, tracker=None):
         self.account_id = None
-        self.reconnected = False
-        self.stop_event = Event()
         self.logger = SigLogger("IBWrapper", uilogger=uilogger)
 
         self.con_str = ''.join([ib_host['server'], ":", str(ib_host['port'])])
-        self.con = ibConnection(ib_host['server'], ib_host['port'], ib_host['client_id'])
-        self.sig_multiplier = ib_host['sig_multiplier'] or 0.01
-        self.skip_list = ib_host.get('skip_list', [])
-        self.security_types = ib_host.get('security_types')
+        self.name = "IB %s/%s" % (self.con_str, ib_host['client_id'])
+        self.sizing = sig_config.client_sizing(ib_host)
         self.fut_exch = ib_host.get('fut_exch', 'CME')
 
-        # Assign corresponding handling function to message types
-        self.con.register(self.my_account_handler, 'UpdateAccountValue')
-        self.con.register(self.error_handler, 'Error')
-        self.con.register(self.next_valid_id_handler, 'NextValidId')
-        self.con.register(self.managed_account_handler, 'ManagedAccounts')
-        # self.con.register(self.my_tick_handler, message.tickSize, message.tickPrice)
+        # account values are only subscribed to when account_values is set
+        self.account_values = ib_host.get('account_values')
+        self.account_filter = AccountValueFilter(**self.account_filter_conf(ib_host))
+        # orders followed from placement to fill, with their ack and fill latency
+        self.orders = IBOrderRegistry(tracker, max_orders=ib_host.get('max_orders', 1000))
+
+        # the main connection, plus the extra client_ids connections to the
+        # same TWS that orders are spread over. Each has its own order ids.
+        id_conf = sig_config.app_conf().get('ib_order_ids') or {}
+        self.channels = []
+        for client_id in [ib_host['client_id']] + list(ib_host.get('client_ids') or []):
+            con = ibConnection(ib_host['server'], ib_host['port'], client_id,
+                               dispatcher=IBEventDispatcher())
+            id_path = None
+            if id_conf.get('dir'):
+                id_path = os.path.join(id_conf['dir'], '%s_%s_%s' % (ib_host['server'],
+                                                                    ib_host['port'], client_id))
+            ids = IBOrderIdAllocator(id_path, block=id_conf.get('block', 100), logger=self.logger)
+            channel = IBChannel(con, client_id, ids,
+                                ib_host.get('max_rate', DEFAULT_RATE),
+                                ib_host.get('burst', DEFAULT_BURST))
+
+            # Assign corresponding handling function to message types
+            handlers = {
+                'UpdateAccountValue': self.my_account_handler,
+                'Error': self.error_handler,
+                'NextValidId': self.next_valid_id_handler,
+                'ManagedAccounts': self.managed_account_handler,
+                'OrderStatus': self.order_status_handler,
+                'OpenOrder': self.open_order_handler,
+                'ExecDetails': self.exec_details_handler,
+                'ContractDetails': self.contract_details_handler,
+                'ContractDetailsEnd': self.contract_details_end_handler,
+                'ConnectionClosed': self.connection_closed_handler,
+            }
+            for (msg_type, handler) in handlers.items():
+                con.register(partial(handler, channel=channel), msg_type)
+            # con.register(self.my_tick_handler, message.tickSize, message.tickPrice)
+            self.channels.append(channel)
+        self.con = self.channels[0].con
+
+        # orders are queued and paced per connection by the scheduler, and held
+        # there while no connection is up. Lost connections are reconnected
+        # in the background by the supervisor.
+        self.scheduler = IBOrderScheduler(self.channels, self.send_order,
+                                          tracker=tracker, logger=self.logger,
+                                          max_held=ib_host.get('max_held', 100),
+                                          hold_time=ib_host.get('hold_time', 60))
+        self.supervisor = ReconnectSupervisor(self.con_str, self.reconnect, self.logger)
 
         # Assign rest of server reply messages to the
         # reply_handler function
         # self.con.registerAll(self.reply_handler)
 
-        # reading ib's symbol mapping
-        with open('conf/ibsymbols.yml', 'r') as cf:
-            self.symbol_map = yaml.load(cf, Loader=yaml.FullLoader)
+        # ib's symbol mapping, parsed once and shared by all IB clients,
+        # by (symbol, sec_type) in upper case as orders look it up
+        self.symbol_attrs = {}
+        for (sec_type, symbols) in sig_config.symbol_map().items():
+            for (symbol, attrs) in (symbols or {}).items():
+                self.symbol_attrs[ContractCache.key(symbol, sec_type)] = attrs or {}
+
+        # contracts of the symbols of ibsymbols.yml and the watchlist are resolved
+        # after every connect, orders are sent against them. One cache for all
+        # the connections, conIds are the same for every client id.
+        self.watchlist = (sig_config.app_conf().get('ib_contracts') or {}).get('watchlist') or {}
+        self.contracts = ContractCache(self.con_str, self.create_contract,
+                                       self.request_contract, self.logger)
+
+    @property
+    def nextOrderId(self):
+        """Next order id of the main connection."""
+        return self.channels[0].ids.next_id
 
     def connect(self):
-        cnt = 0
-        while not (self.stop_event and self.stop_event.is_set()):
-            if self.con.connect():
-                # give it a second to get data
-                sleep(1)
-                if self.account_id:
-                    self.log_all("Connected to IB: " + self.account_id)
-                return True
-            else:
-                # keep max retry count
-                cnt += 1
-                if cnt > 15:
-                    return False
-                sleep_time = 2 * cnt
-                acct = self.account_id if self.account_id else self.con_str
-                self.log_all('Not connected to IB account %s, will retry in %d sec...' % 
-                             (acct, sleep_time),
-                             level="error")
-                sleep(sleep_time)
-
-    def my_account_handler(self, msg):
-        self.logger.info(msg)
-
-    def managed_account_handler(self, msg):
-        """Handles the capturing of account id"""
-        regex = re.search(r'accountsList=(\w+)', str(msg))
-        if regex:
-            self.account_id = regex.group(1)
-            self.logger.info("IB account: %s" % self.account_id)
-        else:
-            raise ValueError("No account id found in msg: " + msg)
+        """
+        Connect the main connection and then the extra ones. Connections that
+        fail are retried by the supervisor, orders are held until one is up.
+        """
+        self.scheduler.start(self.name)
+        connected = True
+        for channel in self.channels:
+            if channel.con.connect():
+                self.set_no_delay(channel)
+                continue
+            connected = False
+            acct = self.account_id if self.account_id else self.con_str
+            self.log_all('Not connected to IB account %s/%s, will retry...' % (acct, channel.client_id),
+                         level="error")
+            self.supervisor.lost(channel)
+        if connected:
+            # give it a second to get data
+            sleep(1)
+            if self.account_id:
+                self.log_all("Connected to IB: " + self.account_id)
+        return connected
+
+    def reconnect(self, channel):
+        """Called by the supervisor to reconnect a lost connection."""
+        channel.con.disconnect()    # whatever is left of the old socket
+        if not channel.con.connect():
+            return False
+        self.set_no_delay(channel)
+        return True
+
+    def set_no_delay(self, channel):
+        """
+        ibpy writes a request one byte at a time, and with Nagle's algorithm
+        its last bytes wait for TWS to acknowledge the first ones, which it
+        delays by up to 40 ms. Every request is sent as it's written instead.
+        """
+        try:
+            channel.con.sender.client.m_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, socket.error) as e:
+            self.logger.error("TCP_NODELAY not set on client id %s: %s" % (channel.client_id, str(e)))
+
+    def connection_lost(self, channel):
+        """Hold the orders of a lost connection until it has reconnected."""
+        if self.supervisor.is_down(channel):
+            return
+        channel.ids.invalidate()    # not ready until TWS sends a fresh next valid id
+        self.orders.release(channel.client_id)
+        self.log_all("Lost IB connection %s/%s, orders are held until it's back" %
+                     (self.con_str, channel.client_id), level="error")
+        self.supervisor.lost(channel, retry_now=True)
+
+    def connection_closed_handler(self, msg, channel=None):
+        """Sent by the ibpy reader when TWS closed the connection, not on disconnect."""
+        self.connection_lost(channel)
+
+    @staticmethod
+    def account_filter_conf(ib_host):
+        conf = ib_host.get('account_values') or {}
+        return {'keys': conf.get('keys'), 'interval': conf.get('interval', 60)}
+
+    def my_account_handler(self, msg, channel=None):
+        if self.account_filter.accept(msg):
+            self.logger.bulk("IB account value %s: %s = %s %s" % (
+                    msg.accountName, msg.key, msg.value, msg.currency or ''), 'account')
+
+    def managed_account_handler(self, msg, channel=None):
+        """Handles the capturing of account id, sent on every connect"""
+        if not msg.accountsList:
+            raise ValueError("No account id found in msg: " + str(msg))
+        self.account_id = msg.accountsList.split(',')[0]
+        self.scheduler.account = self.account_id
+        self.orders.account = self.account_id
+        self.logger.info("IB account: %s" % self.account_id)
+        if self.account_values and channel is self.channels[0]:
+            channel.con.reqAccountUpdates(True, self.account_id)
 
     def my_tick_handler(self, msg):
         self.logger.info(msg)
 
-    def next_valid_id_handler(self, msg):
+    def next_valid_id_handler(self, msg, channel=None):
         """Handles the capturing of next valid order id"""
-        regex = re.search(r'orderId=(\d+)', str(msg))
-        if regex:
-            self.nextOrderId = int(regex.group(1))
-            self.logger.info("next valid id: %d" % self.nextOrderId)
-        else:
-            raise ValueError("No next valid id found in msg: " + msg)
-
-    def error_handler(self, msg):
+        if msg.orderId is None:
+            raise ValueError("No next valid id found in msg: " + str(msg))
+        next_id = channel.ids.reconcile(msg.orderId)
+        self.logger.info("next valid id: %d, orders continue from %d (client id %s)" %
+                         (msg.orderId, next_id, channel.client_id))
+        if channel is self.channels[0]:
+            self.contracts.requalify(self.prequalified())
+
+    def error_handler(self, msg, channel=None):
         """Handles the capturing of error messages"""
-        regex = re.search(r'<.*errorCode=(.*),\serrorMsg=(.*)>', str(msg))
-        if regex:
-            err_code = regex.group(1)
-            err_msg = regex.group(2)
-            self.logger.info("IB MSG [code: %s, message: %s]" % (err_code, err_msg))
-            if err_code == 'None' and err_msg.startswith('unpack requires a string'):
-                self.log_all("IB account " + self.account_id + " was shutdown!", level="error")
-            if err_code == '504' and err_msg.startswith('Not connected'):
-                self.log_all("IB account not connected.  Will try connecting.", level="error")
-                self.connect()
-                self.reconnected = True  # turn on flag to resubmit order
+        err_code = msg.errorCode
+        # the reader's own errors carry the exception, with no code
+        err_msg = str(msg.errorMsg)
+        if err_code == PACING_ERROR:
+            # pacing violation, hold this connection's orders and contract
+            # requests back for a while, before any of them is sent again
+            self.log_all("IB pacing error on client id %s, orders are held back %.1f sec" %
+                         (channel.client_id, self.PACING_BACKOFF), level="error")
+            with self.scheduler.lock:
+                channel.bucket.drain(self.PACING_BACKOFF)
+        if self.contracts.error(msg.id, err_code, err_msg):
+            return
+        self.logger.info("IB MSG [id: %s, code: %s, message: %s]" % (msg.id, err_code, err_msg))
+        if channel is not None and channel.placing is not None and (err_code == NOT_CONNECTED or
+                (err_code == FAIL_SEND_ORDER and msg.id == channel.placing)):
+            channel.send_failed = True      # see send_order
+        if err_code is None and err_msg.startswith('unpack requires a string'):
+            self.log_all("IB account %s was shutdown!" % self.account_id, level="error")
+        elif err_code == NOT_CONNECTED and err_msg.startswith('Not connected'):
+            self.connection_lost(channel)
+
+        order = self.orders.error(channel.client_id, msg.id, err_code)
+        if order and err_code == PACING_ERROR and order.ts_signal is not None:
+            # TWS didn't take it, it goes out again before the orders queued after it
+            self.log_all("IB order %s paced out, placing it again: %s %s %s (%s client id %s)" % (
+                    order.order_id, order.action, order.quantity, order.symbol,
+                    self.account_id, channel.client_id), level="error")
+            self.scheduler.retry(order.ts_signal, order.quantity, self.orders.take_on_sent(order))
+        elif order:
+            self.log_all("IB order %s rejected: %s %s %s %s (%s client id %s)" % (
+                    order.order_id, order.action, order.quantity, order.symbol, err_msg,
+                    self.account_id, channel.client_id), level="error")
+
+    def order_status_handler(self, msg, channel=None):
+        """Logs every change of an order's status, TWS repeats unchanged ones."""
+        order = self.orders.status(channel.client_id, msg)
+        if order is None:
+            return
+
+        text = "IB order %s %s: filled %s, remaining %s @ %s (%s client id %s%s)" % (
+                msg.orderId, msg.status, msg.filled, msg.remaining, msg.avgFillPrice,
+                self.account_id, channel.client_id, self.order_timing(order))
+        if msg.status in UNFILLED_STATUSES:
+            self.log_all(text, level="error")
         else:
-            self.logger.error("IB Error: %s" % msg)
+            self.logger.info(text)
+
+    def open_order_handler(self, msg, channel=None):
+        contract = msg.contract
+        self.logger.info("IB open order %s: %s %s %s %s (%s client id %s)" % (
+                msg.orderId, msg.order.m_action, msg.order.m_totalQuantity,
+                contract.m_localSymbol or contract.m_symbol, msg.orderState.m_status,
+                self.account_id, channel.client_id))
+
+    def exec_details_handler(self, msg, channel=None):
+        execution = msg.execution
+        contract = msg.contract
+        order = self.orders.execution(channel.client_id, execution)
+        self.log_all("IB fill: %s %s %s %s @ %s, order %s (client id %s%s)" % (
+                execution.m_acctNumber, execution.m_side, execution.m_shares,
+                contract.m_localSymbol or contract.m_symbol, execution.m_price,
+                execution.m_orderId, channel.client_id, self.order_timing(order)))
+
+    @staticmethod
+    def order_timing(order):
+        """Ack and fill time of an order placed by us, and its slippage once filled."""
+        if order.placed is None:
+            return ''
+        text = ''
+        if order.acked is not None:
+            text += ', ack %.1f ms' % ((order.acked - order.placed) * 1000)
+        if order.filled_at is not None:
+            text += ', fill %.1f ms' % ((order.filled_at - order.placed) * 1000)
+            slippage = order.slippage()
+            if slippage is not None:
+                text += ', TradeStation @ %s, slippage %.1f bps' % (order.ts_price, slippage)
+        return text
+
+    def contract_details_handler(self, msg, channel=None):
+        self.contracts.details(msg.reqId, msg.contractDetails)
+
+    def contract_details_end_handler(self, msg, channel=None):
+        self.contracts.details_end(msg.reqId)
+
+    def prequalified(self):
+        """(symbol, sec_type) of ibsymbols.yml and the watchlist."""
+        keys = set(self.symbol_attrs)
+        for (sec_type, symbols) in self.watchlist.items():
+            keys.update(ContractCache.key(symbol, sec_type) for symbol in symbols or [])
+        return keys
+
+    def request_contract(self, req_id, contract):
+        """Ask for the details of a contract, paced along with the orders of the main connection."""
+        channel = self.channels[0]
+        if not self.scheduler.wait_token(channel):
+            return False
+        channel.con.reqContractDetails(req_id, contract)
+        return True
 
     def reply_handler(self, msg):
         """Handles of server replies"""
@@ -124,10 +322,9 @@ class IBWrapper:
 
         # check the symbol map to see if any attributes were defined for this symbol's order
         # e.g. "GLD" has primary exchange defined to disambiguate from "GLD" of foreign exchanges.
-        if sec_type in self.symbol_map:
-            if symbol in self.symbol_map[sec_type]:
-                if 'prim_exch' in self.symbol_map[sec_type][symbol]:
-                    prim_exch = str(self.symbol_map[sec_type][symbol]['prim_exch'])
+        attrs = self.symbol_attrs.get((symbol, sec_type))
+        if attrs and 'prim_exch' in attrs:
+            prim_exch = str(attrs['prim_exch']).upper()
 
         contract = Contract()
         if sec_type == 'FUT':
@@ -156,13 +353,17 @@ class IBWrapper:
         order.m_action = action
         return order
 
-    def placeOrder(self, order_id, contract, order):
-        return self.con.placeOrder(order_id, contract, order)
+    def placeOrder(self, order_id, contract, order, channel=None):
+        return (channel or self.channels[0]).con.placeOrder(order_id, contract, order)
 
     def disconnect(self):
         self.log_all("Disconnecting IB: %s @ %s" % (self.account_id, self.con_str))
-        self.con.disconnect()
-        self.stop_event.set()
+        self.supervisor.stop()
+        self.scheduler.stop()
+        self.contracts.stop()
+        for channel in self.channels:
+            channel.con.disconnect()
+        self.orders.release()
 
     def reqQuote(self, contract):
         self.con.reqMktData(1, contract, '', False)
@@ -170,44 +371,98 @@ class IBWrapper:
     def log_all(self, message, level='info'):
         self.logger.log_all(message, level=level)
 
-    def process_order(self, ts_signal):
-        # check if this cient has skip list and whether the signal
-        # is in this list
-        if len(self.skip_list) and ts_signal.symbol in self.skip_list:
-            return
+    def update(self, ib_host):
+        """Apply reloaded settings from clients.yml, without reconnecting."""
+        self.sizing = sig_config.client_sizing(ib_host)
+        if ib_host.get('fut_exch', 'CME') != self.fut_exch:
+            self.fut_exch = ib_host.get('fut_exch', 'CME')
+            self.contracts.forget('FUT')    # built for the old exchange
+        self.account_filter.configure(**self.account_filter_conf(ib_host))
+        account_values = ib_host.get('account_values')
+        if bool(account_values) != bool(self.account_values) and self.account_id \
+                and self.channels[0].is_ready():
+            self.channels[0].con.reqAccountUpdates(bool(account_values), self.account_id)
+        self.account_values = account_values
+        self.scheduler.set_pacing(ib_host.get('max_rate', DEFAULT_RATE),
+                                  ib_host.get('burst', DEFAULT_BURST))
+        self.scheduler.max_held = ib_host.get('max_held', 100)
+        self.scheduler.hold_time = ib_host.get('hold_time', 60)
+        self.orders.max_orders = ib_host.get('max_orders', 1000)
+        self.log_all("Updated %s: %s" % (self.name, str(self.sizing)))
+
+    def pacing_stats(self):
+        return "%s %s: %s, %s, %s, account values logged %d of %d" % (
+                self.name, self.account_id, self.scheduler.stats(), self.orders.stats(),
+                self.contracts.stats(), self.account_filter.kept, self.account_filter.received)
+
+    def process_order(self, ts_signal, quantity=None, on_sent=None):
+        """
+        Queue the order for the signal. A quantity is given when the signal was
+        already routed and sized by SigRouter, otherwise it's checked and sized here.
+        on_sent(ok) is called once TWS answered the order or it was dropped, or right
+        away if it's skipped.
+        """
+        if quantity is None:
+            sizing = self.sizing    # one consistent snapshot, even during a reload
 
-        # check if security types restriction is defined.  
-        # If it's not defined, no trading restriction on security.
-        # If it's defined, skipped any types that are not in the list.
-        if self.security_types and not self.security_types.get(ts_signal.sec_type.lower()):
-            return
+            # check if this cient has skip list and whether the signal
+            # is in this list
+            skip = ts_signal.symbol in sizing.skip_list or not sizing.sig_multiplier
+
+            # check if security types restriction is defined.  
+            # If it's not defined, no trading restriction on security.
+            # If it's defined, skipped any types that are not in the list.
+            if sizing.security_types and not sizing.security_types.get(ts_signal.sec_type.lower()):
+                skip = True
+
+            if skip:
+                if on_sent:
+                    on_sent(True)   # nothing to send
+                return
 
-        quantity = int(round(ts_signal.quantity * self.sig_multiplier))
-        self.placeOrder(self.nextOrderId,
-                        self.create_contract(ts_signal.symbol, ts_signal.sec_type),
-                        self.create_order(
-                            TS2IB_ORDER_TYPE_MAP[ts_signal.order_type],
-                            quantity,
-                            ts_signal.action)
-                        )
-
-        # placeOrder will caused an error if IB is not connected.  It will
-        # attempt to reconnect, but the order will need to be re-submited.
-        # so we'll check the reconnection flag here and resubmit.
-        if self.reconnected:
-            self.placeOrder(self.nextOrderId,
-                        self.create_contract(ts_signal.symbol, ts_signal.sec_type),
-                        self.create_order(
-                            TS2IB_ORDER_TYPE_MAP[ts_signal.order_type],
-                            quantity,
-                            ts_signal.action)
-                        )
-            self.reconnected = False
-
-        self.log_all(' '.join(["sent IB:", self.account_id, ts_signal.action,
+            quantity = int(round(ts_signal.quantity * sizing.sig_multiplier))
+        self.scheduler.submit(ts_signal, quantity, on_sent)
+
+    def send_order(self, channel, ts_signal, quantity, on_sent=None):
+        """
+        Place an order on the channel, called by the scheduler once it's paced.
+        Returns False if the order wasn't sent, not connected or the write
+        failed, the scheduler then holds it for the next connection. Once sent,
+        on_sent(True) is called as TWS answers, see IBOrderRegistry.placed.
+        """
+        order_id = channel.ids.allocate()
+        self.orders.placed(channel.client_id, order_id, ts_signal, quantity, on_sent)
+
+        # placeOrder won't raise if IB is not connected or the write fails, it
+        # reports NOT_CONNECTED or FAIL_SEND_ORDER to the error handler on this
+        # thread, which flags the call. A connection closed after the order
+        # went out flags nothing, so an order TWS may hold isn't placed twice.
+        channel.placing = order_id
+        channel.send_failed = False
+        try:
+            self.placeOrder(order_id,
+                            self.contracts.get(ts_signal.symbol, ts_signal.sec_type),
+                            self.create_order(
+                                TS2IB_ORDER_TYPE_MAP[ts_signal.order_type],
+                                quantity,
+                                ts_signal.action),
+                            channel
+                            )
+        except Exception:
+            self.orders.discard(channel.client_id, order_id)    # the scheduler reports it
+            raise
+        finally:
+            channel.placing = None
+        if channel.send_failed:
+            self.orders.discard(channel.client_id, order_id)
+            return False
+
+        if ts_signal.trace:
+            ts_signal.trace.mark(self.name)
+        self.log_all(' '.join(["sent IB:", str(self.account_id), ts_signal.action,
                                str(quantity), ts_signal.symbol,
                                '@', ts_signal.order_type]))
-        self.nextOrderId += 1
+        return True
 
 
 if __name__ == '__main__':
@@ -218,9 +473,9 @@ if __name__ == '__main__':
     ib = IBWrapper({'server': 'localhost', 'port': 7496, 'sig_multiplier': 1, 'client_id': 1})
     ib.connect()
 
-    # Create an order ID which is 'global' for this session. This
-    # will need incrementing once new orders are submitted.
-    order_id = ib.nextOrderId
+    # Take the next order ID of the main connection, every order
+    # needs a new one.
+    order_id = ib.channels[0].ids.allocate()
 
     print ">>> order id is", order_id
 
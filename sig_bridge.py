@@ -13,6 +13,14 @@ from ScrolledText import ScrolledText
 from sig_server import SigServer
 
 
+# log view refresh: lines inserted per refresh, delays (ms) and scrollback
+LOG_BATCH_SIZE = 500
+LOG_BUSY_DELAY = 10     # queue still had lines after the last batch
+LOG_ACTIVE_DELAY = 50   # lines arrived since the last refresh
+LOG_IDLE_DELAY = 250    # nothing arrived
+LOG_MAX_LINES = 5000    # oldest lines are trimmed beyond this
+
+
 class QueueLogger(logging.Handler):
     def __init__(self, queue):
         logging.Handler.__init__(self)
@@ -43,6 +51,7 @@ class SigBridgeUI(Tk):
         # Main frame can enlarge
         self.main_frame.columnconfigure(0, weight=1)
         self.main_frame.columnconfigure(1, weight=1)
+        self.main_frame.columnconfigure(2, weight=1)
         self.main_frame.grid(row=0, column=0)
 
         # Run/Stop button
@@ -53,11 +62,16 @@ class SigBridgeUI(Tk):
         self.clear_button = Button(self.main_frame, text="Clear Log", command=self.clear_log)
         self.clear_button.grid(row=0, column=1)
 
+        # Latency button, dumps the signal latency histograms to the log
+        self.latency_button = Button(self.main_frame, text="Latency", command=self.dump_latency)
+        self.latency_button.grid(row=0, column=2)
+
         # Logs Widget
         self.log_widget = ScrolledText(self.main_frame)
-        self.log_widget.grid(row=1, column=0, columnspan=2)
+        self.log_widget.grid(row=1, column=0, columnspan=3)
         # made not editable
         self.log_widget.config(state="disabled")
+        self.log_widget.tag_config('error', foreground="red")
 
         # Queue where the logging handler will write
         self.log_queue = Queue.Queue()
@@ -86,22 +100,52 @@ class SigBridgeUI(Tk):
         self.log_widget.delete(0.0, END)
         self.log_widget.config(state='disabled')
 
+    def dump_latency(self):
+        if self.server:
+            self.server.dump_latency()
+
     def start_log(self):
         self.update_widget()
         # self.control_log_button.configure(text="Pause Log", command=self.stop_log)
 
     def update_widget(self):
-        self.log_widget.config(state='normal')
-        # Read from the Queue and add to the log widger
-        while not self.log_queue.empty():
-            line = self.log_queue.get()
-            tag = "error" if " ERROR " in line else 'info'
-            self.log_widget.insert(END, line, tag)
+        # Read a batch of lines from the Queue, grouping consecutive lines
+        # with the same tag so that the batch is added with a single insert.
+        chunks = []
+        lines = []
+        tag = None
+        while len(lines) < LOG_BATCH_SIZE:
+            try:
+                line = self.log_queue.get_nowait()
+            except Queue.Empty:
+                break
+            line_tag = "error" if " ERROR " in line else 'info'
+            if line_tag != tag and lines:
+                chunks.extend([''.join(lines), tag])
+                lines = []
+            tag = line_tag
+            lines.append(line)
+        if lines:
+            chunks.extend([''.join(lines), tag])
+
+        if chunks:
+            self.log_widget.config(state='normal')
+            self.log_widget.insert(END, *chunks)
+            # keep a bounded scrollback by trimming the oldest lines
+            line_cnt = int(self.log_widget.index('end-1c').split('.')[0])
+            if line_cnt > LOG_MAX_LINES:
+                self.log_widget.delete('1.0', '%d.0' % (line_cnt - LOG_MAX_LINES + 1))
+            self.log_widget.config(state='disabled')
             self.log_widget.see(END)  # Scroll to the bottom
-            self.log_widget.update_idletasks()
-        self.log_widget.tag_config('error', foreground="red")
-        self.log_widget.config(state='disabled')
-        self.log_widget.after(10, self.update_widget)
+
+        # refresh quickly while lines keep coming, slowly when idle
+        if not chunks:
+            delay = LOG_IDLE_DELAY
+        elif self.log_queue.empty():
+            delay = LOG_ACTIVE_DELAY
+        else:
+            delay = LOG_BUSY_DELAY
+        self.log_widget.after(delay, self.update_widget)
 
     def set_geometry(self):
         # set position in window
@@ -0,0 +1,134 @@
+################################################################################
+# Process wide configuration layer. Every file is parsed once and the result
+# is shared, read only, by all adapters. The FIX dictionary and the IB symbol
+# map are also kept in a pickled cache that is rebuilt when the source changes.
+################################################################################
+import os
+import json
+import yaml
+import cPickle as pickle
+from threading import Lock
+from collections import namedtuple
+
+import sig_files
+
+# the libyaml based loader is several times faster than the pure python one
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+CACHE_DIR = 'cache'
+FIX_DICT_PATH = './fixapp/dict_4.2.json'
+SYMBOL_MAP_PATH = 'conf/ibsymbols.yml'
+
+_cache = {}     # (kind, path) -> (mtime, size, value)
+_lock = Lock()
+
+
+# per client sizing fields from clients.yml. Adapters hold them as one
+# immutable tuple, so a reload swaps all of them in a single assignment.
+ClientSizing = namedtuple('ClientSizing', 'sig_multiplier skip_list security_types')
+
+
+def client_sizing(client):
+    sig_multiplier = client.get('sig_multiplier')
+    return ClientSizing(
+                0.01 if sig_multiplier is None else sig_multiplier,     # 0 takes no trades
+                frozenset(client.get('skip_list') or ()),
+                client.get('security_types')
+              )
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+
+def _cached(kind, path, build):
+    """
+    Value built from the file at path, built once per process and again
+    only when the file's mtime or size changes.
+    """
+    stamp = _stamp(path)
+    with _lock:
+        entry = _cache.get((kind, path))
+        if entry and entry[:2] == stamp:
+            return entry[2]
+        value = build(path, stamp)
+        _cache[(kind, path)] = stamp + (value,)
+        return value
+
+
+def _load_yaml(path, stamp=None):
+    with open(path, 'r') as cf:
+        return yaml.load(cf, Loader=YAML_LOADER)
+
+
+def _load_binary(path, stamp, build):
+    """
+    Load the pickled result of build(path), if it was made from the same
+    version of the source file. Otherwise build it and rewrite the cache.
+    """
+    cache_path = os.path.join(CACHE_DIR, os.path.basename(path) + '.pickle')
+    try:
+        with open(cache_path, 'rb') as cf:
+            (cached_stamp, value) = pickle.load(cf)
+        if cached_stamp == stamp:
+            return value
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    value = build(path)
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as cf:
+            pickle.dump((stamp, value), cf, pickle.HIGHEST_PROTOCOL)
+        sig_files.replace(tmp_path, cache_path)
+    except (IOError, OSError):
+        pass    # a read only install still works, just without the cache
+    return value
+
+
+def _build_fix_dict(path):
+    """tag -> ("tag-Name: " prefix, value description map or None)"""
+    fix_dict = {}
+    with open(path, 'r') as df:
+        data = json.loads(df.read())
+    for f in data['Fields']:
+        tag = str(f['Tag'])
+        val = f.get('Val')
+        if val:
+            val = dict((str(k), str(v)) for (k, v) in val.items())
+        fix_dict[tag] = (tag + "-" + str(f['Name']) + ': ', val)
+    return fix_dict
+
+
+def load_yaml(path):
+    """Parsed yaml file, shared by all callers. Do not modify the result."""
+    return _cached('yaml', path, _load_yaml)
+
+
+def app_conf():
+    return load_yaml('conf/app.yml') or {}
+
+
+def clients_conf():
+    return load_yaml('conf/clients.yml') or []
+
+
+def symbol_map():
+    """IB symbol mapping from ibsymbols.yml, shared by every IBWrapper."""
+    return _cached('binary', SYMBOL_MAP_PATH,
+                   lambda path, stamp: _load_binary(path, stamp, _load_yaml)) or {}
+
+
+def fix_dict():
+    """FIX 4.2 tag dictionary, shared by every FixTranslator."""
+    return _cached('binary', FIX_DICT_PATH,
+                   lambda path, stamp: _load_binary(path, stamp, _build_fix_dict))
+
+
+if __name__ == '__main__':
+    print("yaml loader: %s" % YAML_LOADER.__name__)
+    print("fix tags: %d" % len(fix_dict()))
+    print("symbol map: %s" % symbol_map())
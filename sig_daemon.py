@@ -0,0 +1,58 @@
+################################################################################
+# This is the headless entry point that runs the signal server without the UI.
+# Messages that the UI would show are written to the console instead.
+################################################################################
+import time
+START_TIME = time.time()  # taken before other imports to measure startup time
+
+import signal
+import logging
+import argparse
+from threading import Thread, Event
+
+from sig_server import SigServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run SigBridge without UI.')
+    parser.add_argument('--host', default='0.0.0.0', help='smtp listening address')
+    parser.add_argument('--port', type=int, default=25, help='smtp listening port')
+    args = parser.parse_args()
+
+    # console logger in place of the UI logger
+    uilogger = logging.getLogger("SigBridgeConsole")
+    uilogger.setLevel(logging.INFO)
+    uilogger.propagate = False
+    hl = logging.StreamHandler()
+    hl.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    uilogger.addHandler(hl)
+
+    stop_event = Event()
+
+    def stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    server = SigServer((args.host, args.port), None, uilogger)
+    server_thread = Thread(name='server', target=server.run)
+    server_thread.daemon = True
+    server_thread.start()
+    uilogger.info("Accepting signals on %s:%d, %.3f sec after start" %
+                  (args.host, args.port, server.listen_time - START_TIME))
+
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 <pid> dumps the signal latency histograms
+        signal.signal(signal.SIGUSR1, lambda signum, frame: server.dump_latency())
+
+    # wait with a timeout, so that signal handlers get to run
+    while not stop_event.is_set():
+        stop_event.wait(1)
+
+    uilogger.info("Shutting down.")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
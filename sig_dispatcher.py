@@ -0,0 +1,155 @@
+################################################################################
+# Fans a trade signal out to every broker client concurrently.
+# Each client gets its own worker lane so that a slow, reconnecting or failing
+# client never holds up (or aborts) the submission to the other accounts, while
+# signals for the same client are still submitted in the order they arrived.
+# With a SignalJournal, the outcome of every client submission and the
+# completion of each journaled signal are recorded in it. A signal that failed
+# on any client isn't completed, so the next start replays it to those clients.
+################################################################################
+from Queue import Queue
+from functools import partial
+from threading import Thread, Lock
+from time import time
+
+from sig_logger import SigLogger
+
+
+class DispatchBatch(object):
+    """Tracks the per-client submissions of a single signal."""
+
+    def __init__(self, ts_signal, client_cnt, on_complete=None, journal_id=None):
+        self.ts_signal = ts_signal
+        self.journal_id = journal_id    # id of the signal in the SignalJournal, if journaled
+        self.remaining = client_cnt
+        self.created = time()
+        self.first_sent = None
+        self.last_sent = None
+        self.errors = 0
+        self.on_complete = on_complete
+        self.lock = Lock()
+
+    @property
+    def spread(self):
+        """Time between the first and the last client submission."""
+        if self.first_sent is None:
+            return 0.0
+        return self.last_sent - self.first_sent
+
+    def done(self, ok):
+        with self.lock:
+            now = time()
+            if ok:
+                if self.first_sent is None:
+                    self.first_sent = now
+                self.last_sent = now
+            else:
+                self.errors += 1
+            self.remaining -= 1
+            finished = self.remaining == 0
+        if finished and self.on_complete:
+            self.on_complete(self)
+
+
+class SigDispatcher:
+
+    def __init__(self, uilogger=None, tracker=None, journal=None):
+        self.logger = SigLogger("SigDispatcher", uilogger=uilogger)
+        self.tracker = tracker      # LatencyTracker recording the spread, if any
+        self.journal = journal      # SignalJournal recording the outcomes, if any
+        self.lanes = dict()         # client -> order queue of its worker lane
+        self.lanes_lock = Lock()
+        self.last_spread = 0.0      # spread of the most recent signal
+        self.max_spread = 0.0       # worst spread seen since start
+
+    def dispatch(self, ts_signal, clients, quantities=None, journal_id=None):
+        """
+        Queue the signal on the lane of every client and return immediately.
+        :param ts_signal: parsed TradeStationSignal
+        :param clients: clients exposing process_order(ts_signal, quantity) and name
+        :param quantities: order quantity per client, sized by the client if None
+        :param journal_id: id of the signal in the journal, to record its outcomes
+        :return: the DispatchBatch tracking this signal
+        """
+        batch = DispatchBatch(ts_signal, len(clients), self._batch_complete, journal_id)
+        if quantities is None:
+            quantities = [None] * len(clients)
+        for (client, quantity) in zip(clients, quantities):
+            self._lane(client).put((batch, quantity))
+        return batch
+
+    def remove(self, client):
+        """Stop the worker lane of a client that is no longer active."""
+        with self.lanes_lock:
+            lane = self.lanes.pop(client, None)
+        if lane:
+            lane.put(None)
+
+    def stop(self):
+        with self.lanes_lock:
+            lanes = self.lanes.values()
+            self.lanes.clear()
+        for lane in lanes:
+            lane.put(None)
+
+    def _lane(self, client):
+        with self.lanes_lock:
+            lane = self.lanes.get(client)
+            if lane is None:
+                lane = Queue()
+                worker = Thread(target=self._worker, args=(client, lane),
+                                name="dispatch-" + str(client.name))
+                worker.daemon = True
+                worker.start()
+                self.lanes[client] = lane
+        return lane
+
+    def _worker(self, client, lane):
+        # clients queueing orders of their own report when an order is actually sent
+        reports_sent = getattr(client, 'reports_sent', False)
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+
+            (batch, quantity) = item
+            ok = False
+            try:
+                if reports_sent:
+                    client.process_order(batch.ts_signal, quantity,
+                                         on_sent=partial(self._client_done, batch, client))
+                else:
+                    client.process_order(batch.ts_signal, quantity)
+                ok = True
+            except Exception as e:
+                self.logger.log_all('<%s> %s' % (client.name, str(e)), level="error")
+            if not (ok and reports_sent):
+                self._client_done(batch, client, ok)
+
+    def _client_done(self, batch, client, ok):
+        if self.journal and batch.journal_id is not None:
+            try:
+                self.journal.record_outcome(batch.journal_id, client.name, ok)
+            except (IOError, OSError) as e:
+                self.logger.error("journal: outcome of %s not recorded: %s" % (client.name, str(e)))
+        batch.done(ok)
+
+    def _batch_complete(self, batch):
+        if self.journal and batch.journal_id is not None:
+            if batch.errors:
+                # left unfinished, the next start replays it to the clients that failed
+                self.logger.error("journal: order# %s not sent to %d client(s), kept for replay" %
+                                  (batch.ts_signal.order_id, batch.errors))
+            else:
+                try:
+                    self.journal.record_done(batch.journal_id)
+                except (IOError, OSError) as e:
+                    self.logger.error("journal: completion not recorded: " + str(e))
+        spread = batch.spread
+        self.last_spread = spread
+        self.max_spread = max(self.max_spread, spread)
+        if self.tracker and batch.first_sent is not None:
+            self.tracker.record('fan-out spread (first -> last client)', spread)
+        self.logger.info("fan-out of %s %s: spread %.1f ms, total %.1f ms, %d error(s)" %
+                         (batch.ts_signal.symbol, batch.ts_signal.order_id,
+                          spread * 1000, (time() - batch.created) * 1000, batch.errors))
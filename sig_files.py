@@ -0,0 +1,43 @@
+################################################################################
+# Replacing a file with a new version written next to it, in one step. On
+# POSIX os.rename does it atomically. On Windows os.rename won't overwrite an
+# existing file, and removing the old one first leaves no file at all if the
+# process dies in between, so MoveFileEx replaces it there instead.
+################################################################################
+import os
+import sys
+
+if os.name == 'nt':
+    import ctypes
+
+    MOVEFILE_REPLACE_EXISTING = 0x1
+    MOVEFILE_WRITE_THROUGH = 0x8    # returns once the move is on disk
+
+    def _wide(path):
+        if isinstance(path, unicode):
+            return path
+        return path.decode(sys.getfilesystemencoding() or 'mbcs')
+
+    def replace(src, dst):
+        """Move src over dst, raises WindowsError (an OSError) on failure."""
+        if not ctypes.windll.kernel32.MoveFileExW(_wide(src), _wide(dst),
+                                                  MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+else:
+    def replace(src, dst):
+        """Move src over dst, raises OSError on failure."""
+        os.rename(src, dst)
+
+
+def keep_copy(path, copy_path):
+    """
+    Make copy_path the current content of path, which stays in place. A hard
+    link where there are, a copy otherwise.
+    """
+    if os.path.isfile(copy_path):
+        os.remove(copy_path)
+    if hasattr(os, 'link'):
+        os.link(path, copy_path)
+    else:
+        import shutil
+        shutil.copyfile(path, copy_path)
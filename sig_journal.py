@@ -0,0 +1,246 @@
+################################################################################
+# Write-ahead journal of accepted signals, so that a crash between receiving a
+# signal and sending its orders doesn't lose it. Every accepted signal is
+# appended with its raw email before it is dispatched, then the outcome of
+# each client submission and finally the completion of the signal. Partial
+# fills held for netting are appended as they arrive, and merged into one
+# entry of their total quantity as they are dispatched. Signals that never
+# completed are replayed on the next start.
+# Signal records wait until the journal is on disk, but one fsync covers
+# everything written by the threads that were waiting on it (group commit), so
+# concurrent signals share the flush instead of paying one each. Outcome and
+# completion records aren't waited for: a flusher thread puts them on disk
+# with the next group commit, so no order submission waits for a disk flush.
+# Once the file grows beyond max_size it is rotated, and only unfinished
+# signals are carried over.
+################################################################################
+import os
+import json
+from collections import OrderedDict
+from threading import Condition, Thread
+from time import time
+
+import sig_files
+
+
+class JournalEntry(object):
+    """An unfinished signal: its email and the clients it was sent to."""
+
+    __slots__ = ('id', 'time', 'data', 'quantity', 'sent')
+
+    def __init__(self, entry_id, entry_time, data, quantity=None):
+        self.id = entry_id
+        self.time = entry_time
+        self.data = data
+        self.quantity = quantity    # in place of the email's, for netted partial fills
+        self.sent = set()   # names of clients the orders were sent to
+
+
+class SignalJournal:
+
+    def __init__(self, path, max_size=1024 * 1024, logger=None):
+        self.path = path
+        self.max_size = max_size    # bytes before the journal is rotated
+        self.logger = logger
+        self.entries = OrderedDict()    # id -> unfinished JournalEntry, oldest first
+        self.last_id = 0
+        self.cond = Condition()
+        self.fh = None
+        self.size = 0               # bytes in the current file
+        self.written = 0            # records written since start
+        self.synced = 0             # records written since start known to be on disk
+        self.syncing = False        # an fsync is in progress
+        self.syncs = 0              # fsyncs since start
+
+        self._load()
+
+        self.flusher = Thread(target=self._flush, name="journal-flusher")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def record_signal(self, data, quantity=None):
+        """Journal an accepted signal's email, returns its journal id once on disk."""
+        with self.cond:
+            self.last_id += 1
+            entry = JournalEntry(self.last_id, time(), data, quantity)
+            self.entries[entry.id] = entry
+            self._append(self._signal_record(entry), sync=True)
+        return entry.id
+
+    def record_outcome(self, entry_id, client_name, ok):
+        """
+        Journal the submission of a signal to a client. Not waited for, it's
+        called on the thread that sends the orders. If a crash loses it before
+        the flusher's fsync, a replay sends the signal to that client again.
+        """
+        with self.cond:
+            entry = self.entries.get(entry_id)
+            if entry is None:
+                return
+            if ok:
+                entry.sent.add(client_name)
+            self._append({'op': 'sent', 'id': entry_id, 'client': client_name, 'ok': ok}, sync=False)
+
+    def record_netted(self, entry_id, quantity, merged_ids):
+        """
+        Journal that the fills merged_ids were netted into the fill entry_id,
+        which now stands for their total quantity. Returns once on disk.
+        """
+        with self.cond:
+            entry = self.entries.get(entry_id)
+            if entry is None:
+                return
+            entry.quantity = quantity
+            for merged_id in merged_ids:
+                self.entries.pop(merged_id, None)
+            self._append({'op': 'netted', 'id': entry_id, 'quantity': quantity,
+                          'merged': list(merged_ids)}, sync=True)
+
+    def record_done(self, entry_id):
+        """
+        Journal that every client of a signal was handled. Not waited for:
+        if it's lost, a replay finds every client already sent to.
+        """
+        with self.cond:
+            if self.entries.pop(entry_id, None) is None:
+                return
+            self._append({'op': 'done', 'id': entry_id}, sync=False)
+
+    def unfinished(self):
+        """Signals that didn't complete, oldest first."""
+        with self.cond:
+            return list(self.entries.values())
+
+    def stats(self):
+        return "journal: %d records in %d fsyncs, %d unfinished signals" % (
+                self.written, self.syncs, len(self.entries))
+
+    def close(self):
+        with self.cond:
+            if self.fh:
+                self._sync(self.written)
+                self.fh.close()
+                self.fh = None
+                self.cond.notify_all()  # the flusher ends
+
+    @staticmethod
+    def _signal_record(entry):
+        # latin-1 maps every byte of the email to a character and back
+        record = {'op': 'signal', 'id': entry.id, 'time': entry.time,
+                  'data': entry.data.decode('latin-1')}
+        if entry.quantity:
+            record['quantity'] = entry.quantity
+        return record
+
+    def _append(self, record, sync):
+        if self.fh is None:
+            return  # closed
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.fh.write(line)
+        self.size += len(line)
+        self.written += 1
+        if sync:
+            self._sync(self.written)
+        else:
+            self.cond.notify_all()  # for the flusher
+        if self.size > self.max_size:
+            self._rotate()
+
+    def _sync(self, target):
+        """Wait until the first target records are on disk, called with cond held."""
+        while self.synced < target:
+            if self.syncing:
+                # another thread's fsync is running, the next one covers our record
+                self.cond.wait()
+                continue
+            self.syncing = True
+            upto = self.written
+            self.fh.flush()
+            fd = self.fh.fileno()
+            self.cond.release()
+            try:
+                os.fsync(fd)    # other threads keep appending meanwhile
+            finally:
+                self.cond.acquire()
+                self.syncing = False
+                self.cond.notify_all()
+            self.synced = max(self.synced, upto)
+            self.syncs += 1
+
+    def _flush(self):
+        """Put the records nobody waits for on disk, as soon as they're written."""
+        with self.cond:
+            while self.fh is not None:
+                if self.synced < self.written and not self.syncing:
+                    try:
+                        self._sync(self.written)
+                    except (IOError, OSError) as e:
+                        if self.logger:
+                            self.logger.error("journal not synced: " + str(e))
+                        self.cond.wait(1)
+                else:
+                    self.cond.wait()
+
+    def _load(self):
+        """Read the unfinished signals back from the file, then rotate it."""
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as jf:
+                for line in jf:
+                    try:
+                        record = json.loads(line)
+                        op = record['op']
+                        entry_id = record['id']
+                    except (ValueError, KeyError):
+                        continue    # partially written line
+                    self.last_id = max(self.last_id, entry_id)
+                    if op == 'signal':
+                        self.entries[entry_id] = JournalEntry(entry_id, record['time'],
+                                                              record['data'].encode('latin-1'),
+                                                              record.get('quantity'))
+                    elif op == 'sent' and record.get('ok') and entry_id in self.entries:
+                        self.entries[entry_id].sent.add(record['client'])
+                    elif op == 'netted' and entry_id in self.entries:
+                        self.entries[entry_id].quantity = record.get('quantity')
+                        for merged_id in record.get('merged', []):
+                            self.entries.pop(merged_id, None)
+                    elif op == 'done':
+                        self.entries.pop(entry_id, None)
+        elif os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        with self.cond:
+            self._rotate()
+        if self.logger:
+            self.logger.info("loaded %d unfinished signals from %s" % (len(self.entries), self.path))
+
+    def _rotate(self):
+        """
+        Start a new file holding only the unfinished signals, keeping the
+        previous one as path.1. Called with cond held.
+        """
+        while self.syncing:
+            self.cond.wait()
+
+        tmp_path = self.path + '.tmp'
+        size = 0
+        with open(tmp_path, 'w') as jf:
+            for entry in self.entries.values():
+                lines = [self._signal_record(entry)]
+                lines.extend({'op': 'sent', 'id': entry.id, 'client': name, 'ok': True}
+                             for name in sorted(entry.sent))
+                for record in lines:
+                    line = json.dumps(record, separators=(',', ':')) + '\n'
+                    jf.write(line)
+                    size += len(line)
+            jf.flush()
+            os.fsync(jf.fileno())
+
+        if self.fh:
+            self.fh.close()
+        if os.path.isfile(self.path):
+            sig_files.keep_copy(self.path, self.path + '.1')
+        # the journal is in place until the new one replaces it in one step
+        sig_files.replace(tmp_path, self.path)
+        self.fh = open(self.path, 'a')
+        self.size = size
+        self.synced = self.written  # what's still needed is in the new file
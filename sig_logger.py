@@ -1,27 +1,135 @@
 import os
+import atexit
 import logging
+from Queue import Queue, Full
+from threading import Thread, Lock
 from logging.handlers import TimedRotatingFileHandler
 
 
+class LogBackend:
+    """
+    Single writer thread shared by every SigLogger. Records are queued by the
+    calling thread and written (and rotated) by the writer, so file I/O never
+    runs on the signal path. Bulk records, like account updates, are sampled
+    once the queue backs up and dropped when it is full.
+    """
+
+    def __init__(self, max_queue=10000, bulk_watermark=1000, bulk_sample=100):
+        self.queue = Queue(maxsize=max_queue)
+        self.bulk_watermark = bulk_watermark    # queue depth from which bulk records are sampled
+        self.bulk_sample = bulk_sample          # keep one of every n bulk records under load
+        self.file_handlers = {}     # logger name -> file handler, attached once per name
+        self.bulk_counts = {}       # bulk category -> records seen
+        self.dropped = 0            # records dropped since the last report
+        self.lock = Lock()
+
+        self.writer = Thread(target=self.write, name="log-writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def attach(self, name):
+        """Get the logger for the name, with its handlers attached exactly once."""
+        logger = logging.getLogger(name)
+        with self.lock:
+            if name in self.file_handlers:
+                return logger
+
+            # create file, formatter and add it to the handlers
+            fh = TimedRotatingFileHandler('logs/' + name + '.log', when='d',
+                                          interval=1, backupCount=10)
+            fh.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(asctime)s - %(process)d - %(name)s '
+                                          '(%(lineno)d) %(levelname)s: %(message)s',
+                                          "%Y-%m-%d %H:%M:%S")
+            fh.setFormatter(formatter)
+            self.file_handlers[name] = fh
+
+            logger.setLevel(logging.INFO)
+            logger.addHandler(QueueHandler(self))
+            # ibpy's basicConfig puts a console handler on the root logger,
+            # which would format and print every record on the calling thread
+            logger.propagate = False
+        return logger
+
+    def put(self, record):
+        category = getattr(record, 'bulk', None)
+        if category and self.queue.qsize() >= self.bulk_watermark:
+            cnt = self.bulk_counts.get(category, 0) + 1
+            self.bulk_counts[category] = cnt
+            if cnt % self.bulk_sample:
+                self.dropped += 1
+                return
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            fh = self.file_handlers.get(record.name)
+            if fh is None:
+                continue
+            fh.handle(record)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                fh.handle(logging.makeLogRecord({
+                            'name': record.name, 'levelno': logging.WARNING,
+                            'levelname': 'WARNING', 'lineno': 0,
+                            'msg': "log backend dropped %d records under load" % dropped}))
+
+    def flush(self):
+        """Write out queued records, called at exit."""
+        self.queue.put(None)
+        self.writer.join(5)
+        for fh in self.file_handlers.values():
+            fh.flush()
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to the backend's queue."""
+
+    def __init__(self, backend):
+        logging.Handler.__init__(self)
+        self.backend = backend
+
+    def emit(self, record):
+        self.backend.put(record)
+
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = LogBackend()
+            atexit.register(_backend.flush)
+    return _backend
+
+
+def configure(max_queue=None, bulk_watermark=None, bulk_sample=None):
+    """Tune the shared backend from the 'logging' section of app.yml."""
+    backend = get_backend()
+    if max_queue:
+        backend.queue.maxsize = max_queue
+    if bulk_watermark:
+        backend.bulk_watermark = bulk_watermark
+    if bulk_sample:
+        backend.bulk_sample = bulk_sample
+
+
 class SigLogger():
 
     def __init__(self, name, uilogger=None):
         if not os.path.isdir('logs'):
             os.makedirs('logs')
 
-        self.logger = logging.getLogger(name)
-        self.logger.setLevel(logging.INFO)
-
-        # create file, formatter and add it to the handlers
-        fh = TimedRotatingFileHandler('logs/' + name + '.log', when='d',
-                                      interval=1, backupCount=10)
-        fh.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(process)d - %(name)s '
-                                      '(%(lineno)d) %(levelname)s: %(message)s',
-                                      "%Y-%m-%d %H:%M:%S")
-        fh.setFormatter(formatter)
-        self.logger.addHandler(fh)
-
+        self.logger = get_backend().attach(name)
         self.uilogger = uilogger
 
     def log_all(self, message, level='info'):
@@ -36,10 +144,18 @@ class SigLogger():
             if self.uilogger:
                 self.uilogger.error(message)
 
+    def is_enabled(self, level=logging.INFO):
+        return self.logger.isEnabledFor(level)
+
     def info(self, msg):
         if msg:
             self.logger.info(msg)
 
+    def bulk(self, msg, category):
+        """Log a high volume message that may be sampled or dropped under load."""
+        if msg:
+            self.logger.info(msg, extra={'bulk': category})
+
     def error(self, msg):
         if msg:
             self.logger.error(msg)
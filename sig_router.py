@@ -0,0 +1,76 @@
+################################################################################
+# Routing table compiled from the sizing of the running clients. It maps a
+# signal's (symbol, sec_type) to the clients that take the trade and sizes the
+# order for all of them at once, instead of every client filtering and sizing
+# the signal on its own. The table is rebuilt, never modified, when clients
+# change, so a signal always sees one consistent version of it.
+# numpy is imported when the first table with clients is built, not with the
+# module, so that starting without clients doesn't pay for it.
+################################################################################
+from math import floor
+
+numpy = None            # set by _numpy, None until then or if it's not installed
+_numpy_tried = False
+
+
+def _numpy():
+    """numpy, imported on the first call. None if it's not installed."""
+    global numpy, _numpy_tried
+    if not _numpy_tried:
+        try:
+            import numpy as np
+            numpy = np
+        except ImportError:
+            pass    # quantities are then computed one client at a time
+        _numpy_tried = True
+    return numpy
+
+
+def _takes(sizing, symbol, sec_type):
+    """Same rules the clients apply on their own, see process_order."""
+    if not sizing.sig_multiplier or symbol in sizing.skip_list:
+        return False
+    if sizing.security_types and not sizing.security_types.get(sec_type):
+        return False
+    return True
+
+
+class SigRouter(object):
+
+    def __init__(self, clients=()):
+        clients = tuple(clients)
+        sizings = [c.sizing for c in clients]
+        np = _numpy() if clients else None
+
+        # only symbols in a skip list and types in a security_types map can
+        # change the outcome, any other symbol or type routes as None
+        self.symbols = frozenset(s for sz in sizings for s in sz.skip_list)
+        self.sec_types = frozenset(t for sz in sizings for t in (sz.security_types or ()))
+
+        self.routes = {}    # (symbol, sec_type) -> (clients, multipliers)
+        for symbol in list(self.symbols) + [None]:
+            for sec_type in list(self.sec_types) + [None]:
+                idx = [i for (i, sz) in enumerate(sizings) if _takes(sz, symbol, sec_type)]
+                multipliers = [sizings[i].sig_multiplier for i in idx]
+                if np is not None:
+                    multipliers = np.array(multipliers, dtype=float)
+                self.routes[(symbol, sec_type)] = (tuple(clients[i] for i in idx), multipliers)
+
+    def route(self, ts_signal):
+        """
+        :param ts_signal: parsed TradeStationSignal
+        :return: (clients that take the signal, order quantity of each client)
+        """
+        symbol = ts_signal.symbol if ts_signal.symbol in self.symbols else None
+        sec_type = ts_signal.sec_type.lower()
+        if sec_type not in self.sec_types:
+            sec_type = None
+        (clients, multipliers) = self.routes[(symbol, sec_type)]
+        return (clients, self.quantities(ts_signal.quantity, multipliers))
+
+    @staticmethod
+    def quantities(quantity, multipliers):
+        """quantity * multiplier rounded half up, as round() does for positive sizes."""
+        if not isinstance(multipliers, list):     # numpy array
+            return numpy.floor(multipliers * quantity + 0.5).astype(int).tolist()
+        return [int(floor(quantity * m + 0.5)) for m in multipliers]
@@ -1,23 +1,41 @@
 import os
-import yaml
 import asyncore
-from threading import Thread
+from threading import Thread, Event, Lock, Timer
 
 from smtpd import SMTPServer
-from time import sleep, time
+from time import time
 
-from ib_wrapper import IBWrapper
-from slack_web_hook import SlackWebHook
-from email_sender import EmailSender
-from trade_station_signal import TradeStationSignal
-from fix_processor import FixProcessor
+# broker adapters and notifiers are imported only once a client or notifier
+# of that type is configured, so unused dependencies are never loaded.
+from trade_station_signal import parse_signal
+import sig_logger
+import sig_config
 from sig_logger import SigLogger
+from sig_dispatcher import SigDispatcher
+from sig_router import SigRouter
+from smtp_ingress import SMTPIngress
+from signal_dedup import SignalDedup
+from sig_journal import SignalJournal
+from fill_netter import FillNetter
+from sig_tracer import LatencyTracker
 
+LATENCY_SNAPSHOT_PATH = 'logs/latency.json'   # written on dump_latency
 
-class SigServer(SMTPServer):
 
-    def __init__(self, laddr, raddr, uilogger):
+class AsyncoreIngress(SMTPServer):
+    """The smtpd listener of the asyncore engine, handing messages to process_message."""
+
+    def __init__(self, laddr, raddr, process_message):
         SMTPServer.__init__(self, laddr, raddr)
+        self.handler = process_message
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        return self.handler(peer, mailfrom, rcpttos, data)
+
+
+class SigServer:
+
+    def __init__(self, laddr, raddr, uilogger):
         self.uilogger = uilogger
         self.logger = SigLogger("SigServer", uilogger=uilogger)
 
@@ -28,18 +46,48 @@ class SigServer(SMTPServer):
         self.slack = None           # slack client
         self.sig_shutdown = False   # signal to shut down
         self.ts_signal_conf = None  # configuration for TS signal parsing
+        self.tracker = LatencyTracker()   # per stage latency histograms
+        self.dispatcher = SigDispatcher(uilogger=uilogger, tracker=self.tracker)  # concurrent fan-out
+        self.ingress_conf = None    # configuration for the smtp ingress engine
+        self.ingress = None         # threaded smtp ingress, None for asyncore
+        self.smtp = None            # asyncore smtpd listener, None for threaded
+        self.dedup = None           # index of recently routed signals
+        self.journal = None         # write-ahead journal of accepted signals
+        self.journal_conf = None    # configuration for the journal replay
+        self.replay_pending = False # unfinished signals of the journal wait for replay
+        self.replay_entries = []    # unfinished signals the journal was loaded with
+        self.live_orders = set()    # (account, order#) dispatched while replay_pending
+        self.netter = None          # merges partial fills of an order
+        self.listen_time = None     # time the smtp socket started listening
+        self.clients_lock = Lock()  # guards changes to the running set of clients
+        self.client_confs = {}      # client key -> active clients.yml entry
+        self.adapters = {}          # client key -> running IB or FIX client
+        self.router = SigRouter()   # routing table of the running IB and FIX clients
+        self.loaded_clients = None  # clients.yml content last applied
+        self.reload_interval = None # seconds between checks of clients.yml
+        self.watch_stop = Event()   # stops the clients.yml watcher
 
         self._init_app()
+        self._init_ingress(laddr, raddr)
+        self.listen_time = time()
         self._init_client()
+        self._init_replay()
 
     def _init_app(self):
         """
         Initialize application settings from app.yml.
         """
-        with open('conf/app.yml', 'r') as cf:
-            conf = yaml.load(cf, Loader=yaml.FullLoader)
+        conf = sig_config.app_conf()
+
+        if "logging" in conf:
+            sig_logger.configure(
+                               max_queue=conf['logging'].get('max_queue'),
+                               bulk_watermark=conf['logging'].get('bulk_watermark'),
+                               bulk_sample=conf['logging'].get('bulk_sample')
+                             )
 
         if "email_sender" in conf:
+            from email_sender import EmailSender
             self.ems = EmailSender(
                                     conf["email_sender"]["smtp_server"],
                                     conf["email_sender"]["smtp_port"],
@@ -59,51 +107,267 @@ class SigServer(SMTPServer):
             ems_thread.start()
 
         if "slack" in conf:
-            self.slack = SlackWebHook(
+            from slack_web_hook import SlackWebHook, SlackNotifier
+            slack = SlackWebHook(
                                conf['slack']['webhook_path'],
                                url=conf['slack']['webhook_url'],
                                channel=conf['slack']['channel'],
                                username=conf['slack']['username'],
                                icon=conf['slack']['icon']
                              )
+            # slack posts are sent from a background thread, off the smtp thread
+            self.slack = SlackNotifier(
+                               slack,
+                               self.logger,
+                               queue_size=conf['slack'].get('queue_size', 100),
+                               coalesce_time=conf['slack'].get('coalesce_time', 1.0),
+                               max_retry=conf['slack'].get('max_retry', 5)
+                             )
+            self.slack.start()
+
+        if "dedup" in conf:
+            self.dedup = SignalDedup(
+                               max_size=conf['dedup'].get('max_size', 10000),
+                               ttl=conf['dedup'].get('ttl', 86400),
+                               path=conf['dedup'].get('path'),
+                               logger=self.logger
+                             )
+
+        if "journal" in conf:
+            self.journal = SignalJournal(
+                               conf['journal'].get('path', 'logs/signals.journal'),
+                               max_size=conf['journal'].get('max_size', 1024 * 1024),
+                               logger=self.logger
+                             )
+            self.dispatcher.journal = self.journal
+            self.journal_conf = conf['journal']
+            # taken now, signals journaled once the ingress listens aren't replayed
+            self.replay_entries = self.journal.unfinished()
+            self.replay_pending = bool(self.replay_entries)
+
+        if "fill_netting" in conf and conf['fill_netting'].get('window'):
+            self.netter = FillNetter(
+                               conf['fill_netting']['window'],
+                               self._dispatch_netted,
+                               logger=self.logger
+                             )
+
+        if "clients_reload" in conf:
+            self.reload_interval = conf['clients_reload'].get('interval', 2)
+
         self.ts_signal_conf = conf.get('ts_signal', {})
+        self.ingress_conf = conf.get('smtp_ingress', {})
+
+    def _init_ingress(self, laddr, raddr):
+        """
+        Bind the smtp listener with the configured engine. 'threaded' serves
+        each connection on its own thread; otherwise the asyncore smtpd loop is used.
+        """
+        if self.ingress_conf.get('engine') == 'threaded':
+            self.ingress = SMTPIngress(
+                                laddr,
+                                self.process_message,
+                                self.logger,
+                                max_sessions=self.ingress_conf.get('max_sessions', 64),
+                                session_timeout=self.ingress_conf.get('session_timeout', 30),
+                                max_message_size=self.ingress_conf.get('max_message_size', 1024 * 1024),
+                                queue_size=self.ingress_conf.get('queue_size', 1000),
+                                tracker=self.tracker,
+                                journal=self.journal
+                              )
+        else:
+            self.smtp = AsyncoreIngress(laddr, raddr, self.process_message)
 
     def _init_client(self):
         """
-        Initialize client settings from clients.yml.
+        Initialize client settings from clients.yml, and watch the file for
+        changes if clients_reload is configured.
         """
-        with open('conf/clients.yml', 'r') as cf:
-            conf = yaml.load(cf, Loader=yaml.FullLoader)
+        self.reload_clients()
 
-        for client in conf:
-            # skip any client without active flag of value True
-            if not client.get('active'):
-                continue
+        if self.reload_interval:
+            watcher = Thread(target=self.watch_clients, name="clients-watcher")
+            watcher.daemon = True
+            watcher.start()
 
-            # add email client to a list
-            if client.get('email'):
-                # email client
-                self.em_clients.append(client['email'])
+    def _init_replay(self):
+        """
+        Replay the signals the journal holds as unfinished, once the clients
+        had replay_delay seconds to connect.
+        """
+        if not self.replay_entries:
+            return
+        replay = Timer(self.journal_conf.get('replay_delay', 10), self.replay_signals)
+        replay.daemon = True
+        replay.start()
+
+    def replay_signals(self):
+        """
+        Dispatch the unfinished signals of the journal to the clients they
+        weren't sent to yet, oldest first. They go out after the signals that
+        arrived during replay_delay, so a signal is dropped instead if a newer
+        one of the same order# was dispatched meanwhile, or if it's older than
+        max_age.
+        """
+        max_age = self.journal_conf.get('max_age', 300)
+        (entries, self.replay_entries) = (self.replay_entries, [])
+        for entry in entries:
+            if self.sig_shutdown:
+                return
+            ts_signal = parse_signal(entry.data, self.ts_signal_conf)
+            if entry.quantity:
+                ts_signal.quantity = entry.quantity     # total of netted fills
+            age = time() - entry.time
+            if age > max_age or not ts_signal.verify_attributes():
+                self.log_all("Unfinished signal not replayed, %d sec old: order# %s %s %d %s" %
+                             (age, ts_signal.order_id, ts_signal.action, ts_signal.quantity,
+                              ts_signal.symbol), level="error")
+                self.journal.record_done(entry.id)
+                continue
+            if (ts_signal.account_name, ts_signal.order_id) in self.live_orders:
+                self.log_all("Unfinished signal not replayed, a newer one was sent since: order# %s %s %d %s" %
+                             (ts_signal.order_id, ts_signal.action, ts_signal.quantity,
+                              ts_signal.symbol), level="error")
+                self.journal.record_done(entry.id)
                 continue
 
-            if client.get('fix_cfg_path'):
-                fix_thread = Thread(target=self.fix_thread,
-                                    kwargs=dict(client=client))
-                fix_thread.daemon = True
-                fix_thread.start()
+            (clients, quantities) = self.router.route(ts_signal)
+            pending = [(c, q) for (c, q) in zip(clients, quantities) if c.name not in entry.sent]
+            if not pending:
+                self.journal.record_done(entry.id)
                 continue
+            self.log_all("Replaying unfinished signal to %d client(s): order# %s %s %d %s" %
+                         (len(pending), ts_signal.order_id, ts_signal.action,
+                          ts_signal.quantity, ts_signal.symbol))
+            self.dispatcher.dispatch(ts_signal, [c for (c, q) in pending],
+                                     [q for (c, q) in pending], journal_id=entry.id)
+        self.replay_pending = False
+        self.live_orders.clear()
+
+    @staticmethod
+    def client_key(client):
+        """Identity of a client entry. Changing any of these fields replaces the client."""
+        if client.get('email'):
+            return ('email', client['email'])
+        if client.get('fix_cfg_path'):
+            return ('fix', client['fix_cfg_path'])
+        # client_ids are connections of their own, changing them reconnects the client
+        return ('ib', client.get('server'), client.get('port'), client.get('client_id'),
+                tuple(client.get('client_ids') or ()))
+
+    def watch_clients(self):
+        """Apply changes of clients.yml every reload_interval seconds until shutdown."""
+        last_error = None
+        while not self.watch_stop.wait(self.reload_interval):
+            try:
+                self.reload_clients()
+                last_error = None
+            except Exception as e:
+                # e.g. a half saved file, keep the running clients and retry
+                if str(e) != last_error:
+                    last_error = str(e)
+                    self.log_all("clients.yml not reloaded: " + last_error, level="error")
 
+    def reload_clients(self):
+        """
+        Diff clients.yml against the running clients. Only the clients that
+        were added or removed are started or stopped, others that changed get
+        their settings swapped in place and never reconnect.
+        """
+        conf = sig_config.clients_conf()
+        if conf is self.loaded_clients:
+            return  # file unchanged since the last reload
+
+        # skip any client without active flag of value True
+        confs = dict((self.client_key(c), c) for c in conf if c.get('active'))
+
+        with self.clients_lock:
+            old_confs = self.client_confs
+            self.client_confs = confs
+            removed = [(key, self._remove_client(key)) for key in old_confs if key not in confs]
+            for (key, client) in confs.items():
+                if key not in old_confs:
+                    self._start_client(key, client)
+                elif client != old_confs[key] and key in self.adapters:
+                    self.adapters[key].update(client)
+            self.loaded_clients = conf
+            self.router = SigRouter(self.adapters.values())
+
+        # a FIX logout can take a while, signals keep being dispatched meanwhile
+        for (key, adapter) in removed:
+            if adapter is not None:
+                self._stop_adapter(key, adapter)
+
+    def _start_client(self, key, client):
+        if key[0] == 'email':
+            # add email client to a list
+            self.em_clients.append(client['email'])
+        elif key[0] == 'fix':
+            fix_thread = Thread(target=self.fix_thread,
+                                kwargs=dict(client=client))
+            fix_thread.daemon = True
+            fix_thread.start()
+        else:
             # remainings are IBs
             # create a thread to connect each IB client so that it's non-blocking
             ib_thread = Thread(target=self.ib_thread,
                                kwargs=dict(ib_host=client))
             ib_thread.daemon = True
             ib_thread.start()
+        if self.loaded_clients is not None:
+            self.log_all("Client added: " + ' '.join(map(str, key[1:])))
+
+    def _remove_client(self, key):
+        """
+        Take a client out of the running set, called with clients_lock held.
+        Returns its IB or FIX adapter for _stop_adapter, if it had one.
+        """
+        self.log_all("Client removed: " + ' '.join(map(str, key[1:])))
+        if key[0] == 'email':
+            self.em_clients.remove(key[1])
+            return None
+
+        adapter = self.adapters.pop(key, None)
+        if adapter is None:
+            return None     # still starting up, it is stopped once registered
+        if key[0] == 'fix':
+            self.fix_clients.pop(key[1], None)
+        else:
+            self.ib_clients.remove(adapter)
+        return adapter
+
+    def _stop_adapter(self, key, adapter):
+        """Disconnect a removed client, without clients_lock held."""
+        if key[0] == 'fix':
+            adapter.stop()
+        else:
+            adapter.disconnect()
+        self.dispatcher.remove(adapter)
+
+    def _register(self, client, adapter):
+        """
+        Make a newly created IB or FIX client available for dispatch. Returns
+        False if it was removed from clients.yml while it was being created.
+        """
+        key = self.client_key(client)
+        with self.clients_lock:
+            latest = self.client_confs.get(key)
+            if latest is None or self.sig_shutdown:
+                return False
+            if latest != client:
+                adapter.update(latest)  # changed while it was being created
+            self.adapters[key] = adapter
+            if key[0] == 'fix':
+                self.fix_clients[key[1]] = adapter
+            else:
+                self.ib_clients.append(adapter)
+            self.router = SigRouter(self.adapters.values())
+        return True
 
     def log_all(self, msg, level="info"):
         self.logger.log_all(msg, level=level)
 
-    def process_message(self, peer, mailfrom, rcpttos, data):
+    def process_message(self, peer, mailfrom, rcpttos, data, trace=None, journal_id=None):
         """
         This is the function for smtpServer to receive emails
         from TradeStation
@@ -111,17 +375,90 @@ class SigServer(SMTPServer):
         :param mailfrom:
         :param rcpttos:
         :param data:
+        :param trace: SignalTrace started on receipt by the ingress, if it queued the email
+        :param journal_id: id the ingress journaled the email with before accepting it
         :return:
         """
+        if trace is None:
+            trace = self.tracker.start_trace()
         self.logger.info(' '.join(["Receiving signal from:",
                                    str(peer), ' with\n', data]))
         if not data:
+            self._journal_done(journal_id)
             return
 
-        ts_signal = TradeStationSignal(data, self.ts_signal_conf)
+        ts_signal = parse_signal(data, self.ts_signal_conf)
         if not ts_signal.verify_attributes():
+            self._journal_done(journal_id)
+            return
+        ts_signal.trace = trace
+        trace.mark('parse')
+        trace.upstream(ts_signal.sent_time)
+
+        if self.dedup and self.dedup.is_duplicate(ts_signal):
+            self.log_all("Duplicate signal ignored: order# %s %s %d %s (%d duplicates so far)" %
+                         (ts_signal.order_id, ts_signal.sig_type, ts_signal.quantity,
+                          ts_signal.symbol, self.dedup.hits))
+            self._journal_done(journal_id)
+            return
+
+        if self.netter and ts_signal.sig_type == 'filled':
+            # dispatched with the other partial fills of the order once the window is
+            # over, and journaled now so that a crash meanwhile can't lose the fill
+            if journal_id is None:
+                journal_id = self._journal_signal(data)
+            self.netter.add(ts_signal, data, journal_id)
             return
 
+        self._dispatch_signal(ts_signal, data, journal_id=journal_id)
+
+    def _dispatch_netted(self, fill):
+        """Dispatch partial fills netted by the FillNetter as one signal."""
+        ts_signal = fill.ts_signal
+        if ts_signal.trace:
+            ts_signal.trace.mark('fill netting')
+        journal_id = None
+        if fill.journal_ids:
+            # the first fill's entry stands for the total, the others are complete
+            journal_id = fill.journal_ids[0]
+            if len(fill.journal_ids) > 1:
+                try:
+                    self.journal.record_netted(journal_id, ts_signal.quantity, fill.journal_ids[1:])
+                except (IOError, OSError) as e:
+                    self.log_all("Netted fills not journaled: " + str(e), level="error")
+        clients = self._dispatch_signal(ts_signal, fill.data, netted=fill.pieces > 1,
+                                        journal_id=journal_id)
+        if fill.pieces == 1:
+            return
+
+        saved = (fill.pieces - 1) * clients
+        self.netter.saved += saved
+        self.log_all("Netted %d fills of order# %s into one: %d broker messages saved, %d so far" %
+                     (fill.pieces, ts_signal.order_id, saved, self.netter.saved))
+
+    def _journal_signal(self, data, quantity=None):
+        """Journal the email of a signal, returns its journal id or None."""
+        if not self.journal:
+            return None
+        try:
+            return self.journal.record_signal(data, quantity=quantity)
+        except (IOError, OSError) as e:
+            self.log_all("Signal not journaled: " + str(e), level="error")
+            return None
+
+    def _journal_done(self, journal_id):
+        """An email journaled on receipt that sends no order."""
+        if journal_id is not None:
+            self.journal.record_done(journal_id)
+
+    def _dispatch_signal(self, ts_signal, data, netted=False, journal_id=None):
+        """
+        Send the signal to the clients taking it and to the notifiers.
+        journal_id is given for a signal journaled on receipt, as partial fills
+        and the emails of the threaded ingress are.
+        Returns the number of clients it was dispatched to.
+        """
+        trace = ts_signal.trace
         trade_str = ' '.join([
                                 ts_signal.action,
                                 str(ts_signal.quantity),
@@ -135,49 +472,50 @@ class SigServer(SMTPServer):
 
         self.log_all(' '.join(['-------> signal:', trade_str, "\n\n"]))
 
-        try:
-            # sending order to each IB client
-            # make this threaded perhaps?
-            for ib_cli in self.ib_clients:
-                ib_cli.process_order(ts_signal)
-        except Exception as e:
-            self.log_all('<IB Client> ' + str(e), level="error")
-
-        try:
-            # send order to fix client
-            for (key, fix_cli) in self.fix_clients.items():
-                fix_cli.process_order(ts_signal)
-        except Exception as e:
-            self.log_all('<Fix client>' + str(e), level="error")
+        # send order to every IB and FIX client taking the trade at the same time.
+        # Each client has its own lane, so a failing or stalled client won't hold up others.
+        (clients, quantities) = self.router.route(ts_signal)
+        if self.replay_pending and clients:
+            self.live_orders.add((ts_signal.account_name, ts_signal.order_id))
+        if journal_id is not None and not clients:
+            self._journal_done(journal_id)  # no order to send
+            journal_id = None
+        elif journal_id is None and clients:
+            # on disk before any order is sent, so a crash can't lose the signal
+            journal_id = self._journal_signal(data, quantity=ts_signal.quantity if netted else None)
+        self.dispatcher.dispatch(ts_signal, clients, quantities, journal_id)
+        trace.mark('dispatch')
 
         # send data to slack channel
         if self.slack:
-            self.process_slack(trade_str)
+            self.slack.queue_trade(trade_str, trace=trace)
         else:
             self.logger.info(" --- No slack configuration found.")
 
         try:
             # send to email list
             if self.ems:
-                self.ems.queue_trade(trade_str)
+                self.ems.queue_trade(trade_str, trace=trace)
             else:
                 self.logger.info(" --- No email client configuration found.")
         except Exception as e:
             self.log_all('<Email Client> ' + str(e), level="error")
+        return len(clients)
 
-    def process_slack(self, trade_str):
-        try_cnt = 0
-        while try_cnt <= 5:
-            try:
-                self.slack.send(trade_str)
-                break
-            except Exception as e:
-                try_cnt += 1
-                if try_cnt > 5:
-                    self.log_all('<Slack Client> ' + str(e), level="error")
-                else:
-                    self.log_all('<Slack Client> ' + str(e), level="info")
-                sleep(try_cnt)
+    def dump_latency(self):
+        """
+        Log the latency histograms of every stage with the runtime counters,
+        and save the histograms for tests/SendSig.py.
+        """
+        self.log_all(self.tracker.dump())
+        for ib_cli in list(self.ib_clients):
+            self.log_all(ib_cli.pacing_stats())
+        if self.slack:
+            self.log_all(self.slack.stats())
+        try:
+            self.tracker.save(LATENCY_SNAPSHOT_PATH)
+        except (IOError, OSError) as e:
+            self.logger.error("latency snapshot not saved: " + str(e))
 
     def run(self):
         """
@@ -185,24 +523,47 @@ class SigServer(SMTPServer):
         """
         self.sig_shutdown = False
         try:
-            asyncore.loop(timeout=0.8)
+            if self.ingress:
+                self.ingress.serve_forever(poll_interval=0.5)
+            else:
+                asyncore.loop(timeout=0.8)
         except Exception as e:
             # captures 'Bad file descriptor' error when server quits.
             self.logger.error(e)
 
     def shutdown(self):
         """Shutdown the server."""
-        self.sig_shutdown = True
+        self.watch_stop.set()
+        if self.netter:
+            self.netter.stop()  # dispatch the fills still held
+            self.logger.info(self.netter.stats())
+        with self.clients_lock:
+            self.sig_shutdown = True
+            self.client_confs = {}
+            self.adapters.clear()
+            self.router = SigRouter()
         for ib_cli in self.ib_clients:
             ib_cli.disconnect()
 
         for (k, fix_cli) in self.fix_clients.items():
             fix_cli.stop()
 
+        self.dispatcher.stop()
+        if self.slack:
+            self.logger.info(self.slack.stats())
+            self.slack.stop()
+        if self.dedup:
+            self.dedup.close()
+        if self.journal:
+            self.logger.info(self.journal.stats())
+            self.journal.close()
         del self.ib_clients[:]
         self.fix_clients.clear() 
         self.em_clients = []
-        self.close()
+        if self.ingress:
+            self.ingress.shutdown()
+        else:
+            self.smtp.close()
 
     def ib_thread(self, ib_host=None):
         """
@@ -214,9 +575,10 @@ class SigServer(SMTPServer):
         if not ib_host:
             return
 
-        ib = IBWrapper(ib_host, self.uilogger)
-        self.ib_clients.append(ib)  # provides a reference to ib client for interaction
-        ib.connect()
+        from ib_wrapper import IBWrapper
+        ib = IBWrapper(ib_host, self.uilogger, tracker=self.tracker)
+        if self._register(ib_host, ib):   # provides a reference to ib client for interaction
+            ib.connect()
 
     def fix_thread(self, client=None):
         """
@@ -225,8 +587,8 @@ class SigServer(SMTPServer):
         if not client:
             return
 
+        from fix_processor import FixProcessor
         proc = FixProcessor(client, uilogger=self.uilogger)
-        cfg_path = client.get("fix_cfg_path")
-        self.fix_clients[cfg_path] = proc
-        proc.start()
+        if self._register(client, proc):
+            proc.start()
 
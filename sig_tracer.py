@@ -0,0 +1,195 @@
+################################################################################
+# Latency tracing of signals through the bridge.
+# A SignalTrace is started when an email is received and every stage a signal
+# goes through (parse, each client submission, notifications) is marked on it.
+# The elapsed times roll up into HDR style histograms per stage, which can be
+# dumped on demand. The upstream delay (email Date header to receipt) is kept
+# in its own histogram, apart from our own processing time.
+################################################################################
+import sys
+import json
+import time
+from threading import Lock
+
+import sig_files
+
+
+def _monotonic_clock():
+    """Best monotonic clock available on python 2."""
+    if sys.platform.startswith('linux'):
+        try:
+            import ctypes
+            import ctypes.util
+
+            class timespec(ctypes.Structure):
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+            librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+            clock_gettime = librt.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            CLOCK_MONOTONIC = 1
+
+            def monotonic():
+                t = timespec()
+                clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t))
+                return t.tv_sec + t.tv_nsec * 1e-9
+            monotonic()
+            return monotonic
+        except (OSError, AttributeError):
+            pass
+    if sys.platform == 'win32':
+        # time.clock is the high resolution performance counter on windows
+        return time.clock
+    return time.time
+
+
+monotonic = _monotonic_clock()
+
+
+class LatencyHistogram(object):
+    """
+    Log-linear histogram of latencies in microseconds. Every power of two is
+    split into SUB_BUCKETS / 2 linear buckets, which bounds the relative error.
+    """
+
+    SUB_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BITS
+    HALF_BUCKETS = SUB_BUCKETS >> 1
+
+    def __init__(self):
+        self.counts = {}    # bucket index -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value < cls.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls.SUB_BITS
+        return shift * cls.HALF_BUCKETS + (value >> shift)
+
+    @classmethod
+    def bucket_upper(cls, index):
+        """Highest value that falls in the bucket."""
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.HALF_BUCKETS - 1
+        return ((index - shift * cls.HALF_BUCKETS + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        index = self.bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Upper bound of the given percentile in microseconds."""
+        if not self.count:
+            return 0
+        rank = max(1, int(round(self.count * pct / 100.0)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.bucket_upper(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        """Counts per bucket as [[bucket upper bound in us, count], ...], for json."""
+        return {
+            'count': self.count,
+            'total_us': self.total,
+            'min_us': self.min,
+            'max_us': self.max,
+            'buckets': [[self.bucket_upper(i), self.counts[i]] for i in sorted(self.counts)],
+        }
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        hist = cls()
+        for (upper, count) in snap['buckets']:
+            hist.counts[cls.bucket_index(upper)] = count
+        hist.count = snap['count']
+        hist.total = snap['total_us']
+        hist.min = snap['min_us']
+        hist.max = snap['max_us']
+        return hist
+
+    def summary(self):
+        if not self.count:
+            return "n=0"
+        return "n=%d min=%.1f p50=%.1f p90=%.1f p99=%.1f max=%.1f mean=%.1f ms" % (
+                self.count, self.min / 1e3, self.percentile(50) / 1e3,
+                self.percentile(90) / 1e3, self.percentile(99) / 1e3,
+                self.max / 1e3, self.total / 1e3 / self.count)
+
+
+class LatencyTracker:
+
+    UPSTREAM = 'upstream (email Date -> receipt)'
+
+    def __init__(self):
+        self.histograms = {}    # stage name -> LatencyHistogram
+        self.lock = Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = LatencyHistogram()
+            hist.record(seconds)
+
+    def start_trace(self):
+        return SignalTrace(self)
+
+    def snapshot(self):
+        """Histogram snapshots per stage, see LatencyHistogram.snapshot."""
+        with self.lock:
+            return dict((name, hist.snapshot()) for (name, hist) in self.histograms.items())
+
+    def save(self, path):
+        """Write the snapshot as json, replacing the file atomically."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'time': time.time(), 'stages': self.snapshot()}, f)
+        sig_files.replace(tmp_path, path)
+
+    def dump(self):
+        """Summary of every histogram, one line per stage."""
+        with self.lock:
+            lines = ["latency since receipt per stage:"]
+            for name in sorted(self.histograms):
+                if name != self.UPSTREAM:
+                    lines.append("  %-40s %s" % (name, self.histograms[name].summary()))
+            if self.UPSTREAM in self.histograms:
+                lines.append("  %-40s %s" % (self.UPSTREAM, self.histograms[self.UPSTREAM].summary()))
+        return '\n'.join(lines)
+
+
+class SignalTrace(object):
+    """Timestamps of a single signal, relative to its receipt."""
+
+    __slots__ = ('tracker', 'received', 'received_wall')
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.received = monotonic()
+        self.received_wall = time.time()
+
+    def mark(self, stage):
+        """Record the time elapsed since receipt for the stage."""
+        elapsed = monotonic() - self.received
+        self.tracker.record(stage, elapsed)
+        return elapsed
+
+    def upstream(self, sent_time):
+        """Record the delay between the email's Date header and its receipt."""
+        if sent_time:
+            self.tracker.record(LatencyTracker.UPSTREAM, self.received_wall - sent_time)
@@ -0,0 +1,110 @@
+################################################################################
+# Bounded index of recently routed signals, used to drop duplicate deliveries
+# of the same TradeStation email. Entries expire after a TTL and the least
+# recently seen entries are evicted once the index is full. Optionally every
+# new entry is appended to a file so that a restart doesn't forget them.
+################################################################################
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+import sig_files
+
+
+class SignalDedup:
+
+    def __init__(self, max_size=10000, ttl=86400, path=None, logger=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.logger = logger
+        self.entries = OrderedDict()    # key -> time first seen, oldest first
+        self.hits = 0                   # duplicates detected
+        self.lock = Lock()
+        self.fh = None
+        self.appended = 0               # lines appended since the last compaction
+
+        if path:
+            self._load()
+
+    @staticmethod
+    def key(ts_signal):
+        fields = [ts_signal.account_name, ts_signal.order_id, ts_signal.sig_type, ts_signal.quantity]
+        if ts_signal.sig_type == 'filled':
+            # partial fills of an order can be the same size, their price and Date
+            # header tell them apart while a second delivery of one email has both
+            fields += [ts_signal.price, ts_signal.sent_time]
+        return '\t'.join(map(str, fields))
+
+    def is_duplicate(self, ts_signal):
+        """
+        Check whether the signal was already seen within the TTL.
+        A signal that wasn't seen is added to the index.
+        """
+        key = self.key(ts_signal)
+        now = time()
+        with self.lock:
+            seen = self.entries.pop(key, None)
+            if seen is not None and now - seen < self.ttl:
+                # move to the recently used end, but keep the original time
+                self.entries[key] = seen
+                self.hits += 1
+                return True
+
+            self.entries[key] = now
+            self._evict(now)
+            if self.fh:
+                self.fh.write('%f\t%s\n' % (now, key))
+                self.fh.flush()
+                self.appended += 1
+                if self.appended > self.max_size:
+                    self._compact()
+        return False
+
+    def _evict(self, now):
+        while self.entries:
+            key, seen = next(self.entries.iteritems())
+            if len(self.entries) <= self.max_size and now - seen < self.ttl:
+                break
+            del self.entries[key]
+
+    def _load(self):
+        """Load unexpired entries from the file, then rewrite it compacted."""
+        now = time()
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as df:
+                for line in df:
+                    try:
+                        (seen, key) = line.rstrip('\n').split('\t', 1)
+                        seen = float(seen)
+                    except ValueError:
+                        continue    # partially written line
+                    if now - seen < self.ttl:
+                        self.entries.pop(key, None)
+                        self.entries[key] = seen
+            self._evict(now)
+        elif os.path.dirname(self.path) and not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+
+        self._compact()
+        if self.logger:
+            self.logger.info("loaded %d recent signals from %s" % (len(self.entries), self.path))
+
+    def _compact(self):
+        """Rewrite the file with the entries currently in the index."""
+        if self.fh:
+            self.fh.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as df:
+            for (key, seen) in self.entries.iteritems():
+                df.write('%f\t%s\n' % (seen, key))
+        sig_files.replace(tmp_path, self.path)
+        self.fh = open(self.path, 'a')
+        self.appended = 0
+
+    def close(self):
+        with self.lock:
+            if self.fh:
+                self.fh.close()
+                self.fh = None
@@ -1,36 +1,158 @@
 import httplib
 import urllib
 import json
+from Queue import Queue, Full, Empty
+from threading import Thread, Event
+from time import sleep, time
 
 
 class SlackWebHook:
     def __init__(self, webhook_path, url='hooks.slack.com', channel='#test_bed',
-                    username="sb-bot", icon=":satellite:"):
+                    username="sb-bot", icon=":satellite:", timeout=10):
         self.web_hook_url = url
         self.webhook_path = webhook_path
         self.channel = channel
         self.username = username
         self.icon = icon
+        self.timeout = timeout
+        self.conn = None    # keep-alive connection reused between posts
 
     def send(self, message):
         if message:
-            conn = httplib.HTTPSConnection(self.web_hook_url)
             payload = {
                 "channel": self.channel,
                 "username": self.username,
                 "icon_emoji": self.icon,
                 "text": message
             }
+            body = urllib.urlencode({'payload': json.dumps(payload)})
+
+            while True:
+                # an idle keep-alive connection may have been closed by slack,
+                # so a failure on a reused connection is retried once on a new one.
+                reused = self.conn is not None
+                if not reused:
+                    self.conn = httplib.HTTPSConnection(self.web_hook_url, timeout=self.timeout)
+                try:
+                    self.conn.request(
+                        "POST", self.webhook_path, body,
+                        {"Content-type": "application/x-www-form-urlencoded"}
+                    )
+                    resp = self.conn.getresponse()
+                    # the response must be read fully before the connection is reused
+                    resp.read()
+                    break
+                except Exception:
+                    self.close()
+                    if not reused:
+                        raise
+            if resp.getheader('connection', '').lower() == 'close':
+                self.close()
+            return resp
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+class SlackNotifier:
+    """
+    Posts trade strings to slack from a background thread so that slack
+    latency or outages never block signal processing. Messages queued within
+    the coalescing window are merged into a single post.
+    """
+
+    def __init__(self, slack, logger, queue_size=100, coalesce_time=1.0, max_retry=5):
+        self.slack = slack
+        self.logger = logger
+        self.msg_queue = Queue(maxsize=queue_size)
+        self.coalesce_time = coalesce_time  # seconds to wait for more messages
+        self.max_retry = max_retry
+        self.dropped = 0                    # messages dropped on a full queue
+        self.failed = 0                     # posts given up after max retry
+        self.sent = 0                       # successful posts
+        self.stop_event = Event()
+
+    @property
+    def queue_depth(self):
+        return self.msg_queue.qsize()
+
+    def start(self):
+        sender = Thread(target=self.daemon_sender, name="slack-notifier")
+        sender.daemon = True
+        sender.start()
+
+    def stop(self):
+        """Stop the sender, which closes the slack connection once it's done with it."""
+        self.stop_event.set()
+        try:
+            self.msg_queue.put_nowait(None)     # wakes the sender up
+        except Full:
+            pass    # the sender sees the event after its current post
+
+    def queue_trade(self, trade_str, trace=None):
+        """Queue a message without blocking. Drops it if the queue is full."""
+        try:
+            self.msg_queue.put_nowait((trade_str, trace))
+        except Full:
+            self.dropped += 1
+            self.logger.log_all("<Slack Client> queue full, dropped message "
+                                "(%d dropped so far): %s" % (self.dropped, trade_str), level="error")
+
+    def daemon_sender(self):
+        while not self.stop_event.is_set():
+            try:
+                msg = self.msg_queue.get(timeout=1)
+            except Empty:
+                continue
+            if msg is None:
+                break
+            msgs = [msg]
+
+            # gather whatever else arrives within the coalescing window
+            deadline = time() + self.coalesce_time
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    msg = self.msg_queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if msg is None:
+                    break
+                msgs.append(msg)
+
+            if self.post('\n'.join([msg for (msg, trace) in msgs])):
+                for (msg, trace) in msgs:
+                    if trace:
+                        trace.mark('slack')
+        # only this thread uses the connection, so it's closed here rather than by stop
+        self.slack.close()
+
+    def post(self, message):
+        try_cnt = 0
+        while not self.stop_event.is_set():
+            try:
+                self.slack.send(message)
+                self.sent += 1
+                return True
+            except Exception as e:
+                try_cnt += 1
+                if try_cnt > self.max_retry:
+                    self.failed += 1
+                    self.logger.log_all('<Slack Client> ' + str(e), level="error")
+                    return False
+                self.logger.log_all('<Slack Client> ' + str(e), level="info")
+                sleep(try_cnt)
+        return False
+
+    def stats(self):
+        return "slack queue depth: %d, sent: %d, dropped: %d, failed: %d" % (
+                self.queue_depth, self.sent, self.dropped, self.failed)
 
-            conn.request(
-                "POST", self.webhook_path,
-                urllib.urlencode({
-                    'payload': json.dumps(payload)
-                }),
-                {"Content-type": "application/x-www-form-urlencoded"}
-            )
-            return conn.getresponse()
 
 if __name__ == '__main__':
-    slack = Slack("/services/T2GLAPJHM/B4H2LRVS9/7fSoJ9VIrY5v5E0TQvML5kgC")
+    slack = SlackWebHook("/services/T2GLAPJHM/B4H2LRVS9/7fSoJ9VIrY5v5E0TQvML5kgC")
     slack.send("Hi there, I'm a robot added by Jay!! Reporting from SigBridge.")
@@ -0,0 +1,263 @@
+################################################################################
+# Concurrent SMTP ingress for TradeStation signal emails.
+# Every connection is served by its own session thread with a socket timeout
+# and a message size limit. Received messages are handed to a single routing
+# thread through a bounded queue, which calls
+# process_message(peer, mailfrom, rcpttos, data) just like smtpd.SMTPServer.
+# With a LatencyTracker, the trace of every message is started as its DATA
+# ends and passed along as process_message's trace, so the time it waited in
+# the queue counts towards its latency. With a SignalJournal, every message is
+# journaled before the sender is told it was accepted, and its journal id is
+# passed along as process_message's journal_id.
+################################################################################
+import socket
+import SocketServer
+from Queue import Queue, Full
+from threading import Thread, BoundedSemaphore
+
+
+class SMTPSession(SocketServer.StreamRequestHandler):
+    """Speaks the subset of SMTP that TradeStation and mail relays use."""
+
+    MAX_LINE = 4096
+    TOO_LONG = object()     # read_line's result for a line over MAX_LINE
+
+    def setup(self):
+        self.timeout = self.server.session_timeout
+        SocketServer.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        try:
+            self.reply('220 %s SigBridge SMTP ready' % self.server.fqdn)
+            self.converse()
+        except (socket.timeout, socket.error) as e:
+            self.server.logger.info("SMTP session %s closed: %s" % (str(self.client_address), str(e)))
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def reset(self):
+        self.mailfrom = None
+        self.rcpttos = []
+
+    def read_line(self):
+        """
+        The next line without its CRLF, None once the client closed. A line
+        longer than MAX_LINE is read to its end and discarded, TOO_LONG instead.
+        """
+        line = self.rfile.readline(self.MAX_LINE)
+        if not line:
+            return None
+        if not line.endswith('\n') and len(line) >= self.MAX_LINE:
+            while line and not line.endswith('\n'):
+                line = self.rfile.readline(self.MAX_LINE)
+            return self.TOO_LONG
+        return line.rstrip('\r\n')
+
+    def converse(self):
+        self.reset()
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            if line is self.TOO_LONG:
+                self.reply('500 Error: line too long')
+                continue
+            i = line.find(' ')
+            if i < 0:
+                command, arg = line.upper(), None
+            else:
+                command, arg = line[:i].upper(), line[i+1:].strip()
+
+            if command in ('HELO', 'EHLO'):
+                if command == 'EHLO':
+                    self.reply('250-%s' % self.server.fqdn)
+                    self.reply('250 SIZE %d' % self.server.max_message_size)
+                else:
+                    self.reply('250 %s' % self.server.fqdn)
+            elif command == 'MAIL':
+                (address, params) = self.get_addr('FROM:', arg)
+                size = params.get('SIZE')
+                if not address or (size is not None and not size.isdigit()):
+                    self.reply('501 Syntax: MAIL FROM:<address> [SIZE=<size>]')
+                    continue
+                if size is not None and int(size) > self.server.max_message_size:
+                    self.reply('552 Error: message size exceeds fixed maximum message size')
+                    continue
+                self.mailfrom = address
+                self.reply('250 Ok')
+            elif command == 'RCPT':
+                if not self.mailfrom:
+                    self.reply('503 Error: need MAIL command')
+                    continue
+                (address, params) = self.get_addr('TO:', arg)
+                if not address:
+                    self.reply('501 Syntax: RCPT TO: <address>')
+                    continue
+                self.rcpttos.append(address)
+                self.reply('250 Ok')
+            elif command == 'DATA':
+                if not self.rcpttos:
+                    self.reply('503 Error: need RCPT command')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.receive_data()
+                self.reset()
+            elif command == 'RSET':
+                self.reset()
+                self.reply('250 Ok')
+            elif command == 'NOOP':
+                self.reply('250 Ok')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Error: command "%s" not implemented' % command)
+
+    @staticmethod
+    def get_addr(keyword, arg):
+        """Address of a MAIL or RCPT argument and its ESMTP parameters, e.g. SIZE."""
+        if not arg or not arg[:len(keyword)].upper() == keyword:
+            return (None, {})
+        address = arg[len(keyword):].strip()
+        if address.startswith('<'):
+            end = address.find('>')
+            if end < 0:
+                return (None, {})
+            (address, rest) = (address[1:end] or '<>', address[end + 1:])
+        else:
+            (address, _, rest) = address.partition(' ')
+        params = {}
+        for param in rest.split():
+            (name, _, value) = param.partition('=')
+            params[name.upper()] = value
+        return (address or None, params)
+
+    def receive_data(self):
+        """Read the message up to the terminating '.' line, then queue it."""
+        lines = []
+        size = 0
+        too_big = False
+        too_long = False
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            if line is self.TOO_LONG:
+                # the rest of the message is read, but it's not taken
+                too_long = True
+                continue
+            if line == '.':
+                break
+            size += len(line) + 2
+            if size > self.server.max_message_size:
+                # keep reading up to the terminator, but discard the content
+                too_big = True
+                continue
+            if line.startswith('.'):
+                line = line[1:]
+            lines.append(line)
+
+        if too_long:
+            self.reply('500 Error: line too long')
+        elif too_big:
+            self.reply('552 Error: message exceeds size limit')
+        else:
+            # received now, the time it waits in the queue is part of its latency
+            trace = self.server.tracker.start_trace() if self.server.tracker else None
+            if self.server.queue_message(self.client_address, self.mailfrom,
+                                         self.rcpttos, '\n'.join(lines), trace):
+                self.reply('250 Ok')
+            else:
+                self.reply('451 Error: server busy, try again later')
+
+
+class SMTPIngress(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, laddr, process_message, logger, max_sessions=64,
+                 session_timeout=30, max_message_size=1024 * 1024, queue_size=1000,
+                 tracker=None, journal=None):
+        SocketServer.TCPServer.__init__(self, laddr, SMTPSession)
+        self.process_message = process_message
+        self.logger = logger
+        self.tracker = tracker  # LatencyTracker the messages are traced with, if any
+        self.journal = journal  # SignalJournal the messages are recorded in, if any
+        self.fqdn = socket.getfqdn()
+        self.session_slots = BoundedSemaphore(max_sessions)
+        self.session_timeout = session_timeout
+        self.max_message_size = max_message_size
+        self.msg_queue = Queue(maxsize=queue_size)
+
+        self.router = Thread(target=self.route, name="smtp-router")
+        self.router.daemon = True
+        self.router.start()
+
+    def process_request(self, request, client_address):
+        """Refuse a connection over max_sessions before a thread is started for it."""
+        if not self.session_slots.acquire(False):
+            try:
+                request.sendall('421 Too many connections, try again later\r\n')
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.session_slots.release()    # no thread to release it
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.session_slots.release()
+
+    def queue_message(self, peer, mailfrom, rcpttos, data, trace=None):
+        """
+        Journal the message and queue it, False if it's not taken. Called
+        before the reply to DATA, so an acknowledged message survives a crash.
+        """
+        journal_id = None
+        if self.journal:
+            try:
+                journal_id = self.journal.record_signal(data)
+            except (IOError, OSError) as e:
+                # taken anyway, process_message journals it again if it's a signal
+                self.logger.error("SMTP message from %s not journaled: %s" % (str(peer), str(e)))
+        try:
+            self.msg_queue.put_nowait((peer, mailfrom, rcpttos, data, trace, journal_id))
+            return True
+        except Full:
+            self.logger.error("SMTP routing queue full, rejected message from %s" % str(peer))
+            if journal_id is not None:
+                self.journal.record_done(journal_id)    # the sender tries again
+            return False
+
+    def route(self):
+        """Hand every received message to process_message, in arrival order."""
+        while True:
+            msg = self.msg_queue.get()
+            if msg is None:
+                break
+            (peer, mailfrom, rcpttos, data, trace, journal_id) = msg
+            kwargs = {}
+            if trace is not None:
+                trace.mark('ingress queue')
+                kwargs['trace'] = trace
+            if journal_id is not None:
+                kwargs['journal_id'] = journal_id
+            try:
+                self.process_message(peer, mailfrom, rcpttos, data, **kwargs)
+            except Exception as e:
+                self.logger.log_all('<SMTP Ingress> ' + str(e), level="error")
+
+    def shutdown(self):
+        SocketServer.TCPServer.shutdown(self)
+        self.server_close()
+        self.msg_queue.put(None)
+        self.router.join(5)
@@ -0,0 +1,89 @@
+# This script measures the time to build a NewOrderSingle with FixWrapper,
+# compared with the way orders were built before the header fields and the
+# TransactTime prefix were cached (standard header rendered through a Logon
+# message, settings read per order and the @echo trace printed per call).
+# usage: python tests/BenchFixOrder.py [iterations]
+import os
+import sys
+import timeit
+import tempfile
+import datetime as dt
+
+import quickfix as fix
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixapp.fix_wrapper import FixWrapper
+
+CFG = """[DEFAULT]
+ConnectionType=initiator
+FileStorePath=store
+StartTime=00:00:00
+EndTime=00:00:00
+HeartBtInt=30
+SocketConnectHost=localhost
+SocketConnectPort=9878
+
+[SESSION]
+BeginString=FIX.4.2
+SenderCompID=SIGBRIDGE
+TargetCompID=BROKER
+"""
+
+ORDER = {'55': 'SPY', '38': 25, '54': fix.Side_BUY}
+
+
+class Logger:
+    def info(self, msg):
+        pass
+
+
+def legacy_new_order_single(app, kargs):
+    """NewOrderSingle as it was built before, including the @echo output."""
+    print(" --- calling _NewOrderSingle")
+    print(" --- calling _make_standard_header")
+    sender = app.settingsDic.getString('SenderCompID')
+    target = app.settingsDic.getString('TargetCompID')
+    msg = fix.Message()
+    msg.getHeader().setField(fix.BeginString(fix.BeginString_FIX42))
+    msg.getHeader().setField(fix.MsgType(fix.MsgType_Logon))
+    msg.getHeader().setField(fix.SenderCompID(sender))
+    msg.getHeader().setField(fix.TargetCompID(target))
+    app.unicode_fix(msg.toString())
+
+    msg.getHeader().setField(fix.BeginString(fix.BeginString_FIX42))
+    msg.getHeader().setField(fix.MsgType(fix.MsgType_NewOrderSingle))
+    print(" --- calling genOrderID")
+    msg.setField(fix.ClOrdID(app.genOrderID()))
+    msg.setField(fix.TimeInForce(kargs.get('59', fix.TimeInForce_FILL_OR_KILL)))
+    msg.setField(fix.SecurityType(kargs.get('167', fix.SecurityType_COMMON_STOCK)))
+    msg.setField(fix.HandlInst(fix.HandlInst_AUTOMATED_EXECUTION_ORDER_PRIVATE_NO_BROKER_INTERVENTION))
+    msg.setField(fix.Symbol(kargs['55'].upper()))
+    msg.setField(fix.Side(kargs.get('54', fix.Side_BUY)))
+    msg.setField(fix.OrdType(kargs.get('40', fix.OrdType_MARKET)))
+    msg.setField(fix.OrderQty(float(kargs.get('38', 1))))
+    msg.setField(fix.Price(float(kargs.get('44', 0))))
+    msg.getHeader().setField(fix.SendingTime(1))
+    msg.setField(fix.StringField(60, (dt.datetime.utcnow().strftime("%Y%m%d-%H:%M:%S.%f"))[:-3]))
+    return msg
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) >= 2 else 20000
+
+    (fd, cfg_path) = tempfile.mkstemp(suffix='.cfg')
+    os.write(fd, CFG)
+    os.close(fd)
+    settings = fix.SessionSettings(cfg_path)
+    os.remove(cfg_path)
+
+    app = FixWrapper(settings, Logger())
+    app.onCreate(fix.SessionID('FIX.4.2', 'SIGBRIDGE', 'BROKER'))
+
+    # the old @echo trace went to stdout, keep it out of the terminal
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    before = timeit.timeit(lambda: legacy_new_order_single(app, ORDER), number=iterations)
+    after = timeit.timeit(lambda: app._NewOrderSingle(ORDER), number=iterations)
+    sys.stdout = stdout
+
+    print("before: %6.2f us/order" % (before / iterations * 1e6))
+    print("after:  %6.2f us/order" % (after / iterations * 1e6))
@@ -0,0 +1,120 @@
+# This script times the reader thread's work per TWS message: dispatch plus
+# the IBWrapper handler. 'regex' is ibpy's Dispatcher with the handlers as
+# they were, formatting every message into a string and searching it for its
+# fields, and every account value logged. 'table' is IBWrapper's own
+# connection, with IBEventDispatcher and the account value filter. The mix is
+# mostly account values, with order statuses, executions and info errors.
+# usage: python tests/BenchIBEvents.py [messages]
+import os
+import re
+import sys
+import random
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from ib.opt.dispatcher import Dispatcher
+from ib.ext.Contract import Contract
+from ib.ext.Execution import Execution
+from ib_wrapper import IBWrapper
+from sig_logger import SigLogger
+
+ACCOUNT = 'DU000001'
+ACCOUNT_KEYS = ['NetLiquidation', 'BuyingPower', 'AvailableFunds', 'GrossPositionValue',
+                'ExcessLiquidity', 'Cushion', 'UnrealizedPnL', 'RealizedPnL']
+
+
+class RegexHandlers(object):
+    """The handlers as IBWrapper had them, minus reconnecting and pacing."""
+
+    def __init__(self):
+        self.logger = SigLogger("BenchIBEvents")
+        self.account_id = None
+        self.next_id = None
+
+    def my_account_handler(self, msg):
+        self.logger.bulk(msg, 'account')
+
+    def managed_account_handler(self, msg):
+        regex = re.search(r'accountsList=(\w+)', str(msg))
+        if regex:
+            self.account_id = regex.group(1)
+
+    def next_valid_id_handler(self, msg):
+        regex = re.search(r'orderId=(\d+)', str(msg))
+        if regex:
+            self.next_id = int(regex.group(1))
+
+    def error_handler(self, msg):
+        regex = re.search(r'<.*errorCode=(.*),\serrorMsg=(.*)>', str(msg))
+        if regex:
+            self.logger.info("IB MSG [code: %s, message: %s]" % (regex.group(1), regex.group(2)))
+        else:
+            self.logger.error("IB Error: %s" % msg)
+
+
+def regex_dispatcher():
+    handlers = RegexHandlers()
+    dispatcher = Dispatcher()
+    dispatcher.register(handlers.my_account_handler, 'UpdateAccountValue')
+    dispatcher.register(handlers.error_handler, 'Error')
+    dispatcher.register(handlers.next_valid_id_handler, 'NextValidId')
+    dispatcher.register(handlers.managed_account_handler, 'ManagedAccounts')
+    return dispatcher
+
+
+def table_dispatcher():
+    ib = IBWrapper({'server': 'localhost', 'port': 7496, 'client_id': 1, 'sig_multiplier': 1,
+                    'account_values': {'keys': ['NetLiquidation', 'AvailableFunds'],
+                                       'interval': 60}})
+    ib.account_id = ACCOUNT
+    return ib.channels[0].con.dispatcher
+
+
+def messages(count, rnd):
+    """(EWrapper method name, args) as the ibpy reader dispatches them."""
+    msgs = [('nextValidId', {'orderId': 1})]
+    order_id = 1
+    while len(msgs) < count:
+        pick = rnd.random()
+        if pick < 0.8:
+            key = rnd.choice(ACCOUNT_KEYS)
+            value = '%.2f' % (1000000 + rnd.randint(0, 3) * 100)
+            msgs.append(('updateAccountValue', {'key': key, 'value': value, 'currency': 'USD',
+                                                'accountName': ACCOUNT}))
+        elif pick < 0.9:
+            for status in ('Submitted', 'Submitted', 'Filled', 'Filled'):
+                msgs.append(('orderStatus', {'orderId': order_id, 'status': status,
+                                             'filled': 0, 'remaining': 100, 'avgFillPrice': 0.0,
+                                             'permId': 1000 + order_id, 'parentId': 0,
+                                             'lastFillPrice': 0.0, 'clientId': 1,
+                                             'whyHeld': ''}))
+            contract = Contract()
+            contract.m_symbol = 'SPY'
+            execution = Execution()
+            (execution.m_acctNumber, execution.m_side, execution.m_shares,
+             execution.m_price, execution.m_orderId) = (ACCOUNT, 'BOT', 100, 100.0, order_id)
+            msgs.append(('execDetails', {'reqId': -1, 'contract': contract,
+                                         'execution': execution}))
+            order_id += 1
+        else:
+            msgs.append(('error', {'id': -1, 'errorCode': 2104,
+                                   'errorMsg': 'Market data farm connection is OK:usfarm'}))
+    return msgs[:count]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) >= 2 else 20000
+    msgs = messages(count, random.Random(7))
+
+    print("%8s %16s %16s" % ('messages', 'regex us/msg', 'table us/msg'))
+    for (name, make) in (('regex', regex_dispatcher), ('table', table_dispatcher)):
+        dispatcher = make()
+        elapsed = min(timeit.repeat(lambda: [dispatcher(n, args) for (n, args) in msgs],
+                                    number=1, repeat=3))
+        if name == 'regex':
+            regex_us = elapsed / count * 1e6
+        else:
+            print("%8d %16.2f %16.2f" % (count, regex_us, elapsed / count * 1e6))
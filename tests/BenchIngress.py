@@ -0,0 +1,100 @@
+# This script compares the message throughput of the asyncore (smtpd) ingress
+# against the threaded SMTPIngress, using several concurrent SMTP clients.
+# process_message sleeps for the given work time to stand in for parsing and
+# dispatching; asyncore can't accept anything else while it runs.
+# usage: python tests/BenchIngress.py [clients] [messages per client] [work ms]
+import os
+import sys
+import time
+import asyncore
+from smtpd import SMTPServer
+from smtplib import SMTP
+from threading import Thread, Event
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from smtp_ingress import SMTPIngress
+from sig_logger import SigLogger
+
+HOST = 'localhost'
+BODY = ('Subject: TradeStation - Order has been filled for SPY\n\n'
+        'TradeStation - Order has been filled for SPY\n'
+        '   Order: Buy 25 SPY @ Market\n'
+        '   Qty Filled: 25\n'
+        '   Filled Price: 65.2000\n'
+        '   Account: SIMXXXX\n'
+        '   Order#: 5-5733-7770')
+
+
+class Counter:
+    def __init__(self, total, work):
+        self.total = total
+        self.work = work
+        self.received = 0
+        self.finished = Event()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.work:
+            time.sleep(self.work)
+        self.received += 1
+        if self.received >= self.total:
+            self.finished.set()
+
+
+class AsyncoreServer(SMTPServer):
+    def __init__(self, laddr, counter):
+        SMTPServer.__init__(self, laddr, None)
+        self.counter = counter
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.counter.process_message(peer, mailfrom, rcpttos, data)
+
+
+def client(port, count):
+    smtp = SMTP(HOST, port, timeout=30)
+    for i in range(count):
+        smtp.sendmail('from@tester.net', ['test@receiver.com'], BODY)
+    smtp.quit()
+
+
+def drive(port, counter, clients, count):
+    start = time.time()
+    threads = [Thread(target=client, args=(port, count)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counter.finished.wait(60)
+    return counter.received / (time.time() - start)
+
+
+def bench_asyncore(port, clients, count, work):
+    counter = Counter(clients * count, work)
+    server = AsyncoreServer((HOST, port), counter)
+    loop = Thread(target=asyncore.loop, kwargs=dict(timeout=0.8))
+    loop.daemon = True
+    loop.start()
+    rate = drive(port, counter, clients, count)
+    server.close()
+    return rate
+
+
+def bench_threaded(port, clients, count, work):
+    counter = Counter(clients * count, work)
+    server = SMTPIngress((HOST, port), counter.process_message,
+                         SigLogger("BenchIngress"), max_sessions=clients)
+    loop = Thread(target=server.serve_forever)
+    loop.daemon = True
+    loop.start()
+    rate = drive(port, counter, clients, count)
+    server.shutdown()
+    return rate
+
+
+if __name__ == '__main__':
+    clients = int(sys.argv[1]) if len(sys.argv) >= 2 else 16
+    count = int(sys.argv[2]) if len(sys.argv) >= 3 else 100
+    work = float(sys.argv[3]) / 1000 if len(sys.argv) >= 4 else 0.0
+
+    print("%d clients x %d messages, %.1f ms work per message" % (clients, count, work * 1000))
+    print("asyncore: %8.1f msg/s" % bench_asyncore(8025, clients, count, work))
+    print("threaded: %8.1f msg/s" % bench_threaded(8026, clients, count, work))
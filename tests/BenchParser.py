@@ -0,0 +1,104 @@
+# This script checks that the fast TradeStation email parser gives the same
+# result as the line based parser on a corpus of real and synthetic emails,
+# then measures the parse time per message of both.
+# usage: python tests/BenchParser.py [iterations]
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from trade_station_signal import TradeStationSignal, FastTradeStationSignal
+
+CONF = {'future_regex': '[A-Z]{2,3}(F|G|H|J|K|M|N|Q|U|V|X|Z)\d{2}'}
+
+ATTRS = ['action', 'sig_type', 'symbol', 'quantity', 'order_type',
+         'account_name', 'order_id', 'price', 'sec_type', 'sent_time']
+
+HEADER = ('Date: 17 Sep 2019 19:50:20 UTC\n'
+          'From:  <xxxxx@roadrunner.com>\n'
+          'X-Priority: 3 (Normal)\n'
+          'To: <xxxxx@roadrunnerl.com>\n'
+          'Subject: TradeStation - %s for %s\n'
+          'MIME-Version: 1.0\n'
+          'Content-type: text/plain; charset="US-ASCII"\n'
+          'Content-Transfer-Encoding: 7bit\n')
+
+FILLED = ('TradeStation - Order has been filled for %(sym)s\n'
+          '    Order: %(order)s\n'
+          '    Qty Filled: %(qty)s\n'
+          '    Filled Price: %(price)s\n'
+          '    Duration: Day\n'
+          '    Route: Intelligent\n'
+          '    Account: SIMXXXX\n'
+          '    Order#: 5-5733-7770')
+
+PLACED = ('TradeStation - New order has been placed for %(sym)s\n'
+          '    Order: %(order)s\n'
+          '    Duration: Day\n'
+          '    Route: Intelligent\n'
+          '    Account: SIMXXXX\n'
+          '    Order#: 5-5733-7771')
+
+
+def email(subject, body, sym, **fields):
+    fields['sym'] = sym
+    return HEADER % (subject, sym) + body % fields
+
+
+CORPUS = [
+    # sample from the module docstring
+    email('Order has been filled', FILLED, 'TQQQ', order='Buy 300 TQQQ @ Market',
+          qty='300', price='65.2000'),
+    # tests/SendSig.py
+    email('Order has been filled', FILLED, 'SPY', order='Buy 25 SPY @ Market',
+          qty='25 ', price='65.2000'),
+    email('New order has been placed', PLACED, 'VXX', order='Sell Short 560 VXX @ Market'),
+    email('New order has been placed', PLACED, 'VXX', order='Buy to Cover 1,000 VXX @ Market'),
+    email('Order has been filled', FILLED, 'VXX', order='Sell 1,225 VXX @ Market',
+          qty='1,225', price='12.5'),
+    email('Order has been filled', FILLED, 'MESZ22', order='Buy 2 MESZ22 @ Market',
+          qty='2', price='3900.25'),
+    email('New order has been placed', PLACED, 'M2KH23', order='Sell 1 M2KH23 @ Market'),
+    email('Order has been filled', FILLED, 'GLD', order='Buy 10 GLD @ Limit',
+          qty='10', price='170'),
+    # crlf line endings as relayed by some mail servers
+    email('Order has been filled', FILLED, 'QQQ', order='Buy 5 QQQ @ Market',
+          qty='5', price='300.1').replace('\n', '\r\n'),
+    # odd spacing handled by the line based fallback
+    email('Order has been filled', FILLED, 'IWM', order='Buy  7 IWM @ Market',
+          qty='7', price='180.0'),
+    email('Order has been filled', FILLED, 'IWM', order='Buy 7 IWM @ Market Day',
+          qty='7', price='180.0'),
+    # incomplete or unrelated emails
+    email('Order has been filled', 'TradeStation - test message', 'SPY'),
+    'Subject: hello\n\nnot a signal',
+    '',
+]
+
+
+def compare():
+    mismatches = 0
+    for data in CORPUS:
+        legacy = TradeStationSignal(data, CONF)
+        fast = FastTradeStationSignal(data, CONF)
+        for attr in ATTRS:
+            if getattr(legacy, attr) != getattr(fast, attr):
+                mismatches += 1
+                print("MISMATCH %s: %r != %r in\n%s" %
+                      (attr, getattr(legacy, attr), getattr(fast, attr), data))
+    return mismatches
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) >= 2 else 20000
+
+    # both parsers print about unrecognized subjects, keep the output readable
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    mismatches = compare()
+    sys.stdout = stdout
+    print("%d emails compared, %d mismatches" % (len(CORPUS), mismatches))
+
+    data = CORPUS[0]
+    for cls in (TradeStationSignal, FastTradeStationSignal):
+        sec = timeit.timeit(lambda: cls(data, CONF), number=iterations)
+        print("%-24s %6.2f us/message" % (cls.__name__, sec / iterations * 1e6))
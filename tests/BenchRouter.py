@@ -0,0 +1,71 @@
+# This script checks that SigRouter picks and sizes the same orders as the
+# clients did on their own, and times both for 10, 100 and 500 accounts with
+# 20 symbol skip lists. 'per client' is every client scanning its skip list,
+# checking security_types and rounding its quantity, as before.
+# usage: python tests/BenchRouter.py [signals]
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sig_router
+from sig_config import client_sizing
+from sig_router import SigRouter
+
+SYMBOLS = ['SPY', 'QQQ', 'IWM', 'GLD', 'MSFT', 'TSLA', 'AAPL', 'AMZN', 'NVDA', 'META',
+           'XLF', 'XLE', 'TLT', 'HYG', 'EEM', 'EFA', 'VXX', 'USO', 'SLV', 'GDX']
+
+
+class Client(object):
+    def __init__(self, n, rnd):
+        self.name = "client %d" % n
+        self.conf = {
+            'sig_multiplier': rnd.choice([0.1, 0.25, 0.5, 1, 1.5, 2]),
+            'skip_list': rnd.sample(SYMBOLS, 20 if n % 2 else 0),
+            'security_types': rnd.choice([None, {'stk': 1}, {'fut': 1}, {'stk': 1, 'fut': 1}]),
+        }
+        self.sizing = client_sizing(self.conf)
+
+
+class Signal(object):
+    def __init__(self, symbol, sec_type, quantity):
+        self.symbol = symbol
+        self.sec_type = sec_type
+        self.quantity = quantity
+
+
+def per_client(clients, sig):
+    """What every client's process_order did with a list skip_list."""
+    orders = []
+    for c in clients:
+        if len(c.conf['skip_list']) and sig.symbol in c.conf['skip_list']:
+            continue
+        if c.conf['security_types'] and not c.conf['security_types'].get(sig.sec_type.lower()):
+            continue
+        orders.append((c, int(round(sig.quantity * c.conf['sig_multiplier']))))
+    return orders
+
+
+def routed(router, sig):
+    (clients, quantities) = router.route(sig)
+    return zip(clients, quantities)
+
+
+if __name__ == '__main__':
+    signals = int(sys.argv[1]) if len(sys.argv) >= 2 else 2000
+    rnd = random.Random(7)
+    sigs = [Signal(rnd.choice(SYMBOLS + ['ESZ9', 'DIA']), rnd.choice(['STK', 'FUT']),
+                   rnd.randint(1, 500)) for _ in range(signals)]
+
+    print("numpy: %s" % ('yes' if sig_router._numpy() is not None else 'no'))
+    print("%8s %16s %16s" % ('clients', 'per client us', 'router us'))
+    for n in (10, 100, 500):
+        clients = [Client(i, rnd) for i in range(n)]
+        router = SigRouter(clients)
+        for sig in sigs:
+            assert per_client(clients, sig) == routed(router, sig), sig.symbol
+
+        before = timeit.timeit(lambda: [per_client(clients, s) for s in sigs], number=1)
+        after = timeit.timeit(lambda: [router.route(s) for s in sigs], number=1)
+        print("%8d %16.1f %16.1f" % (n, before / signals * 1e6, after / signals * 1e6))
@@ -0,0 +1,101 @@
+# This script measures cold start time, from process start to every adapter
+# built, for 1, 10 and 100 configured IB and FIX clients. Each run is a fresh
+# process. 'legacy' builds the adapters of a revision from before sig_config
+# (given as legacy rev, taken with git archive), which parse ibsymbols.yml and
+# dict_4.2.json per adapter with the pure python yaml loader, 'no cache' goes
+# through sig_config with an empty binary cache and 'cached' with the cache
+# already built. Without a legacy rev, the legacy column is left out.
+# usage: python tests/BenchStartup.py [runs] [legacy rev]
+import time
+START_TIME = time.time()
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import subprocess
+from StringIO import StringIO
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+CLIENT_COUNTS = (1, 10, 100)
+LEGACY_FILES = ['ib_wrapper.py', 'sig_logger.py', 'fixapp']
+
+
+def legacy_sources(rev):
+    """Directory holding the adapters of rev, imported ahead of the current ones."""
+    archive = subprocess.check_output(['git', 'archive', rev] + LEGACY_FILES, cwd=ROOT)
+    legacy_dir = tempfile.mkdtemp(prefix='sigbridge-legacy-')
+    tarfile.open(fileobj=StringIO(archive)).extractall(legacy_dir)
+    return legacy_dir
+
+
+def legacy_start(n, legacy_dir):
+    sys.path.insert(0, legacy_dir)
+    import yaml
+    from ib_wrapper import IBWrapper
+    from fixapp.fix_translator import FixTranslator
+
+    # SigServer read both files itself
+    with open('conf/app.yml', 'r') as cf:
+        yaml.load(cf, Loader=yaml.FullLoader)
+    with open('conf/clients.yml', 'r') as cf:
+        yaml.load(cf, Loader=yaml.FullLoader)
+
+    for i in range(n):
+        IBWrapper({'server': 'localhost', 'port': 7496, 'client_id': i,
+                   'sig_multiplier': 1})
+        FixTranslator()
+
+
+def config_start(n):
+    import sig_config
+    from ib_wrapper import IBWrapper
+    from fixapp.fix_translator import FixTranslator
+
+    sig_config.app_conf()
+    sig_config.clients_conf()
+
+    for i in range(n):
+        IBWrapper({'server': 'localhost', 'port': 7496, 'client_id': i,
+                   'sig_multiplier': 1})
+        FixTranslator()
+
+
+def run_child(mode, n, *args):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   '--child', mode, str(n)] + list(args), cwd=ROOT)
+    return float(out.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == '--child':
+        os.chdir(ROOT)
+        if sys.argv[2] == 'legacy':
+            legacy_start(int(sys.argv[3]), sys.argv[4])
+        else:
+            config_start(int(sys.argv[3]))
+        print(time.time() - START_TIME)
+        sys.exit(0)
+
+    runs = int(sys.argv[1]) if len(sys.argv) >= 2 else 5
+    legacy_rev = sys.argv[2] if len(sys.argv) >= 3 else None
+    cache_dir = os.path.join(ROOT, 'cache')
+    legacy_dir = legacy_sources(legacy_rev) if legacy_rev else None
+
+    print("%8s %12s %12s %12s" % ('clients', 'legacy ms', 'no cache ms', 'cached ms'))
+    for n in CLIENT_COUNTS:
+        legacy = None
+        if legacy_dir:
+            legacy = min(run_child('legacy', n, legacy_dir) for _ in range(runs)) * 1000
+        cold = []
+        for _ in range(runs):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            cold.append(run_child('config', n))
+        cached = min(run_child('config', n) for _ in range(runs))
+        print("%8d %12s %12.1f %12.1f" % (n, '%.1f' % legacy if legacy else '-',
+                                          min(cold) * 1000, cached * 1000))
+    if legacy_dir:
+        shutil.rmtree(legacy_dir, ignore_errors=True)
@@ -0,0 +1,184 @@
+# This script is a FIX 4.2 acceptor standing in for the counterparty of
+# FixProcessor. It accepts the FixWrapper session logon and answers every
+# NewOrderSingle with ExecutionReports, New and then Filled. Latency, jitter,
+# pacing rejections (OrdStatus Rejected) and dropped sessions are set on the
+# command line, see tests/SimBroker.py.
+#
+# usage: python tests/FixSim.py [--cfg tests/FixSim.cfg] [--port 9878] [--latency ms] ..., see --help
+# then add a FIX client with fix_cfg_path: './tests/FixSimClient.cfg' to conf/clients.yml.
+import os
+import re
+import time
+import signal
+import tempfile
+import argparse
+from threading import Lock
+
+import quickfix as fix
+
+import SimBroker
+
+
+class FixSimApp(fix.Application):
+
+    def __init__(self, args):
+        super(FixSimApp, self).__init__()
+        self.args = args
+        self.conditions = SimBroker.BrokerConditions(args)
+        self.lock = Lock()
+        self.order_id = 0
+        self.exec_id = 0
+        self.stats = {'orders': 0, 'paced': 0, 'filled': 0, 'disconnects': 0, 'refused logons': 0}
+
+    def log(self, msg):
+        print("%s %s" % (time.strftime('%H:%M:%S'), msg))
+
+    def onCreate(self, sessionID):
+        self.log("session " + sessionID.toString())
+
+    def onLogon(self, sessionID):
+        self.log("logon " + sessionID.toString())
+
+    def onLogout(self, sessionID):
+        self.log("logout " + sessionID.toString())
+
+    def toAdmin(self, message, sessionID):
+        pass
+
+    def fromAdmin(self, message, sessionID):
+        msg_type = message.getHeader().getField(fix.MsgType().getField())
+        if msg_type == fix.MsgType_Logon and self.conditions.is_down():
+            with self.lock:
+                self.stats['refused logons'] += 1
+            raise fix.RejectLogon("simulated outage")
+
+    def toApp(self, message, sessionID):
+        pass
+
+    def fromApp(self, message, sessionID):
+        msg_type = message.getHeader().getField(fix.MsgType().getField())
+        if msg_type == fix.MsgType_NewOrderSingle:
+            self.new_order(message, sessionID)
+
+    def new_order(self, message, sessionID):
+        order = {
+            'cl_ord_id': message.getField(fix.ClOrdID().getField()),
+            'symbol': message.getField(fix.Symbol().getField()),
+            'side': message.getField(fix.Side().getField()),
+            'quantity': float(message.getField(fix.OrderQty().getField())),
+        }
+        with self.lock:
+            self.stats['orders'] += 1
+            paced = self.conditions.paced()
+            if paced:
+                self.stats['paced'] += 1
+            else:
+                self.order_id += 1
+                order['order_id'] = str(self.order_id)
+            drop = self.conditions.order_received()
+
+        if self.args.verbose:
+            self.log("order %s: side %s %g %s %s" % (order['cl_ord_id'], order['side'],
+                     order['quantity'], order['symbol'], 'paced' if paced else 'accepted'))
+        if paced:
+            order['order_id'] = 'NONE'
+            self.send_report(sessionID, order, fix.ExecType_REJECTED, fix.OrdStatus_REJECTED,
+                             text="Order rate exceeded, max %d per second" % self.args.max_rate)
+        else:
+            self.conditions.scheduler.call_later(self.conditions.ack_delay(),
+                                                 self.acknowledge, sessionID, order)
+        if drop:
+            with self.lock:
+                self.stats['disconnects'] += 1
+            self.log("dropping session after order " + order['cl_ord_id'])
+            session = fix.Session.lookupSession(sessionID)
+            if session:
+                session.logout("simulated disconnect")
+                # logout leaves the session disabled, allow logons again once it's out
+                self.conditions.scheduler.call_later(0.5, session.logon)
+
+    def acknowledge(self, sessionID, order):
+        self.send_report(sessionID, order, fix.ExecType_NEW, fix.OrdStatus_NEW)
+        if not self.args.no_fill:
+            self.conditions.scheduler.call_later(self.conditions.fill_delay(),
+                                                 self.fill, sessionID, order)
+
+    def fill(self, sessionID, order):
+        with self.lock:
+            self.stats['filled'] += 1
+        price = round(self.args.fill_price * (1 + self.conditions.rnd.uniform(-0.001, 0.001)), 2)
+        self.send_report(sessionID, order, fix.ExecType_FILL, fix.OrdStatus_FILLED, price=price)
+
+    def send_report(self, sessionID, order, exec_type, ord_status, price=None, text=None):
+        with self.lock:
+            self.exec_id += 1
+            exec_id = str(self.exec_id)
+        filled = price is not None
+        msg = fix.Message()
+        header = msg.getHeader()
+        header.setField(fix.BeginString(fix.BeginString_FIX42))
+        header.setField(fix.MsgType(fix.MsgType_ExecutionReport))
+        msg.setField(fix.OrderID(order['order_id']))
+        msg.setField(fix.ExecID(exec_id))
+        msg.setField(fix.ExecTransType(fix.ExecTransType_NEW))
+        msg.setField(fix.ExecType(exec_type))
+        msg.setField(fix.OrdStatus(ord_status))
+        msg.setField(fix.ClOrdID(order['cl_ord_id']))
+        msg.setField(fix.Symbol(order['symbol']))
+        msg.setField(fix.Side(order['side']))
+        msg.setField(fix.OrderQty(order['quantity']))
+        msg.setField(fix.LeavesQty(0 if filled or text else order['quantity']))
+        msg.setField(fix.CumQty(order['quantity'] if filled else 0))
+        msg.setField(fix.AvgPx(price or 0))
+        if filled:
+            msg.setField(fix.LastShares(order['quantity']))
+            msg.setField(fix.LastPx(price))
+        if text:
+            msg.setField(fix.Text(text))
+        fix.Session.sendToTarget(msg, sessionID)
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()   # print the stats on kill as on ctrl-c
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated FIX 4.2 counterparty for FixProcessor.')
+    parser.add_argument('--cfg', default='tests/FixSim.cfg', help='acceptor session settings')
+    parser.add_argument('--port', type=int, help='overrides SocketAcceptPort of the settings')
+    parser.add_argument('--fill-price', type=float, default=100, help='price orders fill around')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every order')
+    SimBroker.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.port:
+        # every session copies the port when the settings are read, so it's
+        # replaced in a copy of the file rather than in the settings
+        with open(args.cfg) as f:
+            cfg = re.sub(r'(?m)^SocketAcceptPort=.*$', 'SocketAcceptPort=%d' % args.port, f.read())
+        (fd, cfg_path) = tempfile.mkstemp(suffix='.cfg')
+        os.write(fd, cfg)
+        os.close(fd)
+        settings = fix.SessionSettings(cfg_path)
+        os.remove(cfg_path)
+    else:
+        settings = fix.SessionSettings(args.cfg)
+
+    app = FixSimApp(args)
+    acceptor = fix.SocketAcceptor(app, fix.MemoryStoreFactory(), settings,
+                                  fix.FileLogFactory(settings))
+    acceptor.start()
+    app.log("FIX simulator listening on port %d" % (args.port or settings.get().getInt('SocketAcceptPort')))
+
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    acceptor.stop()
+    app.log(', '.join('%s: %d' % kv for kv in sorted(app.stats.items())))
+
+
+if __name__ == '__main__':
+    main()
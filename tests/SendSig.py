@@ -1,77 +1,290 @@
-# This script is used to simulate order notification emails coming from TradeStation
-from smtplib import SMTP
-from email.mime.text import MIMEText
+# This script simulates order notification emails coming from TradeStation.
+# Without options it sends a single SPY fill. It doubles as a load generator:
+# signals are sent at a given rate, in bursts, over concurrent SMTP connections,
+# with a mix of stock and futures symbols, buy/sell, placed/filled and duplicate
+# emails, and a json report of the run is written for comparing releases.
+#
+# usage: python tests/SendSig.py [host:port] [options], see --help
+#
+# e.g. 2000 signals at 200/s in bursts of 10 over 8 connections, including the
+# bridge's own ingress to dispatch latency (sig_daemon.py's pid, run from the
+# same directory as the bridge so that logs/latency.json is found):
+#   python tests/SendSig.py localhost:25 -n 2000 -r 200 -b 10 -c 8 --pid 1234 --report run.json
+import os
 import sys
+import json
 import time
+import random
+import signal
 import socket
+import argparse
+from Queue import Queue
+from threading import Thread, Lock
+from smtplib import SMTP, SMTPException
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sig_tracer import LatencyHistogram
+
+STOCKS = ['SPY', 'QQQ', 'IWM', 'GLD', 'VXX', 'TQQQ']
+FUTURES = ['ESZ24', 'MESH25', 'NQM25', 'RTYU25']
+BUY_ACTIONS = ['Buy', 'Buy to Cover']
+SELL_ACTIONS = ['Sell', 'Sell Short']
+
+FILLED = ('TradeStation - Order has been filled for %(sym)s\n'
+          '   Order: %(action)s %(qty)s %(sym)s @ Market\n'
+          '   Qty Filled: %(qty)s \n'
+          '   Filled Price: %(price).4f\n'
+          '   Duration: Day\n'
+          '   Route: Intelligent\n'
+          '   Account: SIMXXXX\n'
+          '   Order#: %(order_id)s')
+
+PLACED = ('TradeStation - New order has been placed for %(sym)s\n'
+          '   Order: %(action)s %(qty)s %(sym)s @ Market\n'
+          '   Duration: Day\n'
+          '   Route: Intelligent\n'
+          '   Account: SIMXXXX\n'
+          '   Order#: %(order_id)s')
+
+FROM_ADDR = 'from@tester.net'
+TO_ADDR = 'test@receiver.com'
+
+
+class SignalMix:
+    """Generates the signal emails of a run."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.sent = []  # fields of sent signals, for duplicates
+
+    def next(self, i):
+        """(kind, subject, body) of the i-th signal."""
+        args, rnd = self.args, self.rnd
+        if self.sent and rnd.random() < args.duplicates:
+            fields = rnd.choice(self.sent)
+            kind = 'duplicate'
+        else:
+            futures = rnd.random() < args.futures
+            fields = {
+                'sym': rnd.choice(FUTURES if futures else STOCKS),
+                'action': rnd.choice(BUY_ACTIONS if rnd.random() < 0.5 else SELL_ACTIONS),
+                'qty': args.quantity if args.count == 1 else rnd.randint(1, 500),
+                'price': rnd.uniform(10, 500),
+                'order_id': '5-%04d-%04d' % (os.getpid() % 10000, i),
+                'placed': rnd.random() < args.placed,
+            }
+            self.sent.append(fields)
+            kind = 'placed' if fields['placed'] else 'filled'
+
+        if fields['placed']:
+            subject = 'TradeStation - New order has been placed for ' + fields['sym']
+            body = PLACED % fields
+        else:
+            subject = 'TradeStation - Order has been filled for ' + fields['sym']
+            body = FILLED % fields
+        return (kind, subject, body)
+
+
+class LoadRun:
+
+    def __init__(self, args):
+        self.args = args
+        (self.host, self.port) = (args.server.split(':') + ['25'])[:2]
+        self.port = int(self.port)
+        self.jobs = Queue(maxsize=args.connections * 4)
+        self.lock = Lock()
+        self.latencies = []     # smtp send time of accepted signals, in seconds
+        self.kinds = {}         # signal kind -> accepted count
+        self.rejected = 0       # refused by the bridge, e.g. ingress queue full
+        self.errors = 0         # connection errors and timeouts
+        self.first_error = None
+
+    def connect(self):
+        return SMTP(self.host, self.port, timeout=self.args.timeout)
+
+    def worker(self):
+        """Sends the queued signals over one smtp connection, reconnecting on errors."""
+        conn = None
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            (kind, subject, body) = job
+
+            msg = MIMEText(body)
+            msg['Subject'] = subject
+            msg['From'] = FROM_ADDR
+            msg['To'] = TO_ADDR
+            msg['Date'] = formatdate()
+
+            start = time.time()
+            try:
+                if conn is None:
+                    conn = self.connect()
+                conn.sendmail(FROM_ADDR, [TO_ADDR], msg.as_string())
+                elapsed = time.time() - start
+                with self.lock:
+                    self.latencies.append(elapsed)
+                    self.kinds[kind] = self.kinds.get(kind, 0) + 1
+            except SMTPException as e:
+                with self.lock:
+                    self.rejected += 1
+                    self.first_error = self.first_error or str(e)
+                conn = self.reset(conn)
+            except (socket.error, socket.timeout) as e:
+                with self.lock:
+                    self.errors += 1
+                    self.first_error = self.first_error or str(e)
+                conn = self.reset(conn)
+        if conn:
+            try:
+                conn.quit()
+            except (SMTPException, socket.error):
+                pass
+
+    @staticmethod
+    def reset(conn):
+        if conn:
+            try:
+                conn.close()
+            except socket.error:
+                pass
+        return None
+
+    def run(self):
+        """Queue the signals at the requested rate and wait for all to be sent."""
+        args = self.args
+        workers = [Thread(target=self.worker) for _ in range(args.connections)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        mix = SignalMix(args)
+        interval = float(args.burst) / args.rate if args.rate else 0
+        start = time.time()
+        for i in range(args.count):
+            if interval and i % args.burst == 0:
+                # bursts start on a fixed schedule, so a slow bridge doesn't lower the rate
+                wait = start + (i // args.burst) * interval - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self.jobs.put(mix.next(i))
+        for w in workers:
+            self.jobs.put(None)
+        for w in workers:
+            w.join()
+        self.duration = time.time() - start
+
+
+def percentiles(values):
+    """Exact percentiles of the client side latencies, in ms."""
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda pct: values[min(len(values) - 1, int(len(values) * pct / 100.0))] * 1000
+    return {'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': values[-1] * 1000,
+            'mean': sum(values) / len(values) * 1000}
+
+
+def bridge_snapshot(pid, path, timeout=5):
+    """Ask the bridge to save its latency histograms and read them back."""
+    old_mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+    os.kill(pid, signal.SIGUSR1)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.isfile(path) and os.path.getmtime(path) != old_mtime:
+            with open(path) as f:
+                return json.load(f)['stages']
+        time.sleep(0.05)
+    raise RuntimeError("no latency snapshot from pid %d in %s" % (pid, path))
+
+
+def bridge_latency(before, after):
+    """Percentiles per stage of the signals recorded between the two snapshots, in ms."""
+    stages = {}
+    for (name, snap) in after.items():
+        hist = LatencyHistogram.from_snapshot(snap)
+        if name in before:
+            for (upper, count) in before[name]['buckets']:
+                index = LatencyHistogram.bucket_index(upper)
+                hist.counts[index] -= count
+            hist.count -= before[name]['count']
+            hist.total -= before[name]['total_us']
+        if hist.count <= 0:
+            continue
+        stages[name] = {'count': hist.count,
+                        'p50': hist.percentile(50) / 1e3, 'p90': hist.percentile(90) / 1e3,
+                        'p99': hist.percentile(99) / 1e3, 'mean': hist.total / 1e3 / hist.count}
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send simulated TradeStation signals.')
+    parser.add_argument('server', nargs='?', default='localhost:25', help='bridge host:port')
+    parser.add_argument('-n', '--count', type=int, default=1, help='signals to send')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='signals per second, 0 for no limit')
+    parser.add_argument('-b', '--burst', type=int, default=1, help='signals sent back to back')
+    parser.add_argument('-c', '--connections', type=int, default=1, help='concurrent smtp connections')
+    parser.add_argument('--futures', type=float, default=0.2, help='share of futures symbols')
+    parser.add_argument('--placed', type=float, default=0.3, help='share of "new order placed" emails')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='share of resent signals')
+    parser.add_argument('--quantity', type=int, default=25, help='quantity of a single signal')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the signal mix')
+    parser.add_argument('--timeout', type=float, default=30, help='smtp timeout in seconds')
+    parser.add_argument('--pid', type=int, help='pid of sig_daemon.py, to include its latencies')
+    parser.add_argument('--drain', type=float, default=1, help='seconds to wait for the bridge after sending')
+    parser.add_argument('--snapshot', default='logs/latency.json', help="bridge's latency snapshot")
+    parser.add_argument('--report', help='write the json report to this file')
+    args = parser.parse_args()
+
+    if args.count == 1:
+        # a single SPY fill, as this script always sent
+        args.futures = args.placed = args.duplicates = 0
+
+    before = bridge_snapshot(args.pid, args.snapshot) if args.pid else None
+    load = LoadRun(args)
+    load.run()
+    after = None
+    if args.pid:
+        # let the bridge drain what it accepted before reading its latencies
+        time.sleep(args.drain)
+        after = bridge_snapshot(args.pid, args.snapshot)
+
+    accepted = len(load.latencies)
+    report = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'options': vars(args),
+        'sent': args.count,
+        'accepted': accepted,
+        'accepted_by_kind': load.kinds,
+        'rejected': load.rejected,
+        'errors': load.errors,
+        'first_error': load.first_error,
+        'duration_sec': load.duration,
+        'accepted_per_sec': accepted / load.duration if load.duration else 0,
+        'smtp_latency_ms': percentiles(load.latencies),
+    }
+    if before is not None:
+        report['bridge_latency_ms'] = bridge_latency(before, after)
+
+    print("sent %d, accepted %d (%.1f/s), rejected %d, errors %d in %.2f sec" %
+          (args.count, accepted, report['accepted_per_sec'], load.rejected,
+           load.errors, load.duration))
+    if load.first_error:
+        print("first error: " + load.first_error)
+    for (name, value) in sorted(report['smtp_latency_ms'].items()):
+        print("  smtp %-4s %8.2f ms" % (name, value))
+    for (name, stage) in sorted(report.get('bridge_latency_ms', {}).items()):
+        print("  %-40s n=%d p50=%.2f p90=%.2f p99=%.2f ms" %
+              (name, stage['count'], stage['p50'], stage['p90'], stage['p99']))
 
-server = 'localhost'
-port = 25
-smtp_server = None
-
-def send(quantity=2):
-    global server
-    global port
-    global smtp_server
-    if len(sys.argv) >= 2:
-        [server, port] = sys.argv[1].split(":")
-        
-    try:
-        smtp_server = SMTP(server, port, timeout=30)
-    except socket.timeout:
-        print "Error: server connection timed out."
-        sys.exit()
-    except socket.gaierror:
-        print "Error: unknown server name:", server
-        sys.exit()
-    except socket.error:
-        print "Error: Connection refused for", server
-        sys.exit()
-
-    fromaddr = 'from@tester.net'
-    toaddr = 'test@receiver.com'
-    # 4 types of order message?
-    # body = ('TradeStation - New order has been placed for VXX\n'
-    """
-    body = ('TradeStation - Order has been filled for VXX\n'
-            #'        Order: Sell 225 VXX @ Market\n'
-            #'        Order: Buy 225 VXX @ Market\n'
-            #'        Order: Sell 1000 VXX @ Market\n'
-            #'        Order: Sell Short 560 VXX @ Market\n'
-            '        Order: Buy to Cover 100 VXX @ Market\n'
-            '        Qty Filled: 50\n'
-            #'        Entered: 1/6/2017 12:59:01 PM\n'
-            '        Duration: Day\n'
-            '        Route: Intelligent\n'
-            '        Account: SIM524807M\n'
-            '        Order#: 4-4060-7888')
-    """
-    body = ('TradeStation - Order has been filled for SPY\n'
-             '   Order: Buy %s SPY @ Market\n'
-             '   Qty Filled: %s \n'
-             '   Filled Price: 65.2000\n'
-             '   Duration: Day\n'
-             '   Route: Intelligent\n'
-             '   Account: SIMXXXX\n'
-             '   Order#: 5-5733-7770')
-
-    msg = MIMEText(body % (str(quantity), str(quantity)))
-    # msg['Subject'] = 'TradeStation - New order has been placed for VXX'
-    msg['Subject'] = 'TradeStation - Order has been filled for SPY'
-    msg['From'] = 'samhalim@roadrunner.com'
-    msg['To'] = ','.join([toaddr])
-
-    try:
-        smtp_server.sendmail(fromaddr, [toaddr], msg.as_string())
-        # time.sleep(1)
-        smtp_server.quit()
-    except:
-        print "toaddr", toaddr, " has unexpected error:", sys.exc_info()[0]
-        print sys.exc_info()[1]
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
 
 
 if __name__ == '__main__':
-    quantity = 25
-    for i in range(1):
-        print("sending %d" % i)
-        send(quantity + i)
+    main()
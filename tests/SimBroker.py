@@ -0,0 +1,109 @@
+# Broker conditions shared by the TWS and FIX simulators (tests/TwsSim.py and
+# tests/FixSim.py): response latency and jitter, pacing rejections and
+# disconnects, plus a timer thread to send the delayed responses from.
+import time
+import heapq
+import random
+from threading import Thread, Condition
+
+
+def add_arguments(parser):
+    """Command line options of the simulated broker conditions."""
+    parser.add_argument('--latency', type=float, default=5, help='ms until an order is acknowledged')
+    parser.add_argument('--jitter', type=float, default=0, help='random ms added to every response')
+    parser.add_argument('--fill-delay', type=float, default=20, help='ms from acknowledgement to fill')
+    parser.add_argument('--no-fill', action='store_true', help='acknowledge orders but never fill them')
+    parser.add_argument('--max-rate', type=float, default=50,
+                        help='orders per second on a connection before pacing rejections, 0 for no limit')
+    parser.add_argument('--disconnect-every', type=int, default=0,
+                        help='drop the connection after every n orders, 0 to never')
+    parser.add_argument('--down-time', type=float, default=0,
+                        help='seconds new connections are refused after a drop')
+    parser.add_argument('--seed', type=int, help='random seed of the jitter')
+
+
+class Scheduler(object):
+    """Runs callbacks at a given time on a single timer thread."""
+
+    def __init__(self):
+        self.events = []    # heap of (time, seq, callback, args)
+        self.seq = 0
+        self.cond = Condition()
+        thread = Thread(target=self.run, name="sim-scheduler")
+        thread.daemon = True
+        thread.start()
+
+    def call_later(self, delay, callback, *args):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.events, (time.time() + delay, self.seq, callback, args))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.events or self.events[0][0] > time.time():
+                    self.cond.wait(self.events[0][0] - time.time() if self.events else None)
+                (_, _, callback, args) = heapq.heappop(self.events)
+            try:
+                callback(*args)
+            except Exception as e:
+                print("scheduled response failed: %s" % e)
+
+
+class Pacer(object):
+    """Token bucket of the pacing limit of one connection."""
+
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self.tokens = max_rate
+        self.last_refill = time.time()
+
+    def paced(self):
+        """True if the order exceeds the pacing limit and must be rejected."""
+        if not self.max_rate:
+            return False
+        now = time.time()
+        self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.max_rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+
+class BrokerConditions(object):
+    """Decides how the simulated broker treats each order."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.scheduler = Scheduler()
+        self.pacer = Pacer(args.max_rate)
+        self.orders = 0
+        self.down_until = 0
+
+    def delay(self, ms):
+        """Seconds to wait for a response that takes ms plus jitter."""
+        return (ms + self.rnd.uniform(0, self.args.jitter)) / 1000.0
+
+    def ack_delay(self):
+        return self.delay(self.args.latency)
+
+    def fill_delay(self):
+        return self.delay(self.args.fill_delay)
+
+    def paced(self):
+        """Pacing of a broker with a single connection, see Pacer."""
+        return self.pacer.paced()
+
+    def order_received(self):
+        """Count an order, True if the connection should be dropped after it."""
+        self.orders += 1
+        if self.args.disconnect_every and self.orders % self.args.disconnect_every == 0:
+            self.down_until = time.time() + self.args.down_time
+            return True
+        return False
+
+    def is_down(self):
+        return time.time() < self.down_until
@@ -0,0 +1,406 @@
+# This script is a stand-in for TWS / IB Gateway to run IBWrapper against.
+# It speaks enough of the IB API socket protocol to hand out the next valid
+# order id and the managed account on connect, accept placeOrder, cancelOrder,
+# reqIds, reqAccountUpdates and reqContractDetails, and answer orders with
+# orderStatus (Submitted, then Filled) and execDetails. Latency, jitter, pacing
+# rejections (error 100), dropped connections and symbols that are ambiguous
+# or unknown to contract details requests are set on the command line.
+#
+# usage: python tests/TwsSim.py [--port 7496] [--latency ms] [--jitter ms] ..., see --help
+# then point an IB client in conf/clients.yml at localhost and that port.
+# With --expect N, it exits with 1 unless N orders were filled by the time it's
+# stopped, e.g. that no order is lost to pacing with a --max-rate below the
+# client's max_rate.
+import sys
+import time
+import zlib
+import signal
+import socket
+import argparse
+from threading import Lock
+from SocketServer import ThreadingMixIn, TCPServer, BaseRequestHandler
+
+from ib.ext.EClientSocket import EClientSocket
+from ib.ext.ExecutionFilter import ExecutionFilter
+from ib.ext.Contract import Contract
+from ib.ext.Order import Order
+
+import SimBroker
+
+SERVER_VERSION = 60     # has conId in placeOrder, accepted by ibpy (>= 38)
+
+# incoming message ids
+PLACE_ORDER = 3
+CANCEL_ORDER = 4
+REQ_ACCOUNT_DATA = 6
+REQ_IDS = 8
+REQ_CONTRACT_DATA = 9
+
+# outgoing message ids
+ORDER_STATUS = 3
+ERR_MSG = 4
+ACCT_VALUE = 6
+NEXT_VALID_ID = 9
+CONTRACT_DATA = 10
+EXECUTION_DATA = 11
+MANAGED_ACCTS = 15
+CONTRACT_DATA_END = 52
+
+ACCOUNT_KEYS = [('NetLiquidation', '1000000.00'), ('BuyingPower', '4000000.00'),
+                ('AvailableFunds', '1000000.00'), ('GrossPositionValue', '0.00')]
+
+
+class _FieldCapture(object):
+    """Stands in for ibpy's output stream, collecting the fields it writes."""
+
+    def __init__(self):
+        self.fields = []
+        self.field = ''
+
+    def write(self, data):
+        if data == 0:
+            self.fields.append(self.field)
+            self.field = ''
+        else:
+            self.field += data
+
+
+def _capture(server_version, request, *args):
+    client = EClientSocket(None)
+    client.m_connected = True
+    client.m_serverVersion = server_version
+    client.m_dos = _FieldCapture()
+    getattr(client, request)(*args)
+    return client.m_dos.fields
+
+
+def request_layouts(server_version):
+    """
+    Fields per client request at the server version, as ibpy sends them, and
+    the position of each placeOrder and reqContractDetails field read by the
+    simulator. Requests are
+    not length prefixed, so this is what frames them on the socket. Combo
+    (BAG) and other optional order attributes are not supported.
+    """
+    contract = Contract()
+    contract.m_symbol = '@SYM@'
+    contract.m_secType = '@SEC@'
+    contract.m_localSymbol = '@LOCAL@'
+    contract.m_exchange = '@EXCH@'
+    contract.m_currency = '@CURR@'
+    contract.m_conId = 4242 if server_version >= EClientSocket.MIN_SERVER_VER_PLACE_ORDER_CONID else 0
+    order = Order()
+    order.m_action = '@ACTION@'
+    order.m_totalQuantity = 424242
+    order.m_orderType = '@TYPE@'
+
+    requests = [('placeOrder', (77, contract, order)), ('cancelOrder', (1,)),
+                ('reqIds', (1,)), ('reqAccountUpdates', (True, '')),
+                ('reqOpenOrders', ()), ('reqAllOpenOrders', ()), ('reqAutoOpenOrders', (True,)),
+                ('reqExecutions', (1, ExecutionFilter())), ('reqContractDetails', (1, contract)),
+                ('reqMktData', (1, contract, '', False)), ('cancelMktData', (1,)),
+                ('reqCurrentTime', ()), ('reqManagedAccts', ())]
+    counts = {}
+    for (request, args) in requests:
+        fields = _capture(server_version, request, *args)
+        counts[int(fields[0])] = len(fields)
+
+    fields = _capture(server_version, 'placeOrder', 77, contract, order)
+    positions = {'order_id': fields.index('77'), 'symbol': fields.index('@SYM@'),
+                 'sec_type': fields.index('@SEC@'), 'local_symbol': fields.index('@LOCAL@'),
+                 'exchange': fields.index('@EXCH@'), 'action': fields.index('@ACTION@'),
+                 'quantity': fields.index('424242'), 'order_type': fields.index('@TYPE@')}
+    if contract.m_conId:
+        positions['con_id'] = fields.index('4242')
+
+    fields = _capture(server_version, 'reqContractDetails', 4343, contract)
+    details_positions = {'req_id': fields.index('4343'), 'symbol': fields.index('@SYM@'),
+                         'sec_type': fields.index('@SEC@'), 'local_symbol': fields.index('@LOCAL@'),
+                         'exchange': fields.index('@EXCH@'), 'currency': fields.index('@CURR@')}
+    return (counts, positions, details_positions)
+
+
+class TwsSession(BaseRequestHandler):
+    """One API client connection."""
+
+    def setup(self):
+        # replies go out as they are sent, like the latency asked for
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sim = self.server
+        self.lock = Lock()
+        self.buf = ''
+        self.closed = False
+        self.client_id = None
+        self.pacer = SimBroker.Pacer(self.sim.args.max_rate)   # TWS paces every connection on its own
+        self.account = None
+        self.account_updates = False
+
+    def read_field(self):
+        while '\0' not in self.buf:
+            data = self.request.recv(4096)
+            if not data:
+                raise EOFError()
+            self.buf += data
+        (field, self.buf) = self.buf.split('\0', 1)
+        return field
+
+    def send(self, *fields):
+        """Send a message, ignored once the connection is gone."""
+        data = ''.join(str(f) + '\0' for f in fields)
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.request.sendall(data)
+            except socket.error:
+                self.closed = True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle(self):
+        if self.sim.conditions.is_down():
+            return  # refused like a TWS that is restarting
+
+        try:
+            self.read_field()   # client version
+            self.send(SERVER_VERSION, time.strftime('%Y%m%d %H:%M:%S EST'))
+            self.client_id = int(self.read_field())
+            self.account = 'DU%06d' % self.client_id
+            self.sim.log("client %d connected from %s" % (self.client_id, self.client_address[0]))
+            self.send(NEXT_VALID_ID, 1, self.sim.next_valid_id(self.client_id))
+            self.send(MANAGED_ACCTS, 1, self.account)
+
+            while not self.closed:
+                msg_id = int(self.read_field())
+                count = self.sim.request_counts.get(msg_id)
+                if count is None:
+                    self.sim.log("client %d sent unsupported message %d, closing" % (self.client_id, msg_id))
+                    break
+                fields = [msg_id] + [self.read_field() for _ in range(count - 1)]
+                self.process(msg_id, fields)
+        except (EOFError, socket.error, ValueError):
+            pass
+        self.close()
+        self.sim.log("client %s disconnected" % self.client_id)
+
+    def process(self, msg_id, fields):
+        if msg_id == PLACE_ORDER:
+            self.place_order(fields)
+        elif msg_id == CANCEL_ORDER:
+            self.sim.cancel_order(self, int(fields[2]))
+        elif msg_id == REQ_CONTRACT_DATA:
+            pos = self.sim.details_positions
+            self.sim.contract_details(self, dict((name, fields[i]) for (name, i) in pos.items()))
+        elif msg_id == REQ_IDS:
+            self.send(NEXT_VALID_ID, 1, self.sim.next_valid_id(self.client_id))
+        elif msg_id == REQ_ACCOUNT_DATA:
+            subscribe = fields[2] not in ('0', 'false', 'False', '')
+            if subscribe and not self.account_updates:
+                self.sim.conditions.scheduler.call_later(0, self.send_account_values, 0)
+            self.account_updates = subscribe
+
+    def place_order(self, fields):
+        pos = self.sim.positions
+        order = dict((name, fields[i]) for (name, i) in pos.items())
+        order['order_id'] = int(order['order_id'])
+        order['quantity'] = int(float(order['quantity'] or 0))
+        self.sim.place_order(self, order)
+
+    def send_account_values(self, i):
+        """Stream account values at --account-rate while subscribed."""
+        if self.closed or not self.account_updates:
+            return
+        (key, value) = ACCOUNT_KEYS[i % len(ACCOUNT_KEYS)]
+        self.send(ACCT_VALUE, 2, key, value, 'USD', self.account)
+        self.sim.conditions.scheduler.call_later(1.0 / self.sim.args.account_rate,
+                                                 self.send_account_values, i + 1)
+
+
+class TwsSim(ThreadingMixIn, TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, args):
+        self.args = args
+        self.conditions = SimBroker.BrokerConditions(args)
+        (self.request_counts, self.positions, self.details_positions) = request_layouts(SERVER_VERSION)
+        self.lock = Lock()
+        self.used_ids = {}      # client id -> highest order id used
+        self.open_orders = {}   # (client id, order id) -> order
+        self.perm_id = 1000
+        self.exec_id = 0
+        self.stats = {'orders': 0, 'paced': 0, 'duplicate ids': 0, 'filled': 0,
+                      'cancelled': 0, 'disconnects': 0, 'contract requests': 0,
+                      'orders by conId': 0}
+        TCPServer.__init__(self, ('0.0.0.0', args.port), TwsSession)
+
+    def log(self, msg):
+        print("%s %s" % (time.strftime('%H:%M:%S'), msg))
+
+    def next_valid_id(self, client_id):
+        with self.lock:
+            return self.used_ids.get(client_id, 0) + 1
+
+    def place_order(self, session, order):
+        order_id = order['order_id']
+        with self.lock:
+            self.stats['orders'] += 1
+            if order_id <= self.used_ids.get(session.client_id, 0):
+                self.stats['duplicate ids'] += 1
+                error = (103, "Duplicate order id")
+            elif session.pacer.paced():
+                self.stats['paced'] += 1
+                error = (100, "Max rate of messages per second has been exceeded:max=%d" %
+                         self.args.max_rate)
+            else:
+                error = None
+                self.used_ids[session.client_id] = order_id
+                self.perm_id += 1
+                order['perm_id'] = self.perm_id
+                self.open_orders[(session.client_id, order_id)] = order
+                if int(order.get('con_id') or 0):
+                    self.stats['orders by conId'] += 1
+            drop = self.conditions.order_received()
+
+        if self.args.verbose:
+            self.log("client %d order %d: %s %d %s %s" % (
+                     session.client_id, order_id, order['action'], order['quantity'],
+                     order['symbol'] or order['local_symbol'], error[1] if error else 'accepted'))
+        if error:
+            session.send(ERR_MSG, 2, order_id, error[0], error[1])
+        else:
+            self.conditions.scheduler.call_later(self.conditions.ack_delay(),
+                                                 self.acknowledge, session, order)
+        if drop:
+            with self.lock:
+                self.stats['disconnects'] += 1
+            self.log("dropping client %d after order %d" % (session.client_id, order_id))
+            session.close()
+
+    def acknowledge(self, session, order):
+        session.send(ORDER_STATUS, 6, order['order_id'], 'Submitted', 0, order['quantity'],
+                     0, order['perm_id'], 0, 0, session.client_id, '')
+        if not self.args.no_fill:
+            self.conditions.scheduler.call_later(self.conditions.fill_delay(),
+                                                 self.fill, session, order)
+
+    def fill(self, session, order):
+        with self.lock:
+            if self.open_orders.pop((session.client_id, order['order_id']), None) is None:
+                return  # cancelled
+            self.exec_id += 1
+            exec_id = '0000e0d5.%08x.01.01' % self.exec_id
+            self.stats['filled'] += 1
+        price = round(self.args.fill_price * (1 + self.conditions.rnd.uniform(-0.001, 0.001)), 2)
+        qty = order['quantity']
+        side = 'BOT' if order['action'].upper() == 'BUY' else 'SLD'
+        session.send(EXECUTION_DATA, 9, -1, order['order_id'], order.get('con_id', 0),
+                     order['symbol'], order['sec_type'], '', 0, '', '',
+                     order['exchange'], 'USD', order['local_symbol'] or order['symbol'],
+                     exec_id, time.strftime('%Y%m%d  %H:%M:%S'), session.account,
+                     order['exchange'], side, qty, price, order['perm_id'], session.client_id,
+                     0, qty, price, '', '', 0)
+        session.send(ORDER_STATUS, 6, order['order_id'], 'Filled', qty, 0, price,
+                     order['perm_id'], 0, price, session.client_id, '')
+
+    def contract_details(self, session, req):
+        """
+        Every symbol is listed once, on --prim-exch, with a conId made from it.
+        --ambiguous symbols are listed on a second exchange as well, --unknown
+        ones are answered with error 200.
+        """
+        req_id = int(req['req_id'])
+        symbol = (req['symbol'] or req['local_symbol']).upper()
+        with self.lock:
+            self.stats['contract requests'] += 1
+            paced = session.pacer.paced()
+            if paced:
+                self.stats['paced'] += 1
+        if paced:
+            session.send(ERR_MSG, 2, req_id, 100, "Max rate of messages per second has been exceeded:max=%d" %
+                         self.args.max_rate)
+            return
+
+        if symbol in self.args.unknown:
+            listings = []
+        elif symbol in self.args.ambiguous:
+            listings = [self.args.prim_exch, 'ASX']
+        else:
+            listings = [self.args.prim_exch]
+        if listings:
+            con_id = zlib.crc32(symbol + req['sec_type']) & 0xffffff
+            replies = [(CONTRACT_DATA, 8, req_id, req['symbol'], req['sec_type'], '', 0, '',
+                        req['exchange'], req['currency'] or 'USD', req['local_symbol'] or symbol,
+                        symbol, symbol, con_id + i, 0.01, '', 'MKT,LMT', 'SMART,' + prim_exch, 1, 0,
+                        symbol, prim_exch, '', '', '', '', 'EST', '', '', '', 0, 0)
+                       for (i, prim_exch) in enumerate(listings)]
+            replies.append((CONTRACT_DATA_END, 1, req_id))
+        else:
+            replies = [(ERR_MSG, 2, req_id, 200, "No security definition has been found for the request")]
+        # one delay for all of them, jitter would reorder them
+        self.conditions.scheduler.call_later(self.conditions.ack_delay(), self.send_replies,
+                                             session, replies)
+
+    @staticmethod
+    def send_replies(session, replies):
+        for reply in replies:
+            session.send(*reply)
+
+    def cancel_order(self, session, order_id):
+        with self.lock:
+            order = self.open_orders.pop((session.client_id, order_id), None)
+            if order:
+                self.stats['cancelled'] += 1
+        if order:
+            session.send(ORDER_STATUS, 6, order_id, 'Cancelled', 0, order['quantity'], 0,
+                         order['perm_id'], 0, 0, session.client_id, '')
+        else:
+            session.send(ERR_MSG, 2, order_id, 135, "Can't find order with id =%d" % order_id)
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()   # print the stats on kill as on ctrl-c
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated TWS for IBWrapper.')
+    parser.add_argument('--port', type=int, default=7496, help='api port')
+    parser.add_argument('--fill-price', type=float, default=100, help='price orders fill around')
+    parser.add_argument('--account-rate', type=float, default=1,
+                        help='account values per second while subscribed')
+    parser.add_argument('--prim-exch', default='ARCA', help='primary exchange of every symbol')
+    parser.add_argument('--ambiguous', type=lambda s: s.upper().split(','), default=[],
+                        help='symbols listed on a second exchange, e.g. GLD,SPY')
+    parser.add_argument('--unknown', type=lambda s: s.upper().split(','), default=[],
+                        help='symbols contract details requests find nothing for')
+    parser.add_argument('--expect', type=int, default=0,
+                        help='orders that must be filled by the end, exits with 1 if fewer were')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every order')
+    SimBroker.add_arguments(parser)
+    args = parser.parse_args()
+
+    sim = TwsSim(args)
+    sim.log("TWS simulator (server version %d) listening on port %d" % (SERVER_VERSION, args.port))
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        sim.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sim.log(', '.join('%s: %d' % kv for kv in sorted(sim.stats.items())))
+    if args.expect:
+        filled = sim.stats['filled']
+        sim.log("%s: %d of %d expected orders filled" % (
+                'OK' if filled >= args.expect else 'FAILED', filled, args.expect))
+        if filled < args.expect:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
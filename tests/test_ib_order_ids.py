@@ -0,0 +1,68 @@
+# Checks of the IB order id allocator.
+# usage: python -m unittest discover -s tests -p 'test_*.py'
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ib_order_ids import IBOrderIdAllocator
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+class TestIBOrderIdAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='sigbridge-ids-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_not_persisted(self):
+        logger = Logger()
+        ids = IBOrderIdAllocator(None, block=10, logger=logger)
+        ids.reconcile(5)
+        self.assertEqual([ids.allocate() for _ in range(25)], range(5, 30))
+        self.assertEqual(ids.reserve(3), 30)
+        self.assertEqual(ids.allocate(), 33)
+        self.assertEqual(logger.errors, [])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_persisted(self):
+        path = os.path.join(self.dir, 'ids')
+        ids = IBOrderIdAllocator(path, block=10)
+        ids.reconcile(5)
+        for _ in range(12):
+            ids.allocate()
+        with open(path) as f:
+            self.assertEqual(int(f.read()), ids.limit)
+
+        # after a restart ids go on above the saved mark, even if TWS is behind
+        restarted = IBOrderIdAllocator(path, block=10)
+        restarted.reconcile(1)
+        self.assertTrue(restarted.allocate() >= 17)
+
+    def test_save_failed(self):
+        logger = Logger()
+        blocker = os.path.join(self.dir, 'file')
+        open(blocker, 'w').close()
+        ids = IBOrderIdAllocator(os.path.join(blocker, 'ids'), block=10, logger=logger)
+        ids.reconcile(1)
+        self.assertEqual([ids.allocate() for _ in range(3)], [1, 2, 3])
+        # the mark isn't raised past what's on disk, every id tries again
+        self.assertEqual(ids.limit, 0)
+        self.assertEqual(len(logger.errors), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
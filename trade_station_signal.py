@@ -21,42 +21,57 @@ TradeStation - Order has been filled for TQQQ
 """
 ################################################################################
 import re
+from email.utils import parsedate_tz, mktime_tz
 
 
-class TradeStationSignal:
+# compiled futures regex per configured pattern
+_future_regex_cache = {}
 
-    def __init__(self, data, conf):
-        """
-        Parses email data into wanted attributes
-        """
-        self.action = None
-        self.sig_type = None
-        self.symbol = None
-        self.quantity = 0
-        self.order_type = None
-        self.account_name = None
-        self.order_id = None
-        self.price = 0
-        self.sec_type = 'STK' # default to stock
-        self.future_regex = conf.get('future_regex')
+# Single pass scan of the lower-cased email. The well-formed variant of every
+# field is extracted directly; any other line starting with a known key falls
+# through to the generic 'key'/'rest' alternative and the line based parsing.
+SIGNAL_RE = re.compile(r"""
+    ^[^\S\n]*(?:
+        subject:(?P<subject>.*)
+      | date:(?P<date>.*)
+      | order:\ (?P<action>buy\ to\ cover|sell\ short|buy|sell)
+               \ (?P<order_qty>[\d,]+)\ (?P<symbol>[^\s,]+)\ @\ (?P<order_type>[a-z]+)[^\S\n]*$
+      | qty\ filled:\ (?P<qty>[\d,]+)[^\S\n]*$
+      | filled\ price:\ (?P<price>\d+(?:\.\d*)?)[^\S\n]*$
+      | account:\ (?P<account>\S+)[^\S\n]*$
+      | order\#:\ (?P<order_id>\S+)[^\S\n]*$
+      | (?P<key>order\#|order|qty\ filled|filled\ price|account):(?P<rest>.*)
+    )""", re.M | re.X)
+
+ACTION_MAP = {'buy to cover': 'buy', 'sell short': 'sell', 'buy': 'buy', 'sell': 'sell'}
+
+
+def compile_future_regex(pattern):
+    """Compiled futures symbol regex for the pattern, None if not configured."""
+    if not pattern:
+        return None
+    regex = _future_regex_cache.get(pattern)
+    if regex is None:
+        regex = _future_regex_cache[pattern] = re.compile(pattern)
+    return regex
+
+
+def parse_signal(data, conf):
+    """Parse email data with the parser selected by ts_signal.parser in app.yml."""
+    if conf.get('parser') == 'fast':
+        return FastTradeStationSignal(data, conf)
+    return TradeStationSignal(data, conf)
 
-        if data:
-            for line in data.split('\n'):
-                line = line.strip().lower()
-                if line.startswith('subject:'):
-                    self._parse_subject(line)
-                elif line.startswith('order:'):
-                    self._parse_order(line)
-                elif line.startswith('qty filled:'):
-                    self._parse_qty(line)
-                elif line.startswith('filled price:'):
-                    self._parse_price(line)
-                elif line.startswith('account:'):
-                    params = line.split(' ')
-                    self.account_name = params[1]
-                elif line.startswith('order#:'):
-                    params = line.split(' ')
-                    self.order_id = params[1]
+
+class SignalBase(object):
+    """Field parsing and validation shared by both signal parsers."""
+
+    __slots__ = ()
+
+    def _parse_date(self, line):
+        # time TradeStation sent the email, used to measure upstream delay
+        parsed = parsedate_tz(line[5:].strip())
+        self.sent_time = mktime_tz(parsed) if parsed else None
 
     def _parse_subject(self, line):
         # ensure this email is intended
@@ -77,12 +92,16 @@ class TradeStationSignal:
         self.action = params[1]
         if self.sig_type == 'opened':
             self.quantity = int(params[2])
-        self.symbol = params[3].upper()
-        if self.symbol and re.match(self.future_regex, self.symbol):
+        self._set_symbol(params[3].upper())
+        self.order_type = params[5]
+
+    def _set_symbol(self, symbol):
+        self.symbol = symbol
+        future_regex = compile_future_regex(self.future_regex)
+        if symbol and future_regex and future_regex.match(symbol):
             # detect future contract from symbol and converts it to ib's symbol
             self.sec_type = 'FUT'
-            self.symbol = self.symbol[0:-2] + self.symbol[-1]
-        self.order_type = params[5]
+            self.symbol = symbol[0:-2] + symbol[-1]
 
     def _parse_qty(self, line):
         line = line.replace(',', '')
@@ -113,3 +132,105 @@ class TradeStationSignal:
             print("Error: no order id!")
             return False
         return True
+
+
+class TradeStationSignal(SignalBase):
+
+    def __init__(self, data, conf):
+        """
+        Parses email data into wanted attributes
+        """
+        self.action = None
+        self.sig_type = None
+        self.symbol = None
+        self.quantity = 0
+        self.order_type = None
+        self.account_name = None
+        self.order_id = None
+        self.price = 0
+        self.sec_type = 'STK' # default to stock
+        self.future_regex = conf.get('future_regex')
+        self.sent_time = None   # epoch time of the email Date header
+        self.trace = None       # SignalTrace of this signal, if traced
+
+        if data:
+            for line in data.split('\n'):
+                line = line.strip().lower()
+                if line.startswith('subject:'):
+                    self._parse_subject(line)
+                elif line.startswith('date:'):
+                    self._parse_date(line)
+                elif line.startswith('order:'):
+                    self._parse_order(line)
+                elif line.startswith('qty filled:'):
+                    self._parse_qty(line)
+                elif line.startswith('filled price:'):
+                    self._parse_price(line)
+                elif line.startswith('account:'):
+                    params = line.split(' ')
+                    self.account_name = params[1]
+                elif line.startswith('order#:'):
+                    params = line.split(' ')
+                    self.order_id = params[1]
+
+
+class FastTradeStationSignal(SignalBase):
+    """
+    Same result as TradeStationSignal, but scans the email once with the
+    precompiled SIGNAL_RE instead of stripping and lower-casing every line.
+    """
+
+    __slots__ = ('action', 'sig_type', 'symbol', 'quantity', 'order_type',
+                 'account_name', 'order_id', 'price', 'sec_type', 'future_regex',
+                 'sent_time', 'trace')
+
+    def __init__(self, data, conf):
+        self.action = None
+        self.sig_type = None
+        self.symbol = None
+        self.quantity = 0
+        self.order_type = None
+        self.account_name = None
+        self.order_id = None
+        self.price = 0
+        self.sec_type = 'STK' # default to stock
+        self.future_regex = conf.get('future_regex')
+        self.sent_time = None   # epoch time of the email Date header
+        self.trace = None       # SignalTrace of this signal, if traced
+
+        if data:
+            for m in SIGNAL_RE.finditer(data.lower()):
+                group = m.lastgroup
+                if group == 'subject':
+                    self._parse_subject(m.group(0).strip())
+                elif group == 'date':
+                    self._parse_date(m.group(0).strip())
+                elif group == 'order_type':
+                    self.action = ACTION_MAP[m.group('action')]
+                    if self.sig_type == 'opened':
+                        self.quantity = int(m.group('order_qty').replace(',', ''))
+                    self._set_symbol(m.group('symbol').upper())
+                    self.order_type = m.group('order_type')
+                elif group == 'qty':
+                    self.quantity = int(m.group('qty').replace(',', ''))
+                elif group == 'price':
+                    self.price = float(m.group('price'))
+                elif group == 'account':
+                    self.account_name = m.group('account')
+                elif group == 'order_id':
+                    self.order_id = m.group('order_id')
+                else:
+                    self._parse_line(m.group('key'), m.group(0).strip())
+
+    def _parse_line(self, key, line):
+        """Line based parsing of a field that isn't in its usual form."""
+        if key == 'order':
+            self._parse_order(line)
+        elif key == 'qty filled':
+            self._parse_qty(line)
+        elif key == 'filled price':
+            self._parse_price(line)
+        elif key == 'account':
+            self.account_name = line.split(' ')[1]
+        elif key == 'order#':
+            self.order_id = line.split(' ')[1]